@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for CloudStorage transfers against a local GCS emulator.
+
+Start an emulator such as fake-gcs-server, e.g.
+
+    docker run -d -p 4443:4443 fsouza/fake-gcs-server -scheme http
+
+then run the benchmarks from the repo's top directory:
+
+    python -m benchmarks.gcs_transfer --latency-ms 20 --bandwidth-mbps 200 \\
+        -o bench_output.json
+
+Each scenario generates a local tree of files, then times the CloudStorage
+operations make_dirs, upload_tree, list_blobs, and download_tree on it. The
+injected latency and bandwidth limits apply to every HTTP request the storage
+client makes so the numbers approximate a real network link. Save the JSON
+results to compare runs across versions.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import namedtuple
+import json
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from requests.adapters import HTTPAdapter
+
+from borealis.util import data
+import borealis.util.filepath as fp
+
+
+DEFAULT_EMULATOR = 'http://localhost:4443'
+DEFAULT_BUCKET = 'borealis-benchmark'
+MB = 1024 * 1024
+
+#: A file tree to benchmark: `count` files of `size` bytes each, spread
+#: over `depth` levels of subdirectories with up to `fanout` entries each.
+Scenario = namedtuple('Scenario', 'name count size depth fanout')
+
+SCENARIOS = {s.name: s for s in [
+    Scenario('small-flat', 10000, 4 * 1024, 0, 0),
+    Scenario('small-deep', 10000, 4 * 1024, 4, 10),
+    Scenario('large-flat', 100, 100 * MB, 0, 0),
+    Scenario('large-deep', 100, 100 * MB, 3, 4),
+]}
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """A requests transport adapter that counts requests and bytes, and delays
+    each request to simulate network latency and bandwidth.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, **kwargs):
+        # type: (float, Optional[float], **Any) -> None
+        """
+        latency: seconds to add to each request.
+        bandwidth: bytes/second to limit each request's transfer rate, or None
+            for no limit.
+        """
+        super(ThrottledAdapter, self).__init__(**kwargs)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # type: () -> None
+        """Reset the request and byte counters."""
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def send(self, request, **kwargs):
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+
+        response = super(ThrottledAdapter, self).send(request, **kwargs)
+        received = int(response.headers.get('Content-Length') or 0)
+
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+        delay = self.latency
+        if self.bandwidth:
+            delay += (sent + received) / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+
+def make_tree(root, scenario):
+    # type: (str, Scenario) -> List[str]
+    """Write the scenario's files under root. Return their relative paths."""
+    block = os.urandom(min(scenario.size, MB))
+    paths = []
+
+    for i in range(scenario.count):
+        parts = []
+        n = i
+        for _ in range(scenario.depth):
+            parts.append('d{}'.format(n % scenario.fanout))
+            n //= scenario.fanout
+        rel_path = os.path.join(*(parts + ['f{}.dat'.format(i)]))
+        path = os.path.join(root, rel_path)
+
+        fp.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            remaining = scenario.size
+            while remaining > 0:
+                chunk = block[:remaining]
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        paths.append(rel_path)
+
+    return paths
+
+
+def measure(adapter, scenario, operation, nbytes, fn):
+    # type: (ThrottledAdapter, Scenario, str, int, Callable[[], Any]) -> Dict[str, Any]
+    """Time fn() and return a results row for the operation."""
+    adapter.reset()
+    start = time.time()
+    fn()
+    seconds = max(time.time() - start, 1e-9)
+
+    row = {
+        'scenario': scenario.name,
+        'operation': operation,
+        'files': scenario.count,
+        'bytes': nbytes,
+        'seconds': round(seconds, 3),
+        'files_per_sec': round(scenario.count / seconds, 1),
+        'mb_per_sec': round(nbytes / MB / seconds, 2),
+        'requests': adapter.requests,
+        'bytes_sent': adapter.bytes_sent,
+        'bytes_received': adapter.bytes_received,
+    }
+    print('{scenario:>12} {operation:>14}: {seconds:9.3f} s {files_per_sec:10.1f}'
+          ' files/s {mb_per_sec:9.2f} MB/s {requests:7} requests'.format(**row))
+    return row
+
+
+def run_scenario(client, adapter, bucket_name, scenario, work_dir):
+    # type: (Any, ThrottledAdapter, str, Scenario, str) -> List[Dict[str, Any]]
+    """Run the benchmark operations on one scenario."""
+    from borealis.util import storage as st
+
+    upload_dir = os.path.join(work_dir, 'upload')
+    download_dir = os.path.join(work_dir, 'download')
+    paths = make_tree(upload_dir, scenario)
+    nbytes = scenario.count * scenario.size
+
+    run_prefix = '{}/{}/{}/'.format(bucket_name, data.timestamp(), scenario.name)
+    gcs = st.CloudStorage(run_prefix, client=client)
+    sub_path = 'tree/'
+
+    def make_dirs():
+        for path in paths:
+            gcs.make_dirs(os.path.join('dirs', path))
+
+    def upload():
+        gcs.clear_directory_cache()
+        gcs.upload_tree(upload_dir, sub_path)
+
+    def list_blobs():
+        for _ in gcs.list_blobs(sub_path):
+            pass
+
+    def download():
+        gcs.download_tree(sub_path, download_dir)
+
+    try:
+        return [
+            measure(adapter, scenario, 'make_dirs', 0, make_dirs),
+            measure(adapter, scenario, 'upload_tree', nbytes, upload),
+            measure(adapter, scenario, 'list_blobs', 0, list_blobs),
+            measure(adapter, scenario, 'download_tree', nbytes, download),
+        ]
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def _version():
+    # type: () -> str
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('borealis-fireworks').version
+    except Exception:
+        return 'unknown'
+
+
+def main(args):
+    # type: (argparse.Namespace) -> Dict[str, Any]
+    # The storage library reads the emulator host when it's first imported.
+    os.environ['STORAGE_EMULATOR_HOST'] = args.emulator
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud.exceptions import Conflict
+    from google.cloud.storage import Client
+    import requests
+
+    adapter = ThrottledAdapter(
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mbps * 1e6 / 8 if args.bandwidth_mbps else None,
+        pool_maxsize=32)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    client = Client(
+        project='benchmark', credentials=AnonymousCredentials(), _http=session)
+
+    try:
+        client.create_bucket(args.bucket)
+    except Conflict:
+        pass
+
+    results = {
+        'version': _version(),
+        'timestamp': data.timestamp(),
+        'python': platform.python_version(),
+        'settings': {
+            'emulator': args.emulator,
+            'latency_ms': args.latency_ms,
+            'bandwidth_mbps': args.bandwidth_mbps,
+            'scale': args.scale},
+        'results': []}
+
+    work_dir = tempfile.mkdtemp(prefix='borealis-bench-')
+    try:
+        for name in args.scenarios:
+            scenario = SCENARIOS[name]
+            scenario = scenario._replace(
+                count=max(1, int(scenario.count * args.scale)))
+            results['results'].extend(
+                run_scenario(client, adapter, args.bucket, scenario, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Wrote {}'.format(args.output))
+
+    return results
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Benchmark CloudStorage transfers against a local GCS'
+                    ' emulator with injected latency and bandwidth limits.')
+    parser.add_argument('--emulator', default=DEFAULT_EMULATOR,
+        help='The GCS emulator URL (default="{}").'.format(DEFAULT_EMULATOR))
+    parser.add_argument('--bucket', default=DEFAULT_BUCKET,
+        help='The emulator bucket name to use (default="{}").'.format(
+            DEFAULT_BUCKET))
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+        help='Latency to add to each HTTP request, in milliseconds.')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0,
+        help='Bandwidth limit in megabits/second (default=0 for no limit).')
+    parser.add_argument('-s', '--scenarios', nargs='+',
+        choices=sorted(SCENARIOS), default=sorted(SCENARIOS),
+        help='The scenarios to run (default=all).')
+    parser.add_argument('--scale', type=float, default=1.0,
+        help='Scale factor for the scenarios\' file counts, e.g. 0.01 for a'
+             ' quick run.')
+    parser.add_argument('-o', '--output', metavar='JSON_FILE',
+        help='Write the results to this JSON file.')
+
+    args = parser.parse_args()
+    main(args)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Import-time benchmark that guards the startup latency of the `gce` and
+`fireworker` entry points and of deserializing DockerTasks.
+
+Run it from the repo's top directory (it needs Python 3.7+ for
+`-X importtime`):
+
+    python -m benchmarks.import_time
+
+Each case imports a module in a fresh Python process with `-X importtime`,
+takes the module's median cumulative import time over the runs, and checks
+it against a time budget. It also checks that the process didn't load any of
+the case's heavy dependencies. The exit code is 1 if any case fails, so this
+can run in CI.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+from collections import namedtuple
+import json
+import subprocess
+import sys
+from typing import Any, Dict, List, Tuple
+
+#: A startup path to measure: `setup` is code to run first and not measure,
+#: e.g. importing FireWorks, which deserializing anything needs; `code` does
+#: the import of `module` to measure; `budget_ms` is the allowed cumulative
+#: import time of `module`; and `forbidden` lists top-level module names it
+#: mustn't load.
+Case = namedtuple('Case', 'name setup code module budget_ms forbidden')
+
+CASES = [
+    Case('gce', '', 'import borealis.gce', 'borealis.gce', 100,
+         ('requests', 'ruamel', 'fireworks', 'google', 'docker')),
+    Case('fireworker --setup', '', 'import borealis.fireworker',
+         'borealis.fireworker', 100,
+         ('requests', 'ruamel', 'fireworks', 'google', 'docker')),
+    Case('DockerTask deserialization', 'import fireworks',
+         'from borealis.docker_task import DockerTask\n'
+         'DockerTask.from_dict({"name": "t", "image": "i", "command": ["true"],'
+         ' "internal_prefix": "/in", "storage_prefix": "bucket/p/"})',
+         'borealis.docker_task', 100,
+         ('docker', 'google.cloud.storage', 'requests')),
+]
+
+#: Child process code that notes the modules loaded by the setup code...
+_SNAPSHOT = 'import sys as _sys; _before = set(_sys.modules)'
+
+#: ...and reports which forbidden modules got loaded after that.
+_REPORT = '''
+import json
+_new = set(_sys.modules) - _before
+print(json.dumps([m for m in {forbidden!r}
+                  if any(k == m or k.startswith(m + '.') for k in _new)]))
+'''
+
+
+def import_time_us(stderr, module):
+    # type: (str, str) -> int
+    """Return the module's cumulative import time in microseconds from the
+    `-X importtime` output, or 0 if it wasn't imported.
+    """
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1])
+    return 0
+
+
+def run_once(case):
+    # type: (Case) -> Tuple[int, List[str]]
+    """Run the case in a fresh process. Return the module's cumulative import
+    time in microseconds and the forbidden modules that it loaded after the
+    setup code.
+    """
+    code = '\n'.join([case.setup, _SNAPSHOT, case.code,
+                      _REPORT.format(forbidden=list(case.forbidden))])
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    if process.returncode:
+        raise RuntimeError('Case "{}" failed:\n{}'.format(case.name, stderr))
+
+    loaded = json.loads(stdout.strip().splitlines()[-1])
+    return import_time_us(stderr, case.module), loaded
+
+
+def measure(case, runs, scale):
+    # type: (Case, int, float) -> Dict[str, Any]
+    """Measure the case and return a results row."""
+    times = []
+    loaded = set()
+    for _ in range(runs):
+        us, modules = run_once(case)
+        times.append(us)
+        loaded.update(modules)
+
+    median_ms = sorted(times)[len(times) // 2] / 1000
+    budget_ms = case.budget_ms * scale
+    row = {
+        'case': case.name,
+        'median_ms': round(median_ms, 1),
+        'budget_ms': budget_ms,
+        'loaded': sorted(loaded),
+        'ok': median_ms <= budget_ms and not loaded}
+    print('{case:>28}: {median_ms:7.1f} ms (budget {budget_ms:.0f} ms) {status}'
+          .format(status='OK' if row['ok'] else 'FAIL', **row))
+    if loaded:
+        print('{:>28}  loaded heavy modules: {}'.format('', ', '.join(row['loaded'])))
+    return row
+
+
+def main(args):
+    # type: (argparse.Namespace) -> List[Dict[str, Any]]
+    if sys.version_info < (3, 7):
+        raise SystemExit('This needs Python 3.7+ for `-X importtime`.')
+
+    return [measure(case, args.runs, args.scale) for case in CASES]
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Check the import time of the gce and fireworker entry'
+                    ' points and of DockerTask deserialization against'
+                    ' budgets.')
+    parser.add_argument('-n', '--runs', type=int, default=5,
+        help='The number of fresh processes to run per case (default=5).')
+    parser.add_argument('--scale', type=float, default=1.0,
+        help='Scale factor for the time budgets, e.g. 2 for a slow machine.')
+
+    args = parser.parse_args()
+    results = main(args)
+    if not all(row['ok'] for row in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
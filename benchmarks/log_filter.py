@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Micro-benchmark for the Fireworker's log filtering on the `dockerfiretask.*`
+hot path, i.e. logging each line of a task's container output.
+
+Run it from the repo's top directory:
+
+    python -m benchmarks.log_filter -n 200000
+
+It logs through a Logger with two no-op handlers, each with a LogPrefixFilter
+like the Fireworker's cloud and console handlers, and reports records/sec for
+records that pass the filters and records that the filters reject, with and
+without the filter's level cache and apply_logger_levels().
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import time
+from typing import Any, Callable, Dict, List
+
+from borealis.util.log_filter import LogPrefixFilter, apply_logger_levels
+
+
+class _NullHandler(logging.Handler):
+    """A Handler that formats each record then discards it."""
+
+    def emit(self, record):
+        self.format(record)
+
+
+class _UncachedFilter(LogPrefixFilter):
+    """A LogPrefixFilter that resolves the level for every record."""
+
+    def level_for(self, name):
+        return self._levels.get(name.split('.', 1)[0], self._else_level)
+
+
+def _setup(filter_class, raise_levels):
+    # type: (type, bool) -> logging.Logger
+    """Set up a fresh task logger and handlers like the Fireworker does."""
+    parent = logging.getLogger('dockerfiretask')
+    parent.handlers = []
+    parent.propagate = False
+    parent.setLevel(logging.DEBUG)
+
+    cloud_filter = filter_class({'dockerfiretask': logging.DEBUG}, logging.WARNING)
+    console_filter = filter_class({'dockerfiretask': logging.INFO}, logging.INFO)
+    for f in (cloud_filter, console_filter):
+        handler = _NullHandler()
+        handler.addFilter(f)
+        parent.addHandler(handler)
+
+    if raise_levels:
+        # Pretend both handlers were more selective, as off GCE.
+        cloud_filter.set_level('dockerfiretask', logging.WARNING)
+        apply_logger_levels(cloud_filter, console_filter)
+
+    return logging.getLogger('dockerfiretask.benchmark-task')
+
+
+def measure(name, count, fn):
+    # type: (str, int, Callable[[], Any]) -> Dict[str, Any]
+    """Time fn() which logs `count` records and return a results row."""
+    start = time.time()
+    fn()
+    seconds = max(time.time() - start, 1e-9)
+
+    row = {'case': name, 'records': count, 'seconds': round(seconds, 3),
+           'records_per_sec': round(count / seconds)}
+    print('{case:>32}: {seconds:8.3f} s {records_per_sec:12,} records/s'.format(
+        **row))
+    return row
+
+
+def main(args):
+    # type: (argparse.Namespace) -> List[Dict[str, Any]]
+    count = args.count
+    line = 'a line of container output from a task'
+
+    def log_info(logger):
+        return lambda: [logger.info('%s', line) for _ in range(count)]
+
+    def log_debug(logger):
+        return lambda: [logger.debug('%s', line) for _ in range(count)]
+
+    results = []
+    for label, filter_class in (('uncached', _UncachedFilter),
+                                ('cached', LogPrefixFilter)):
+        logger = _setup(filter_class, raise_levels=False)
+        results.append(measure(
+            'passed, {} filter'.format(label), count, log_info(logger)))
+
+        # The cloud filter passes DEBUG records, so raise it to reject them.
+        logger.parent.handlers[0].filters[0].set_level(
+            'dockerfiretask', logging.WARNING)
+        results.append(measure(
+            'rejected, {} filter'.format(label), count, log_debug(logger)))
+
+    logger = _setup(LogPrefixFilter, raise_levels=True)
+    results.append(measure(
+        'rejected, raised logger level', count, log_debug(logger)))
+
+    return results
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Benchmark LogPrefixFilter on the dockerfiretask.* logging'
+                    ' hot path.')
+    parser.add_argument('-n', '--count', type=int, default=200000,
+        help='The number of records to log per case (default=200000).')
+
+    args = parser.parse_args()
+    main(args)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""Check and measure BatchingCloudHandler's shipping latency, i.e. how long a
+log record waits in memory before the background thread ships it.
+
+Run it from the repo's top directory:
+
+    python -m benchmarks.log_shipping --max-latency 0.5
+
+It ships through a fake cloud logging client, so it needs no credentials. It
+logs a single record to a quiet handler and fails unless the record ships
+within `max_latency` (plus some scheduling slack), then reports the latency of
+a record logged after a burst and the time to ship a full queue.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import logging
+import sys
+from threading import Event
+import time
+from typing import Any, Dict, List
+
+from borealis.util.log_shipping import BatchingCloudHandler
+
+
+#: Seconds of scheduling slack to allow beyond max_latency.
+SLACK = 0.25
+
+
+class _FakeBatch(object):
+    def __init__(self, shipped):
+        self.entries = []  # type: List[Dict[str, Any]]
+        self._shipped = shipped
+
+    def log_struct(self, info, **kwargs):
+        self.entries.append(info)
+
+    def commit(self):
+        self._shipped(self.entries)
+        self.entries = []
+
+
+class _FakeLogger(object):
+    def __init__(self, shipped):
+        self._shipped = shipped
+
+    def batch(self):
+        return _FakeBatch(self._shipped)
+
+
+class _FakeClient(object):
+    """A cloud logging Client that records when each message shipped."""
+
+    def __init__(self):
+        self.shipped = {}  # type: Dict[str, float]
+        self.event = Event()
+
+    def logger(self, name):
+        return _FakeLogger(self._ship)
+
+    def _ship(self, entries):
+        now = time.time()
+        for entry in entries:
+            for line in entry['message'].split('\n'):
+                self.shipped.setdefault(line, now)
+        self.event.set()
+
+
+def _setup(max_latency):
+    # type: (float) -> tuple
+    client = _FakeClient()
+    handler = BatchingCloudHandler(client, 'benchmark', max_latency=max_latency)
+    logger = logging.getLogger('benchmark-log-shipping')
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return client, handler, logger
+
+
+def _latency(client, message, start, timeout):
+    # type: (_FakeClient, str, float, float) -> float
+    """Wait up to timeout for the message to ship; return its latency or inf."""
+    deadline = start + timeout
+    while message not in client.shipped and time.time() < deadline:
+        client.event.wait(0.01)
+        client.event.clear()
+    return client.shipped.get(message, float('inf')) - start
+
+
+def main(args):
+    # type: (argparse.Namespace) -> bool
+    max_latency = args.max_latency
+    timeout = max_latency + SLACK
+    ok = True
+
+    client, handler, logger = _setup(max_latency)
+    time.sleep(max_latency)  # let the shipper go idle on an empty queue
+    start = time.time()
+    logger.warning('hello')
+    latency = _latency(client, 'hello', start, timeout)
+    passed = latency <= timeout
+    ok = ok and passed
+    print('{:>32}: {:8.3f} s {}'.format(
+        'one record on a quiet handler', latency, 'ok' if passed else 'FAILED'))
+
+    for i in range(args.count):
+        logger.info('burst %d', i)
+    start = time.time()
+    logger.info('after the burst')
+    latency = _latency(client, 'after the burst', start, timeout)
+    passed = latency <= timeout
+    ok = ok and passed
+    print('{:>32}: {:8.3f} s {}'.format(
+        'one record after a burst', latency, 'ok' if passed else 'FAILED'))
+    handler.close()
+
+    client, handler, logger = _setup(max_latency)
+    start = time.time()
+    for i in range(args.count):
+        logger.info('queued %d', i)
+    last = 'queued {}'.format(args.count - 1)
+    latency = _latency(client, last, start, timeout + 10)
+    print('{:>32}: {:8.3f} s'.format(
+        '{:,} records'.format(args.count), latency))
+    handler.close()
+
+    return ok
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description='Check and measure BatchingCloudHandler shipping latency.')
+    parser.add_argument('--max-latency', type=float, default=0.5,
+        help="The handler's max_latency in seconds (default=0.5).")
+    parser.add_argument('-n', '--count', type=int, default=10000,
+        help='The number of records to log in a burst (default=10000).')
+
+    args = parser.parse_args()
+    if not main(args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,190 @@
+"""Scale a group of Fireworker VMs to track the LaunchPad's queue depth."""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from borealis.gce import ComputeEngine
+
+#: GCE VM statuses that count as live workers (and cost money).
+LIVE_STATUSES = ('PROVISIONING', 'STAGING', 'RUNNING')
+
+#: Firework states that mean the workflows still have work to do.
+PENDING_STATES = ['READY', 'RESERVED', 'RUNNING', 'WAITING']
+
+
+def _index_of(name):
+    # type: (str) -> int
+    """Return the numeric suffix of a "{prefix}-{index}" VM name."""
+    return int(name.rsplit('-', 1)[1])
+
+
+def _runs(indexes):
+    # type: (List[int]) -> List[Tuple[int, int]]
+    """Group VM indexes into contiguous (base, count) runs."""
+    runs = []  # type: List[Tuple[int, int]]
+    for i in sorted(indexes):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((i, 1))
+    return runs
+
+
+class Autoscaler(object):
+    """Creates and retires Fireworker VMs named "{prefix}-{index}" to track the
+    number of READY and RUNNING Fireworks on a LaunchPad, within min/max bounds
+    and an optional budget of VM-hours.
+
+    It retires workers by setting their `quit=when-idle` metadata so they
+    finish their current rockets then shut themselves down, and reclaims
+    retiring workers (by resetting `quit`) before creating new ones. Once over
+    budget, it asks all workers to `quit=soon`, i.e. after their current
+    rockets, and stops when they're gone.
+    """
+
+    def __init__(self, compute_engine, launchpad, min_workers=0, max_workers=10,
+                 rockets_per_worker=1, max_vm_hours=None, interval=60,
+                 command_options=None, metadata=None):
+        # type: (ComputeEngine, Any, int, int, int, Optional[float], float, Optional[Dict[str, Any]], Optional[Dict[str, Any]]) -> None
+        """
+        :param compute_engine: creates, lists, and sets metadata on the VMs
+        :param launchpad: the FireWorks LaunchPad to watch
+        :param min_workers: keep at least this many workers while the
+            workflows have pending work
+        :param max_workers: never run more than this many workers
+        :param rockets_per_worker: the READY + RUNNING rockets to allow per
+            worker, e.g. 1 for full parallelism
+        :param max_vm_hours: once the live workers have accumulated this many
+            VM-hours, stop creating workers and ask all of them to quit after
+            their current rockets, or None for no budget
+        :param interval: seconds between scaling steps
+        :param command_options: `gcloud compute instances create` options
+        :param metadata: metadata fields for the created VMs. If it has a
+            `category` (a FireWorks category name, or several separated by
+            spaces), the workers will only run Fireworks with that spec
+            `_category`, so count only those.
+        """
+        assert 0 <= min_workers <= max_workers, 'need 0 <= min <= max workers'
+        assert rockets_per_worker > 0, 'rockets_per_worker must be positive'
+
+        self.compute_engine = compute_engine
+        self.launchpad = launchpad
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.rockets_per_worker = rockets_per_worker
+        self.max_vm_hours = max_vm_hours
+        self.interval = interval
+        self.command_options = command_options or {}
+        self.metadata = metadata or {}
+
+        categories = str(self.metadata.get('category') or '').split()
+        self.query = ({'spec._category': {'$in': categories}} if categories
+                      else {})  # type: Dict[str, Any]
+
+        self.vm_hours = 0.0
+        self.retiring = set()  # type: Set[str]
+        self.quitting = set()  # type: Set[str]  # asked to quit=soon
+        self._last_step = None  # type: Optional[float]
+
+    def count_fireworks(self, states):
+        # type: (List[str]) -> int
+        """Count the Fireworks in any of the given states (and in the workers'
+        category, if any).
+        """
+        return self.launchpad.get_fw_ids(
+            query=dict(self.query, state={'$in': states}), count_only=True)
+
+    def target(self, ready, running):
+        # type: (int, int) -> int
+        """Return the target number of workers for the queue depth."""
+        wanted = -(-(ready + running) // self.rockets_per_worker)  # ceiling
+        return max(self.min_workers, min(self.max_workers, wanted))
+
+    def _set_quit(self, names, value):
+        # type: (List[str], str) -> Set[str]
+        """Set the named workers' `quit` metadata field. Return the names of
+        the workers it succeeded on.
+        """
+        succeeded = set()  # type: Set[str]
+        for base, count in _runs([_index_of(name) for name in names]):
+            result = self.compute_engine.set_metadata(
+                base, count, command_options={'quiet': None}, quit=value)
+            succeeded.update(result.succeeded)
+        return succeeded
+
+    def step(self):
+        # type: () -> bool
+        """Take one scaling step. Return False when the workflows have no
+        pending work left and all workers got asked to quit, or when over
+        budget and all workers are gone.
+        """
+        now = time.time()
+        instances = self.compute_engine.list_instances()
+        live = sorted((name for name, (_, status) in instances.items()
+                       if status in LIVE_STATUSES), key=_index_of)
+
+        if self._last_step is not None:
+            self.vm_hours += len(live) * (now - self._last_step) / 3600
+        self._last_step = now
+
+        self.retiring &= set(live)
+        active = [name for name in live if name not in self.retiring]
+
+        ready = self.count_fireworks(['READY'])
+        running = self.count_fireworks(['RESERVED', 'RUNNING'])
+        pending = ready + running or self.count_fireworks(PENDING_STATES)
+        target = self.target(ready, running) if pending else 0
+        over_budget = (self.max_vm_hours is not None
+                       and self.vm_hours >= self.max_vm_hours)
+
+        print('Autoscale: {} READY, {} RUNNING; {} active + {} retiring workers;'
+              ' target {}; {:.2f} VM-hours{}'.format(
+            ready, running, len(active), len(self.retiring), target,
+            self.vm_hours, ' (over budget)' if over_budget else ''))
+
+        if over_budget:
+            quit_soon = [name for name in live if name not in self.quitting]
+            if quit_soon:
+                self.quitting |= self._set_quit(quit_soon, 'soon')
+            return bool(live)
+
+        if target > len(active):
+            reclaim = sorted(self.retiring, key=_index_of)[:target - len(active)]
+            reclaimed = self._set_quit(reclaim, 'no') if reclaim else set()
+            self.retiring -= reclaimed
+
+            to_create = target - len(active) - len(reclaimed)
+            if to_create > 0 and not over_budget:
+                base = max([_index_of(name) for name in instances] + [-1]) + 1
+                self.compute_engine.create(
+                    base, to_create, command_options=self.command_options,
+                    **self.metadata)
+        elif target < len(active) and ready == 0:
+            retire = active[target:]
+            self.retiring |= self._set_quit(retire, 'when-idle')
+
+        return bool(pending or active)
+
+    def run(self):
+        # type: () -> None
+        """Take scaling steps every `interval` seconds until the workflows have
+        no pending work left (or the budget ran out). Print and retry failed
+        steps, e.g. from a `gcloud` or LaunchPad connection error.
+
+        In dry run mode, which doesn't create VMs, just take one step.
+        """
+        while True:
+            try:
+                more = self.step()
+            except Exception as e:
+                traceback.print_exc()
+                print('Autoscale: step failed: {!r}'.format(e))
+                more = True
+
+            if not more or self.compute_engine.dry_run:
+                break
+            time.sleep(self.interval)
+        print('Autoscale: done, {:.2f} VM-hours'.format(self.vm_hours))
@@ -4,26 +4,33 @@ files from Google Cloud Storage (GCS) and pushing output files to GCS.
 
 from __future__ import absolute_import, division, print_function
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
 import logging
 import os
 from pprint import pformat
 import shutil
-from threading import Event, Timer
+from threading import Event, Lock, Thread, Timer
 import time
-from typing import Any, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TYPE_CHECKING
 
-import docker
-from docker import errors as docker_errors
-from docker.models.containers import Container
-from docker.types import Mount
-from docker.utils import parse_repository_tag
 from fireworks import explicit_serialize, FiretaskBase, FWAction
-import requests
 
 from borealis.util import data
 import borealis.util.filepath as fp
-import borealis.util.storage as st
+from borealis.util import metrics
+from borealis.util import profiling
+
+# FireWorks imports this module to deserialize DockerTasks, e.g. in LaunchPad
+# queries and the autoscaler, so import Docker and the storage libraries only
+# in the methods that run tasks. See benchmarks/import_time.py.
+if TYPE_CHECKING:
+    import docker
+    from docker.models.containers import Container
+    import borealis.util.storage as st
+    from borealis.util.file_cache import FileCache
 
 
 class DockerTaskError(Exception):
@@ -31,7 +38,56 @@ class DockerTaskError(Exception):
     pass
 
 
-PathMapping = namedtuple('PathMapping', 'captures local_prefix local sub_path mount')
+class DockerTaskStopped(DockerTaskError):
+    """The DockerTask stopped early on request, e.g. because its GCE VM is
+    being preempted. The Fireworker should requeue the Firework.
+    """
+    pass
+
+
+#: How DockerTask maps an input or output `path` (as given in its parameters)
+#: to a `local` path and a storage `sub_path`.
+PathMapping = namedtuple(
+    'PathMapping', 'captures archive local_prefix local sub_path mount path')
+
+#: DockerTask metrics for the Fireworker's metrics endpoint.
+TASKS = metrics.counter(
+    'borealis_dockertask_tasks_total', 'DockerTasks run, by outcome.', ['outcome'])
+PHASE_SECONDS = metrics.histogram(
+    'borealis_dockertask_phase_seconds',
+    'DockerTask phase durations: looking up and reusing memoized results,'
+    ' pulling the Docker image, downloading inputs, running the container,'
+    ' and uploading outputs; and pre-pulling images at Fireworker startup.',
+    ['phase'])
+
+#: The fw_spec key where DockerTasks pass their output manifests to their
+#: child Fireworks. See DockerTask.push_to_gcs().
+MANIFESTS_KEY = '_borealis_manifests'
+
+#: The bucket directory for `memoize` records. See DockerTask.memo_key().
+MEMO_DIR = 'borealis-memo/'
+
+#: The memo key format version. Bump it when changing what goes into the key.
+MEMO_VERSION = 1
+
+#: A DockerTask's memo `key` (or None if it couldn't compute one), the memo
+#: `record` of a past successful run with that key (or None), and the inputs'
+#: list_inputs() `listings`.
+Memo = namedtuple('Memo', 'key record listings')
+
+#: gcsfuse options for mounting `lazy` inputs: read-only, visible to the
+#: Docker daemon, and with directories implied by the object names.
+GCSFUSE_ARGS = ('--implicit-dirs', '-o', 'ro', '-o', 'allow_other')
+
+#: Seconds to let the Docker process exit after SIGTERM when a stop request
+#: (see request_stop()) stops it, before SIGKILL.
+STOP_GRACE_SECONDS = 5
+
+#: Seconds from a stop request to raising DockerTaskStopped, including
+#: stopping the Docker process and pushing outputs, so the Fireworker can
+#: requeue the Firework within a preempted GCE VM's ~30 second notice. The
+#: push continues in the background after that.
+STOP_DEADLINE_SECONDS = 20
 
 
 try:
@@ -41,11 +97,176 @@ except AttributeError:
     seconds_clock = time.time
 
 
+_stop_lock = Lock()
+_stop_reason = None  # type: Optional[str]
+_stop_callback = None  # type: Optional[Callable[[str], None]]
+
+#: The max number of recently cached input paths to remember for
+#: locality_queries().
+MAX_WARM_INPUTS = 64
+
+_warm_lock = Lock()
+_warm_images = set()  # type: Set[str]
+_warm_inputs = OrderedDict()  # type: OrderedDict  # (storage_prefix, internal_prefix, path) -> None
+_input_cache = None  # type: Optional[FileCache]
+
+
+def request_stop(reason):
+    # type: (str) -> None
+    """Ask the running DockerTask (if any) to stop its Docker container, push
+    its outputs, and raise DockerTaskStopped. Any DockerTask that starts later
+    in this process will raise DockerTaskStopped right away. This is
+    thread-safe.
+    """
+    global _stop_reason
+
+    with _stop_lock:
+        _stop_reason = reason
+        callback = _stop_callback
+
+    if callback:
+        callback(reason)
+
+
+def _set_stop_callback(callback):
+    # type: (Optional[Callable[[str], None]]) -> Optional[str]
+    """Set or clear the running task's stop callback. Return the stop reason
+    if a stop was already requested.
+    """
+    global _stop_callback
+
+    with _stop_lock:
+        _stop_callback = callback
+        return _stop_reason
+
+
+def use_input_cache(cache):
+    # type: (Optional[FileCache]) -> None
+    """Set the FileCache for DockerTasks in this process to pull their inputs
+    through, or None for no cache.
+    """
+    global _input_cache
+    _input_cache = cache
+
+
+def _note_warm_images(*image_names):
+    # type: (*str) -> None
+    with _warm_lock:
+        _warm_images.update(image_names)
+
+
+def _note_warm_inputs(storage_prefix, internal_prefix, paths):
+    # type: (str, str, Iterable[str]) -> None
+    with _warm_lock:
+        for path in paths:
+            key = (storage_prefix, internal_prefix, path)
+            _warm_inputs.pop(key, None)
+            _warm_inputs[key] = None
+        while len(_warm_inputs) > MAX_WARM_INPUTS:
+            _warm_inputs.popitem(last=False)
+
+
+def locality_queries():
+    # type: () -> List[Tuple[str, Dict[str, Any]]]
+    """Return (name, LaunchPad Firework query) pairs in order of preference
+    for running next on this worker: 'inputs' for Fireworks with a DockerTask
+    whose inputs this worker recently pulled or pushed via its input cache, then
+    'image' for ones whose Docker image it already pulled. This is a hint:
+    The cache could've evicted the files.
+    """
+    with _warm_lock:
+        images = sorted(_warm_images)
+        input_groups = {}  # type: Dict[Tuple[str, str], List[str]]
+        for storage_prefix, internal_prefix, path in _warm_inputs:
+            input_groups.setdefault((storage_prefix, internal_prefix), []).append(path)
+
+    def query(clauses):
+        return {'spec._tasks': {'$elemMatch': {
+            '_fw_name': DockerTask._fw_name, '$or': clauses}}}
+
+    queries = []
+    if input_groups:
+        queries.append(('inputs', query([
+            {'storage_prefix': storage_prefix,
+             'internal_prefix': internal_prefix,
+             'inputs': {'$in': sorted(paths)}}
+            for (storage_prefix, internal_prefix), paths
+            in sorted(input_groups.items())])))
+    if images:
+        queries.append(('image', query([{'image': {'$in': images}}])))
+    return queries
+
+
+def resource_query(cpus, memory_gb):
+    # type: (float, float) -> Dict[str, Any]
+    """Return a LaunchPad Firework query for Fireworks that don't have any
+    DockerTask needing more than `cpus` CPUs or `memory_gb` GiB of RAM.
+    """
+    return {'spec._tasks': {'$not': {'$elemMatch': {
+        '_fw_name': DockerTask._fw_name,
+        '$or': [{'cpus': {'$gt': cpus}}, {'memory_gb': {'$gt': memory_gb}}]}}}}
+
+
 def uid_gid():
     """Return the Unix uid:gid (user ID, group ID) pair."""
+    if hasattr(os, 'getuid'):
+        return '{}:{}'.format(os.getuid(), os.getgid())
     return '{}:{}'.format(fp.run_cmdline('id -u'), fp.run_cmdline('id -g'))
 
 
+def pull_image(docker_client, image_name, logger):
+    # type: (docker.DockerClient, str, logging.Logger) -> Any  # a Docker Image
+    """Pull the named Docker Image. Ensure there's a tag so pull() will get one
+    Image rather than all tags in a repository.
+    """
+    from docker.utils import parse_repository_tag
+    import requests
+
+    repository, tag = parse_repository_tag(image_name)
+    if not tag:
+        tag = 'latest'  # 'latest' is the default tag; it doesn't mean squat
+    logger.info('Pulling Docker image %s:%s', repository, tag)
+    try:
+        image = docker_client.images.pull(repository, tag)
+        logger.debug('Pulled Docker image %s', image.id)
+    except requests.ConnectionError as e:
+        raise DockerTaskError(
+            "Couldn't connect to the Docker server. You might need to"
+            " install one or start it. {!r}".format(e))
+
+    _note_warm_images(image_name, '{}:{}'.format(repository, tag),
+                      *([repository] if tag == 'latest' else []))
+    return image
+
+
+def prepull_images(image_names, logger):
+    # type: (Iterable[str], logging.Logger) -> List[Thread]
+    """Start pulling the named Docker Images in parallel daemon threads, e.g.
+    while the Fireworker sets up logging and connects to its LaunchPad, so
+    its first DockerTasks won't wait for whole image downloads. (A DockerTask
+    that pulls an image that's still downloading joins the Docker daemon's
+    download in progress.) Log errors rather than raising them.
+    Return the threads.
+    """
+    import docker
+
+    def prepull(image_name):
+        try:
+            with PHASE_SECONDS.labels('prepull').time():
+                pull_image(docker.from_env(), image_name, logger)
+        except Exception as e:
+            logger.warning('Failed to pre-pull Docker image %s: %r', image_name, e)
+
+    threads = []
+    for image_name in image_names:
+        thread = Thread(target=prepull, args=(image_name,),
+                        name='prepull-' + image_name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
 def captures(path):
     # type: (str) -> Optional[str]
     """Categorize the given output path as capturing a log (>>), capturing
@@ -56,6 +277,42 @@ def captures(path):
             else None)
 
 
+def _manifest_index(manifests):
+    # type: (List[Dict[str, Any]]) -> Tuple[Dict[Tuple[str, str], list], List[Tuple[str, str]]]
+    """Index push_to_gcs() manifests, returning {(bucket, name): file entry}
+    and a list of the (bucket, path) they cover. Later manifests supersede
+    earlier ones, e.g. from a rerun parent.
+    """
+    files = {}  # type: Dict[Tuple[str, str], list]
+    covered = []  # type: List[Tuple[str, str]]
+
+    for manifest in manifests:
+        bucket = manifest['bucket']
+        covered.append((bucket, manifest['path']))
+        for entry in manifest['files']:
+            files[(bucket, entry[0])] = entry
+
+    return files, covered
+
+
+def _manifest(gcs, mapping, blobs):
+    # type: (st.StorageBackend, PathMapping, Iterable[Any]) -> Dict[str, Any]
+    """Return a push_to_gcs() manifest of the Blobs stored for the mapping."""
+    return {
+        'bucket': gcs.bucket_name,
+        'path': os.path.join(gcs.path_prefix, mapping.sub_path),
+        'files': [[blob.name, blob.size, blob.crc32c, blob.generation,
+                   blob.content_encoding] for blob in blobs]}
+
+
+def archives(path):
+    # type: (str) -> bool
+    """Return True if the given input or output path starts with '@' to
+    transfer a directory tree as one archive object.
+    """
+    return path.startswith('@')
+
+
 @explicit_serialize
 class DockerTask(FiretaskBase):
     """
@@ -72,7 +329,12 @@ class DockerTask(FiretaskBase):
     internal_prefix: the base pathname inside the Docker Container for inputs
       and outputs (files and directory trees).
 
-    storage_prefix: the GCS base pathname for inputs and outputs.
+    storage_prefix: the GCS base pathname for inputs and outputs, e.g.
+      'my-bucket/sim/' or 'gs://my-bucket/sim/'. A 'file://' prefix like
+      'file:///mnt/nfs/sim/' instead names a directory on a local or shared
+      file system, which skips the object store entirely. Append
+      '?hard_links=1' to it to hard-link files rather than copy them where
+      possible, if no task modifies its input or output files in place.
 
     inputs, outputs: absolute pathnames internal to the Docker container of
       input/output files and directories to pull/push to GCS. DockerTask will
@@ -97,7 +359,73 @@ class DockerTask(FiretaskBase):
       of the path is as if internal to the container, and will get rebased to
       to compute its storage path.
 
+      An input or output directory path that starts with '@' transfers the
+      directory tree as one archive object in GCS, named like the directory
+      plus '.tar', e.g. '@/output/frames/' <-> 'output/frames.tar'. That's
+      much faster for trees of many small files since it pays the per-object
+      overhead once. DockerTask packs and unpacks the archive while it
+      transfers.
+
+      If the task gets stopped early (e.g. its GCE VM is being preempted),
+      DockerTask will write all its outputs so far, then raise
+      DockerTaskStopped so the Fireworker can requeue the Firework. It raises
+      that within STOP_DEADLINE_SECONDS even if it's still pushing outputs.
+
     timeout: in seconds, indicates how long to let the task run.
+
+    checkpoint: if true, the task can resume from its partial outputs, so
+      before running the command, DockerTask will pull any of its (non-capture)
+      outputs that already exist in GCS, e.g. from a run that got stopped.
+
+    compress: fnmatch-style filename patterns of output files to gzip on the
+      way to GCS, e.g. ['*.csv', '*.tsv', '*.log', '*.json']. GCS stores them
+      with 'Content-Encoding: gzip' so downloaders get them decompressed. This
+      saves network time and storage costs for text-heavy outputs.
+
+    staging: a dictionary of input or output path -> where to stage that
+      file or directory tree outside the container: 'disk' (the default) for
+      the boot disk, 'tmpfs' for RAM (good for small, hot files), or 'ssd' for
+      a local SSD mounted at /mnt/disks/ssd0 (good for large ones).
+
+    output_bytes: a dictionary of output path -> estimated size in bytes.
+      Before pulling inputs, DockerTask checks that each staging file system
+      has enough free space for the inputs plus these estimates, so the task
+      fails fast with a clear error rather than filling the disk partway
+      through. It counts a gzipped input at its uncompressed size, which the
+      upload recorded, or else 10x its stored size (storage.GZIP_EXPANSION).
+
+    manifest: if true, write a manifest object next to each output directory
+      tree, e.g. 'out/frames.manifest.json' for 'out/frames/', listing its
+      files' names, sizes, and generations; and pull input trees via their
+      manifests when they have them. That skips listing big trees.
+
+      This also returns a manifest of each pushed output in the FWAction
+      that updates the child Fireworks' specs, so child DockerTasks pull
+      exactly those file generations without listing them in GCS.
+
+    cpus, memory_gb: the number of CPUs and GiB of RAM the task needs. A
+      Fireworker only checks out a Firework if its machine has at least that
+      many CPUs and that much total memory. See resource_query(). To keep
+      small tasks off big machines, put the Firework in a worker pool's
+      category (its spec `_category`).
+
+    memoize: if true, reuse the outputs of a past successful run when the
+      task's Docker image digest, `command`, and input file contents all
+      match, skipping the image pull, input download, and container run.
+      DockerTask copies the recorded outputs to this task's outputs within
+      GCS (without downloading them) and writes only its '>>' logs. It keeps
+      the memo records in the storage bucket's 'borealis-memo/' directory,
+      or a string `memoize` names the storage prefix to keep them in (which a
+      'file://' storage_prefix needs). See memo_key().
+
+    lazy: input paths (as given in `inputs`) to mount read-only rather than
+      download, so the container starts without waiting for them and reads
+      just the file data it uses. For GCS, this mounts the input's directory
+      via gcsfuse, which must be installed on the worker with
+      'user_allow_other' in /etc/fuse.conf (unless the Fireworker runs as
+      root). gcsfuse reads gzipped objects as stored, so don't `compress`
+      them. For a 'file://' storage_prefix, this binds the stored files. An
+      input archive ('@') can't be lazy.
     """
 
     _fw_name = 'DockerTask'
@@ -112,50 +440,74 @@ class DockerTask(FiretaskBase):
     optional_params = [
         'inputs',
         'outputs',
-        'timeout']
+        'timeout',
+        'checkpoint',
+        'compress',
+        'staging',
+        'output_bytes',
+        'manifest',
+        'cpus',
+        'memory_gb',
+        'memoize',
+        'lazy']
 
     LOCAL_BASEDIR = os.path.join(os.sep, 'tmp', 'fireworker')
 
+    #: Staging choice -> local base directory for inputs and outputs.
+    STAGING_DIRS = {
+        'disk': LOCAL_BASEDIR,
+        'tmpfs': os.path.join(os.sep, 'dev', 'shm', 'fireworker'),
+        'ssd': os.path.join(os.sep, 'mnt', 'disks', 'ssd0', 'fireworker')}
+
+    #: The base directory for gcsfuse mount points of `lazy` inputs. It's
+    #: outside STAGING_DIRS so wiping those won't reach into a mounted bucket.
+    LAZY_MOUNT_DIR = os.path.join(os.sep, 'tmp', 'fireworker-lazy')
+
+    #: Free space to leave on each staging file system, in bytes.
+    RESERVED_SPACE = 64 * 1024 * 1024
+
     def _log(self):
         # type: () -> logging.Logger
         """Return a Logger for this task."""
         parent = logging.getLogger('dockerfiretask')
-        parent.setLevel(logging.DEBUG)
+        if parent.level == logging.NOTSET:  # else fireworker set its level
+            parent.setLevel(logging.DEBUG)
 
         name = 'dockerfiretask.{}'.format(self['name'])
         return logging.getLogger(name)
 
+    @contextmanager
+    def _phase(self, phase):
+        # type: (str) -> Iterator[None]
+        """A context manager that measures a run_task() phase: 'memo',
+        'pull', 'download', or 'upload', and profiles it if the Fireworker is profiling
+        rockets.
+        """
+        with PHASE_SECONDS.labels(phase).time(), profiling.phase(phase):
+            yield
+
     def pull_docker_image(self, docker_client):
         # type: (docker.DockerClient) -> Any  # a Docker Image
-        """Pull the requested Docker Image. Ensure there's a tag so pull() will
-        get one Image rather than all tags in a repository.
-        """
-        repository, tag = parse_repository_tag(self['image'])
-        if not tag:
-            tag = 'latest'  # 'latest' is the default tag; it doesn't mean squat
-        self._log().info('Pulling Docker image %s:%s', repository, tag)
-        try:
-            image = docker_client.images.pull(repository, tag)
-            self._log().debug('Pulled Docker image %s', image.id)
-        except requests.ConnectionError as e:
-            raise DockerTaskError(
-                "Couldn't connect to the Docker server. You might need to"
-                " install one or start it. {!r}".format(e))
-        return image
+        """Pull the requested Docker Image. See pull_image()."""
+        return pull_image(docker_client, self['image'], self._log())
 
     def rebase(self, internal_path, new_prefix):
         # type: (str, str) -> str
-        """Strip off any '>' or '>>' prefix then rebase the internal-to-container
-        path from the internal_prefix to new_prefix.
+        """Strip off any '>', '>>', or '@' prefix then rebase the
+        internal-to-container path from the internal_prefix to new_prefix.
 
         '>' or '>>' means capture stdout + stderr rather than fetching a
         container file; the rest of internal_path is the as-if-internal path.
         '>>' creates a log of stdout + stderr + additional information and
         writes it even if the Docker command fails.
 
+        '@' means transfer a directory as one archive object.
+
         A path ending with '/' indicates a directory.
         """
-        core_path = internal_path.lstrip('>')
+        import borealis.util.storage as st
+
+        core_path = internal_path.lstrip('>@')
         internal_prefix = self['internal_prefix']
         rel_path = st.relpath(core_path, internal_prefix)
         new_path = os.path.join(new_prefix, rel_path)
@@ -177,8 +529,22 @@ class DockerTask(FiretaskBase):
 
         Timestamp log filenames to preserve the run history and improve alpha
         sorting.
+
+        An archive mapping's sub_path names the archive object.
         """
+        from docker.types import Mount
+        import borealis.util.storage as st
+
+        path = internal_path
         caps = captures(internal_path)
+        archive = archives(internal_path)
+
+        if archive:
+            if not st.names_a_directory(internal_path):
+                raise DockerTaskError(
+                    'An archive path must name a directory, not a file: "{}"'
+                        .format(internal_path))
+            internal_path = internal_path[1:]
 
         if caps:
             sub_dir, filename = os.path.split(internal_path)
@@ -192,6 +558,8 @@ class DockerTask(FiretaskBase):
 
         local_path = self.rebase(internal_path, local_prefix)
         sub_path = self.rebase(internal_path, '')
+        if archive:
+            sub_path = st.archive_name(sub_path)
 
         fp.makedirs(os.path.dirname(local_path))
         if not st.names_a_directory(local_path):
@@ -201,20 +569,109 @@ class DockerTask(FiretaskBase):
         mount = (None if caps
                  else Mount(target=internal_path, source=local_path, type='bind'))
 
-        return PathMapping(caps, local_prefix, local_path, sub_path, mount)
+        return PathMapping(
+            caps, archive, local_prefix, local_path, sub_path, mount, path)
+
+    def staging_dir(self, path):
+        # type: (str) -> str
+        """Return the local base directory to stage the input or output path
+        per the `staging` parameter.
+        """
+        choice = self.get('staging', {}).get(path, 'disk')
+        base_dir = self.STAGING_DIRS.get(choice)
+
+        if base_dir is None:
+            raise DockerTaskError('Unknown staging "{}" for "{}"; expected one of {}'
+                .format(choice, path, sorted(self.STAGING_DIRS)))
+        if not os.path.isdir(os.path.dirname(base_dir)):
+            raise DockerTaskError(
+                'Staging "{}" for "{}" needs {} but this machine lacks it'
+                    .format(choice, path, os.path.dirname(base_dir)))
+        return base_dir
 
     def setup_mounts(self, group):
         # type: (str) -> List[PathMapping]
         """Set up all the mounts for the 'inputs' or 'outputs' group."""
-        group_base_dir = os.path.join(self.LOCAL_BASEDIR, group)
-        return [self.setup_mount(path, group_base_dir)
+        return [self.setup_mount(path, os.path.join(self.staging_dir(path), group))
                 for path in self.get(group, [])]
 
+    def list_inputs(self, ins, fw_spec=None):
+        # type: (List[PathMapping], Optional[dict]) -> List[List[st.Blob]]
+        """List the GCS Blobs to pull for each input mapping, using the parent
+        tasks' output manifests in fw_spec where they cover the input, else
+        listing them in GCS.
+        """
+        import borealis.util.storage as st
+
+        gcs = st.open_storage(self['storage_prefix'])
+        use_manifest = bool(self.get('manifest'))
+        files, covered = _manifest_index((fw_spec or {}).get(MANIFESTS_KEY, []))
+        listings = []
+
+        for mapping in ins:
+            name = os.path.join(gcs.path_prefix, mapping.sub_path)
+            blobs = None
+
+            if any(bucket == gcs.bucket_name and (name == path or (
+                    st.names_a_directory(path) and name.startswith(path)))
+                   for bucket, path in covered):
+                if st.names_a_directory(name):
+                    entries = [entry for (bucket, path), entry in files.items()
+                               if bucket == gcs.bucket_name and path.startswith(name)]
+                else:
+                    entry = files.get((gcs.bucket_name, name))
+                    entries = [entry] if entry else None
+
+                if entries is not None:
+                    blobs = [gcs.pinned_blob(blob_name, size, generation, crc32c,
+                                             encoding)
+                             for blob_name, size, crc32c, generation, encoding
+                             in entries]
+
+            if blobs is None:
+                blobs = gcs.list_files(mapping.sub_path, use_manifest)
+            listings.append(blobs)
+
+        return listings
+
+    def check_free_space(self, ins, outs, listings):
+        # type: (List[PathMapping], List[PathMapping], List[List[st.Blob]]) -> None
+        """Raise DockerTaskError if any staging file system lacks the free space
+        for its inputs (per the list_inputs() `listings`, counting gzipped
+        inputs at their decompressed sizes via st.local_size()) plus the
+        `output_bytes` estimates.
+        """
+        import borealis.util.storage as st
+
+        needed = {}  # type: Dict[int, int]
+        dirs = {}  # type: Dict[int, str]
+
+        def need(mapping, size):
+            device = os.stat(mapping.local_prefix).st_dev
+            needed[device] = needed.get(device, 0) + size
+            dirs[device] = mapping.local_prefix
+
+        for mapping, blobs in zip(ins, listings):
+            need(mapping, sum(st.local_size(blob) for blob in blobs))
+
+        estimates = self.get('output_bytes', {})
+        for path, mapping in zip(self.get('outputs', []), outs):
+            need(mapping, estimates.get(path, 0))
+
+        for device, size in needed.items():
+            stats = os.statvfs(dirs[device])
+            free = stats.f_bavail * stats.f_frsize - self.RESERVED_SPACE
+            if size > free:
+                raise DockerTaskError(
+                    'Not enough space to stage the task in {}: it needs {:,} MB'
+                    ' but there are {:,} MB free'.format(
+                        dirs[device], size // 2**20, max(free, 0) // 2**20))
+
     def _outputs_to_push(self, lines, success, outs, prologue, epilogue):
         # type: (List[str], bool, List[PathMapping], str, str) -> List[PathMapping]
         """Write requested stdout+stderr and log output files, then return a
         list of output PathMappings to push to GCS: all of them if the Task
-        succeeded; only the '>>' logs if it failed.
+        succeeded or got stopped early; only the '>>' logs if it failed.
         """
         to_push = []
 
@@ -239,39 +696,420 @@ class DockerTask(FiretaskBase):
 
         return to_push
 
-    def push_to_gcs(self, to_push):
-        # type: (List[PathMapping]) -> bool
-        """Push outputs to GCS. Return True if successful."""
+    def _report_retries(self, gcs, activity):
+        # type: (st.StorageBackend, str) -> None
+        """Log the storage backend's retry counts, if any, to show how degraded
+        storage access is.
+        """
+        if gcs.stats:
+            self._log().warning('GCS retries while %s: %s', activity, gcs.stats.counts)
+
+    def push_to_gcs(self, to_push, manifests=None):
+        # type: (List[PathMapping], Optional[List[Dict[str, Any]]]) -> bool
+        """Push outputs to GCS. If `manifests` is a list, append a compact
+        manifest of each pushed output mapping to it:
+            {'bucket': bucket, 'path': blob path of the file or tree,
+             'files': [[blob name, size, crc32c, generation, encoding], ...]}
+        Return True if successful.
+
+        If there's an input cache (see use_input_cache()), also add the pushed
+        (non-capture, non-archive) output files to it so a following task on
+        this worker that inputs them copies them locally rather than
+        downloading them, and note them for locality_queries().
+        """
+        import borealis.util.storage as st
+
         ok = True
         prefix = self['storage_prefix']
+        cache = None if prefix.startswith(st.FILE_SCHEME) else _input_cache
+        cached_paths = []  # type: List[str]
 
         self._log().info('Pushing %s outputs to GCS %s: %s',
             len(to_push), prefix, [mapping.sub_path for mapping in to_push])
-        gcs = st.CloudStorage(prefix)
+        gcs = st.open_storage(prefix)
+        compress = self.get('compress', [])
+        manifest = bool(self.get('manifest'))
 
         for mapping in to_push:
-           ok = gcs.upload_tree(mapping.local, mapping.sub_path) and ok
-
+            uploaded = []  # type: List[st.Blob]
+            if mapping.archive:
+                ok = gcs.upload_archive(
+                    mapping.local, mapping.sub_path, uploaded) and ok
+            else:
+                ok = gcs.upload_tree(mapping.local, mapping.sub_path, compress,
+                                     manifest, uploaded) and ok
+
+            if manifests is not None:
+                manifests.append(_manifest(gcs, mapping, uploaded))
+
+            if cache and uploaded and not (mapping.captures or mapping.archive):
+                cache.store_tree(gcs, uploaded, mapping.local_prefix)
+                cached_paths.append(mapping.path)
+
+        if cached_paths:
+            _note_warm_inputs(prefix, self['internal_prefix'], cached_paths)
+        self._report_retries(gcs, 'pushing outputs')
         return ok
 
-    def pull_from_gcs(self, to_pull):
-        # type: (List[PathMapping]) -> bool
-        """Pull inputs from GCS. Return True if successful."""
+    def push_by_deadline(self, to_push, seconds):
+        # type: (List[PathMapping], float) -> Optional[bool]
+        """Push outputs like push_to_gcs() in a daemon thread but wait at most
+        `seconds` for it. Return True if it finished successfully, False if it
+        failed, or None if it's still pushing (which keeps going in the
+        background, e.g. until the preempted VM shuts down).
+        """
+        result = []  # type: List[bool]
+        thread = Thread(target=lambda: result.append(self.push_to_gcs(to_push)),
+                        name='push-' + self['name'])
+        thread.daemon = True
+        thread.start()
+        thread.join(max(seconds, 0))
+
+        if thread.is_alive():
+            self._log().warning(
+                'Still pushing outputs at the stop deadline; continuing in the'
+                ' background')
+            return None
+        return bool(result and result[0])
+
+    def pull_from_gcs(self, to_pull, listings):
+        # type: (List[PathMapping], List[List[st.Blob]]) -> bool
+        """Pull inputs from GCS given their list_inputs() `listings`. Return
+        True if successful.
+
+        If there's an input cache (see use_input_cache()), copy the files it
+        has from it and add the downloaded files to it.
+        """
+        import borealis.util.storage as st
+
         ok = True
         prefix = self['storage_prefix']
+        cache = None if prefix.startswith(st.FILE_SCHEME) else _input_cache
+        cached_paths = []  # type: List[str]
 
         self._log().info('Pulling %s inputs from GCS %s: %s',
             len(to_pull), prefix, [mapping.sub_path for mapping in to_pull])
-        gcs = st.CloudStorage(prefix)
+        gcs = st.open_storage(prefix)
+
+        for mapping, blobs in zip(to_pull, listings):
+            if mapping.archive:
+                ok = gcs.download_archive(mapping.sub_path, mapping.local) and ok
+            elif cache:
+                blobs = list(blobs)
+                missing = cache.fetch_tree(gcs, blobs, mapping.local_prefix)
+                if missing or not blobs:
+                    pulled = gcs.download_tree(
+                        mapping.sub_path, mapping.local_prefix, missing)
+                    if pulled:
+                        cache.store_tree(gcs, missing, mapping.local_prefix)
+                    ok = pulled and ok
+                cached_paths.append(mapping.path)
+            else:
+                ok = gcs.download_tree(
+                    mapping.sub_path, mapping.local_prefix, blobs) and ok
+
+        if ok and cached_paths:
+            _note_warm_inputs(prefix, self['internal_prefix'], cached_paths)
+        self._report_retries(gcs, 'pulling inputs')
+        return ok
 
-        for mapping in to_pull:
-            ok = gcs.download_tree(mapping.sub_path, mapping.local_prefix) and ok
+    def split_lazy(self, ins, listings):
+        # type: (List[PathMapping], List[List[st.Blob]]) -> Tuple[List[PathMapping], List[List[st.Blob]], List[PathMapping]]
+        """Split the input mappings into the ones to pull, with their
+        list_inputs() `listings`, and the `lazy` ones to mount.
+        """
+        lazy = set(self.get('lazy', []))
+        eager = [(mapping, blobs) for mapping, blobs in zip(ins, listings)
+                 if mapping.path not in lazy]
+        return ([mapping for mapping, _ in eager],
+                [blobs for _, blobs in eager],
+                [mapping for mapping in ins if mapping.path in lazy])
+
+    def mount_lazy_inputs(self, lazy_ins, fuse_dirs):
+        # type: (List[PathMapping], List[str]) -> List[PathMapping]
+        """Make the `lazy` input mappings available without downloading them
+        and return them with Docker Mounts that bind them read-only. For a
+        'file://' storage_prefix, that binds the stored files. For GCS, it
+        mounts their directory via gcsfuse, which fetches file data when the
+        task reads it, and appends the mount point to fuse_dirs for
+        unmount_lazy_inputs().
+        """
+        from docker.types import Mount
+        import borealis.util.storage as st
+
+        prefix = self['storage_prefix']
+        gcs = st.open_storage(prefix)
+        mounted = []
+
+        for mapping in lazy_ins:
+            if mapping.archive:
+                raise DockerTaskError(
+                    'A lazy input must be a file or directory, not an archive: "{}"'
+                        .format(mapping.path))
+
+            name = os.path.join(gcs.path_prefix, mapping.sub_path)
+            if prefix.startswith(st.FILE_SCHEME):
+                source = os.path.join(gcs.bucket_name, name)
+            else:
+                is_tree = st.names_a_directory(name)
+                only_dir = name.rstrip('/') if is_tree else os.path.dirname(name)
+                mount_point = fp.makedirs(self.LAZY_MOUNT_DIR, str(len(fuse_dirs)))
+                tokens = (['gcsfuse'] + list(GCSFUSE_ARGS)
+                          + (['--only-dir', only_dir] if only_dir else [])
+                          + [gcs.bucket_name, mount_point])
+
+                self._log().info('Mounting lazy input %s: %s', mapping.path, tokens)
+                try:
+                    fp.run_cmd(tokens)
+                except Exception as e:
+                    raise DockerTaskError(
+                        "Couldn't mount the lazy input \"{}\" via gcsfuse. You"
+                        " might need to install it. {!r}".format(mapping.path, e))
+                fuse_dirs.append(mount_point)
+                source = (mount_point if is_tree
+                          else os.path.join(mount_point, os.path.basename(name)))
+
+            mount = Mount(target=mapping.mount['Target'], source=source,
+                          type='bind', read_only=True)
+            mounted.append(mapping._replace(mount=mount))
+
+        return mounted
+
+    def unmount_lazy_inputs(self, fuse_dirs):
+        # type: (List[str]) -> None
+        """Unmount and remove the gcsfuse mount points of `lazy` inputs."""
+        for mount_point in fuse_dirs:
+            try:
+                fp.run_cmd(['fusermount', '-u', mount_point])
+                os.rmdir(mount_point)
+            except Exception as e:
+                self._log().warning(
+                    "Couldn't unmount the lazy input at %s: %r", mount_point, e)
 
+    def pull_checkpoints(self, outs):
+        # type: (List[PathMapping]) -> bool
+        """If the `checkpoint` parameter is set, pull any (non-capture) outputs
+        that already exist in GCS so the task can resume from them. Return
+        True if successful.
+        """
+        import borealis.util.storage as st
+
+        to_pull = [mapping for mapping in outs if not mapping.captures]
+        if not self.get('checkpoint') or not to_pull:
+            return True
+
+        ok = True
+        prefix = self['storage_prefix']
+
+        self._log().info('Pulling checkpoint outputs from GCS %s: %s',
+            prefix, [mapping.sub_path for mapping in to_pull])
+        gcs = st.open_storage(prefix)
+
+        for mapping in to_pull:
+            is_tree = st.names_a_directory(mapping.sub_path)
+            for blob in gcs.list_blobs(mapping.sub_path):
+                rel_path = st.relpath(blob.name, gcs.path_prefix)
+                if mapping.archive and rel_path == mapping.sub_path:
+                    ok = gcs.download_archive(rel_path, mapping.local) and ok
+                elif is_tree or rel_path == mapping.sub_path:
+                    local_path = os.path.join(mapping.local_prefix, rel_path)
+                    ok = gcs.download_blob(blob, local_path) and ok
+
+        self._report_retries(gcs, 'pulling checkpoints')
         return ok
 
-    def _terminate(self, container, logger, reason, terminated):
-        # type: (Container, logging.Logger, str, Event) -> None
-        """Terminate the Docker Container's process.
+    def memo_storage(self):
+        # type: () -> st.StorageBackend
+        """Return the storage backend for the `memoize` records."""
+        import borealis.util.storage as st
+
+        memoize = self['memoize']
+        if memoize is not True:
+            return st.open_storage(memoize)
+
+        prefix = self['storage_prefix']
+        if prefix.startswith(st.FILE_SCHEME):
+            raise DockerTaskError(
+                'memoize needs a storage prefix for its records when the'
+                ' storage_prefix is "{}"'.format(prefix))
+        bucket_name = st.open_storage(prefix).bucket_name
+        return st.open_storage(st.GCS_SCHEME + os.path.join(bucket_name, MEMO_DIR))
+
+    def memo_key(self, docker_client, ins, listings, checkpoints=(),
+                 checkpoint_listings=()):
+        # type: (docker.DockerClient, List[PathMapping], List[List[st.Blob]], Iterable[PathMapping], Iterable[List[st.Blob]]) -> Optional[str]
+        """Return the task's memo key: a hash of its Docker image's registry
+        digest, its `command`, `internal_prefix`, and `outputs`, and the names,
+        sizes, and CRC32C checksums of its input files per the list_inputs()
+        `listings` and of the existing `checkpoint` outputs that the task
+        would resume from per their `checkpoint_listings`. Using checksums
+        rather than generations lets the key match when a parent task rewrote
+        or copied identical inputs.
+
+        Return None if it can't get the image digest, e.g. for a local image.
+        """
+        from docker import errors as docker_errors
+        from docker.utils import parse_repository_tag
+        import borealis.util.storage as st
+
+        image_name = self['image']
+        if '@' not in image_name:
+            repository, tag = parse_repository_tag(image_name)
+            image_name = '{}:{}'.format(repository, tag or 'latest')
+        try:
+            digest = docker_client.images.get_registry_data(image_name).id
+        except docker_errors.APIError as e:
+            self._log().warning(
+                "Can't memoize without the registry digest of %s: %r", image_name, e)
+            return None
+
+        gcs = st.open_storage(self['storage_prefix'])
+
+        def contents(mappings, mapping_listings):
+            result = []
+            for mapping, blobs in zip(mappings, mapping_listings):
+                base = os.path.join(gcs.path_prefix, mapping.sub_path)
+                files = sorted(
+                    ['' if blob.name == base else st.relpath(blob.name, base),
+                     int(blob.size or 0),
+                     blob.crc32c or 'generation {}'.format(blob.generation)]
+                    for blob in blobs if not st.names_a_directory(blob.name))
+                result.append([mapping.path, files])
+            return result
+
+        fingerprint = {
+            'version': MEMO_VERSION,
+            'image': digest,
+            'command': self['command'],
+            'internal_prefix': self['internal_prefix'],
+            'inputs': contents(ins, listings),
+            'outputs': self.get('outputs', [])}
+        if self.get('checkpoint'):
+            fingerprint['checkpoints'] = contents(checkpoints, checkpoint_listings)
+        text = json.dumps(fingerprint, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def lookup_memo(self, docker_client, fw_spec):
+        # type: (docker.DockerClient, dict) -> Memo
+        """List the inputs (and any `checkpoint` outputs), compute the memo
+        key, and look up the memo record of a past successful run with that
+        key.
+        """
+        import borealis.util.storage as st
+
+        ins = self.setup_mounts('inputs')
+        listings = self.list_inputs(ins, fw_spec)
+        checkpoints = []  # type: List[PathMapping]
+        checkpoint_listings = []  # type: List[List[st.Blob]]
+
+        if self.get('checkpoint'):
+            gcs = st.open_storage(self['storage_prefix'])
+            checkpoints = [mapping for mapping in self.setup_mounts('outputs')
+                           if not mapping.captures]
+            checkpoint_listings = [gcs.list_files(mapping.sub_path)
+                                   for mapping in checkpoints]
+
+        key = self.memo_key(
+            docker_client, ins, listings, checkpoints, checkpoint_listings)
+        record = None
+
+        if key:
+            text = self.memo_storage().read_text(key + '.json')
+            try:
+                record = json.loads(text) if text else None
+            except ValueError as e:
+                self._log().warning('Ignoring the unreadable memo %s: %r', key, e)
+
+        return Memo(key, record, listings)
+
+    def reuse_memo(self, memo, manifests, prologue):
+        # type: (Memo, Optional[List[Dict[str, Any]]], str) -> bool
+        """Copy the outputs that the memo record lists to this task's
+        (non-capture) outputs within storage and write the '>>' logs. If
+        `manifests` is a list, append a push_to_gcs() manifest of each copied
+        output to it. Return True if successful, else the task should run.
+        """
+        import borealis.util.storage as st
+
+        record = memo.record
+        gcs = st.open_storage(self['storage_prefix'])
+        if record.get('version') != MEMO_VERSION or record.get('bucket') != gcs.bucket_name:
+            return False
+
+        recorded = {output['path']: output for output in record.get('outputs', [])}
+        copied = []  # type: List[Dict[str, Any]]
+        outs = self.setup_mounts('outputs')
+
+        for mapping in outs:
+            if mapping.captures == '>>':
+                continue
+
+            output = recorded.get(mapping.path)
+            if output is None:
+                return False
+
+            blobs = []
+            base = output['base']
+            for name, size, crc32c, generation, encoding in output['files']:
+                sub_path = (mapping.sub_path if name == base
+                            else os.path.join(mapping.sub_path, st.relpath(name, base)))
+                blob = gcs.copy_blob(
+                    gcs.pinned_blob(name, size, generation, crc32c, encoding),
+                    sub_path)
+                if blob is None:
+                    return False
+                blobs.append(blob)
+            copied.append(_manifest(gcs, mapping, blobs))
+        self._report_retries(gcs, 'copying memoized outputs')
+
+        message = 'Reused the outputs of task {} from {} (memo {})\n'.format(
+            record.get('task'), record.get('timestamp'), memo.key)
+        logs = self._outputs_to_push(
+            [message], False, outs, prologue,
+            'MEMOIZED task: {}'.format(self['name']))
+        if not self.push_to_gcs(logs):
+            return False
+
+        if manifests is not None:
+            manifests.extend(copied)
+        return True
+
+    def record_memo(self, key, pushed, manifests):
+        # type: (str, List[PathMapping], List[Dict[str, Any]]) -> None
+        """Record this successful run's outputs per push_to_gcs()'s `pushed`
+        mappings and their `manifests` under the memo key.
+        """
+        import borealis.util.storage as st
+
+        outputs = [
+            {'path': mapping.path, 'base': manifest['path'],
+             'files': manifest['files']}
+            for mapping, manifest in zip(pushed, manifests)
+            if mapping.captures != '>>']
+        record = {
+            'version': MEMO_VERSION,
+            'task': self['name'],
+            'timestamp': data.timestamp(),
+            'image': self['image'],
+            'bucket': st.open_storage(self['storage_prefix']).bucket_name,
+            'outputs': outputs}
+
+        if self.memo_storage().write_text(
+                key + '.json', json.dumps(record), 'application/json'):
+            self._log().info('Recorded memo %s', key)
+
+    def wipe_staging(self):
+        # type: () -> None
+        """Wipe the local staging directories."""
+        # [Could wipe just the 'inputs' subdirectories to keep the outputs
+        # for local scrutiny.]
+        for wipe_out in self.STAGING_DIRS.values():
+            shutil.rmtree(wipe_out, ignore_errors=True)
+
+    def _terminate(self, container, logger, reason, terminated, grace=None):
+        # type: (Container, logging.Logger, str, Event, Optional[float]) -> None
+        """Terminate the Docker Container's process, waiting up to `grace`
+        seconds (default 10) after SIGTERM before SIGKILL.
 
         This runs in a Timer thread so be careful about mutable state: Signal
         that termination happened using an Event object and cope if the
@@ -281,11 +1119,13 @@ class DockerTask(FiretaskBase):
         NOTE: "The KeyboardInterrupt exception will be received by an arbitrary
         thread." -- https://docs.python.org/3.8/library/_thread.html
         """
+        from docker import errors as docker_errors
+
         name = self['name']
         logger.info('Terminating task {} for {}...'.format(name, reason))
 
         try:
-            container.stop()
+            container.stop(timeout=grace)
             terminated.set()
             logger.warning('Terminated task {} for {}'.format(name, reason))
         except docker_errors.APIError as e:
@@ -325,14 +1165,20 @@ class DockerTask(FiretaskBase):
     def run_task(self, fw_spec):
         # type: (dict) -> Optional[FWAction]
         """Run a task as a shell command in a Docker container."""
+        import docker
+        from docker import errors as docker_errors
+
         start_timestamp = data.timestamp()
         name = self['name']
         errors = []  # type: List[str]
+        memoize = bool(self.get('memoize'))
+        manifests = [] if self.get('manifest') or memoize else None
         lines = []  # type: List[str]
         image = None
         timeout = self.get('timeout', self.DEFAULT_TIMEOUT_SECONDS)
         elapsed = '---'
         logger = self._log()
+        stopped = Event()
 
         def check(success, or_error):
             if not success:
@@ -349,7 +1195,8 @@ class DockerTask(FiretaskBase):
 
         def epilogue():
             return '{} task: {}, elapsed {} of timeout parameter {} {}'.format(
-                'FAILED' if errors else 'SUCCESSFUL',
+                'STOPPED' if stopped.is_set()
+                else 'FAILED' if errors else 'SUCCESSFUL',
                 name,
                 elapsed,
                 data.format_duration(timeout),
@@ -357,14 +1204,47 @@ class DockerTask(FiretaskBase):
 
         logger.warning('STARTING TASK: %s', name)
 
+        reason = _set_stop_callback(None)
+        if reason:
+            stopped.set()
+            raise DockerTaskStopped('Not starting task {} due to {}'.format(
+                name, reason))
+
+        profiling.set_destination(self['storage_prefix'], name)
+
+        memo = Memo(None, None, None)
+        memoized = False
+        fuse_dirs = []  # type: List[str]
+        stop_times = []  # type: List[float]
+        pushing = False  # still pushing outputs in the background
+
         try:
             docker_client = docker.from_env()
-            image = self.pull_docker_image(docker_client)
+            if memoize:
+                with self._phase('memo'):
+                    memo = self.lookup_memo(docker_client, fw_spec)
+                    memoized = memo.record is not None and self.reuse_memo(
+                        memo, manifests, prologue())
+                if memoized:
+                    logger.warning('MEMOIZED TASK: %s (memo %s)', name, memo.key)
+                    return self._manifests_action(manifests)
+
+            with self._phase('pull'):
+                image = self.pull_docker_image(docker_client)
 
             ins = self.setup_mounts('inputs')
             outs = self.setup_mounts('outputs')
 
-            check(self.pull_from_gcs(ins), 'Failed to fetch inputs from GCS')
+            with self._phase('download'):
+                listings = memo.listings or self.list_inputs(ins, fw_spec)
+                to_pull, pull_listings, lazy_ins = self.split_lazy(ins, listings)
+                self.check_free_space(to_pull, outs, pull_listings)
+
+                check(self.pull_from_gcs(to_pull, pull_listings),
+                      'Failed to fetch inputs from GCS')
+                check(self.pull_checkpoints(outs),
+                      'Failed to fetch checkpoint outputs from GCS')
+                ins = to_pull + self.mount_lazy_inputs(lazy_ins, fuse_dirs)
 
             # -----------------------------------------------------
             logger.info('Running: %s', self['command'])
@@ -383,20 +1263,33 @@ class DockerTask(FiretaskBase):
                 timer = Timer(timeout, self._terminate, args=args)
                 timer.start()
 
+                def stop(reason):
+                    stop_times.append(seconds_clock())
+                    self._terminate(container, logger, reason, stopped,
+                                    STOP_GRACE_SECONDS)
+
                 try:
-                    for line in container.logs(stream=True):
-                        line = line.decode()
-                        lines.append(line)
-                        logger.info('%s', line.rstrip())
+                    reason = _set_stop_callback(stop)
+                    if reason:
+                        stop(reason)
+
+                    with profiling.phase('run'):
+                        for line in container.logs(stream=True):
+                            line = line.decode()
+                            lines.append(line)
+                            logger.info('%s', line.rstrip())
                 finally:
+                    _set_stop_callback(None)
                     timer.cancel()
 
                 end_seconds = seconds_clock()
                 exit_code = container.wait(timeout=10)['StatusCode']
                 elapsed = data.format_duration(end_seconds - start_secs)
+                PHASE_SECONDS.labels('run').observe(end_seconds - start_secs)
                 # -----------------------------------------------------
 
                 check(not terminated.is_set(), 'Docker process timeout')
+                check(not stopped.is_set(), 'Docker process stopped early')
                 check(exit_code == 0, 'Docker process exit code {}{}'.format(
                     exit_code, ' (SIGKILL)' if exit_code == 137 else ''))
                 container.reload()  # query the Docker daemon for current attrs
@@ -411,12 +1304,26 @@ class DockerTask(FiretaskBase):
                     logger.exception('Error removing the Docker Container')
 
             to_push = self._outputs_to_push(
-                lines, not errors, outs, prologue(), epilogue())
+                lines, not errors or stopped.is_set(), outs, prologue(),
+                epilogue())
 
             # NOTE: The >>task.log file won't report push failures since it's
             # written before pushing and might itself fail to push. But the
             # StackDriver log will get it.
-            check(self.push_to_gcs(to_push), 'Failed to store outputs to GCS')
+            with self._phase('upload'):
+                if stop_times:
+                    pushed = self.push_by_deadline(
+                        to_push,
+                        stop_times[0] + STOP_DEADLINE_SECONDS - seconds_clock())
+                    pushing = pushed is None
+                    check(bool(pushed),
+                          'Failed to store outputs to GCS by the stop deadline')
+                else:
+                    check(self.push_to_gcs(to_push, manifests),
+                          'Failed to store outputs to GCS')
+
+            if memo.key and not errors and not stopped.is_set():
+                self.record_memo(memo.key, to_push, manifests)
 
         except (Exception, KeyboardInterrupt) as e:
             # Log it, clean up, and re-raise it. That'll FIZZLE the Firework.
@@ -424,13 +1331,27 @@ class DockerTask(FiretaskBase):
             raise
         finally:
             logger.warning('%s', epilogue())
+            TASKS.labels('stopped' if stopped.is_set()
+                         else 'failed' if errors
+                         else 'memoized' if memoized else 'succeeded').inc()
 
-            # [Could wipe just os.path.join(self.LOCAL_BASEDIR, 'inputs') to
-            # keep the outputs for local scrutiny.]
-            wipe_out = self.LOCAL_BASEDIR
-            shutil.rmtree(wipe_out, ignore_errors=True)
+            self.unmount_lazy_inputs(fuse_dirs)
+            if not pushing:  # no later task will run after a stop request
+                self.wipe_staging()
 
+        if stopped.is_set():
+            raise DockerTaskStopped(repr(errors))  # FIZZLE it to requeue it.
         if errors:
             raise DockerTaskError(repr(errors))  # FIZZLE this Firework.
 
+        return self._manifests_action(manifests)
+
+    def _manifests_action(self, manifests):
+        # type: (Optional[List[Dict[str, Any]]]) -> Optional[FWAction]
+        """Return an FWAction that passes the output manifests to the child
+        Fireworks if the `manifest` parameter is set, else None.
+        """
+        if manifests and self.get('manifest'):
+            # Append rather than set so a child of several parents gets them all.
+            return FWAction(mod_spec=[{'_push_all': {MANIFESTS_KEY: manifests}}])
         return None
@@ -18,20 +18,23 @@ from __future__ import absolute_import, division, print_function
 
 import argparse
 import logging
+import multiprocessing
 import os
 import socket
 import sys
+from threading import Event
 import time
-from typing import Any, Dict, Optional
-
-from fireworks import LaunchPad, FWorker, fw_config
-from fireworks.core import rocket_launcher
-import google.cloud.logging as gcl
-from google.cloud.logging.resource import Resource
-import ruamel.yaml as yaml
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+# NOTE: This module imports FireWorks, google-cloud-logging, ruamel.yaml, and
+# DockerTask (with Docker and google-cloud-storage) only where it needs them,
+# so `fireworker --setup` and other quick commands start fast. See
+# benchmarks/import_time.py.
 from borealis.util import gcp
-from borealis.util.log_filter import LogPrefixFilter
+from borealis.util import metrics
+from borealis.util import profiling
+from borealis.util.log_filter import LogPrefixFilter, apply_logger_levels
+from borealis.util.log_shipping import BatchingCloudHandler
 
 #: The default launchpad config filename (in CWD) to read.
 #: GCE instance metadata will override some field values.
@@ -40,6 +43,29 @@ DEFAULT_FIREWORKS_DATABASE = 'default_fireworks_database'
 DEFAULT_IDLE_FOR_WAITERS = 60 * 60  # seconds
 DEFAULT_IDLE_FOR_ROCKETS = 15 * 60  # seconds
 
+#: Seconds to wait for the last log entries to ship before shutting down.
+LOG_FLUSH_DEADLINE = 10
+
+#: Fireworker metrics. See the `metrics_port` setting in main().
+ROCKETS = metrics.counter(
+    'borealis_fireworker_rockets_total', 'Rockets launched.')
+RAPIDFIRE_SECONDS = metrics.histogram(
+    'borealis_fireworker_rapidfire_seconds',
+    'Duration of each launch_rocket() call, i.e. checking out and running a'
+    ' rocket.')
+IDLE_SECONDS = metrics.counter(
+    'borealis_fireworker_idle_seconds_total',
+    'Seconds launch_rockets() idled waiting for READY rockets.')
+CHECKOUTS = metrics.counter(
+    'borealis_fireworker_checkouts_total',
+    'Rocket checkout attempts by locality: "inputs" or "image" for Fireworks'
+    ' that use cached inputs or a pulled Docker image, else "any".',
+    ['locality'])
+
+#: Seconds between checks for READY Fireworks with cached inputs or images
+#: while waiting up to `locality_wait` seconds for one.
+LOCALITY_POLL_SECS = 3
+
 ERROR_EXIT_CODE = 1
 KEYBOARD_INTERRUPT_EXIT_CODE = 2
 
@@ -58,7 +84,16 @@ def _setup_logging(gce_instance_name, host_name):
     """Set up GCP StackDriver cloud logging on Python's root logger for the GCE
     instance name or any host name. Set a narrow logging filter if running off
     GCE (instance_name is empty).
+
+    The cloud logging handler batches log entries in a bounded queue and ships
+    them from a background thread so logging never blocks a DockerTask's
+    container output loop. Under load it drops low-priority log lines, and
+    counts them.
     """
+    import google.cloud.logging as gcl
+    from google.cloud.logging.handlers import setup_logging
+    from google.cloud.logging.resource import Resource
+
     exclude = (FW_CONSOLE_LOGGER.name, 'urllib3')
 
     monitored_resource = Resource(
@@ -67,13 +102,14 @@ def _setup_logging(gce_instance_name, host_name):
             'instance_id': host_name,
             'zone': gcp.zone()})
     client = gcl.Client()
+    cloud_handler = BatchingCloudHandler(
+        client, FW_LOGGER.name, resource=monitored_resource)
 
     # noinspection PyTypeChecker
-    client.setup_logging(
-        log_level=logging.WARNING,
+    setup_logging(
+        cloud_handler,
         excluded_loggers=exclude,
-        name=FW_LOGGER.name,
-        resource=monitored_resource)
+        log_level=logging.WARNING)
 
     # To StackDriver cloud logs (which aggregate all machines): From workers
     # running "locally" (off GCE), log at the WARNING level including start/end
@@ -97,12 +133,17 @@ def _setup_logging(gce_instance_name, host_name):
         is_cloud = hasattr(handler, 'transport') or hasattr(handler, 'resource')
         handler.addFilter(cloud_filter if is_cloud else console_filter)
 
+    # Set the filtered loggers' levels so they don't even create log records
+    # that both handlers would reject.
+    apply_logger_levels(cloud_filter, console_filter)
+
 
-def _cleanup_logging():
-    # type: () -> None
+def _cleanup_logging(deadline=LOG_FLUSH_DEADLINE):
+    # type: (float) -> None
     """Clean up StackDriver cloud logging: Flush and remove root logger's
     background-transport handlers so the last messages get to the server and
     won't raise RuntimeError('cannot schedule new futures after shutdown').
+    Wait up to `deadline` seconds for the batching handler to ship its queue.
 
     StackDriver should be out of the loop after this but there's no documented
     API for this so hopefully it's right, idempotent, and safe if StackDriver
@@ -111,13 +152,52 @@ def _cleanup_logging():
     root = logging.getLogger()
 
     for handler in list(root.handlers):
-        if hasattr(handler, 'transport'):
+        if isinstance(handler, BatchingCloudHandler):
+            root.removeHandler(handler)
+            handler.close(deadline)
+            if handler.dropped or handler.failed:
+                FW_CONSOLE_LOGGER.warning(
+                    'Cloud logging dropped %s and failed to ship %s log records',
+                    handler.dropped, handler.failed)
+        elif hasattr(handler, 'transport'):
             transport = handler.transport
             if hasattr(transport, 'flush'):
                 transport.flush()
                 root.removeHandler(handler)
 
 
+def machine_resources():
+    # type: () -> Tuple[int, float]
+    """Return this machine's (CPU count, total memory in GiB)."""
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):  # not on Linux or macOS
+        memory = 0
+    return multiprocessing.cpu_count(), memory / 2**30
+
+
+def _parse_category(category):
+    # type: (Optional[str]) -> Union[str, List[str]]
+    """Parse the `category` setting: a FireWorks category name, or several
+    separated by spaces, or empty for any category.
+    """
+    categories = (category or '').split()
+    return categories if len(categories) > 1 else ''.join(categories)
+
+
+def _prepull_images(images):
+    # type: (Optional[str]) -> None
+    """Start pre-pulling the Docker images named in the `images` setting,
+    separated by spaces or semicolons, in background threads.
+    """
+    image_names = (images or '').replace(';', ' ').split()
+    if image_names:
+        from borealis import docker_task
+
+        FW_LOGGER.info('Pre-pulling Docker images %s', image_names)
+        docker_task.prepull_images(image_names, FW_LOGGER)
+
+
 class Fireworker(object):
     """A Fireworks worker on Google Compute Engine to "rapidfire" launch rockets.
 
@@ -132,9 +212,19 @@ class Fireworker(object):
         """
         :param lpad_config: LaunchPad() configuration parameters *and*
             idle_for_waiters: see launch_rockets(), default = 60 minutes;
-            idle_for_rockets: see launch_rockets(), default = 15 minutes
+            idle_for_rockets: see launch_rockets(), default = 15 minutes;
+            profiling: profile each rocket in this borealis.util.profiling
+                mode, 'cprofile' or 'sample', default = off;
+            input_cache_gb: keep up to this many GB of recently pulled
+                DockerTask inputs in a local cache, default = off;
+            locality_wait: see choose_fworker(), default = off;
+            category: the worker pool's category name (or several
+                separated by spaces) to run only Fireworks with that spec
+                `_category`, default = any Fireworks
         :param host_name: this network host name
         """
+        from fireworks import LaunchPad, fw_config
+
         self.lpad_config = lpad_config.copy()
         self.host_name = host_name
 
@@ -150,13 +240,151 @@ class Fireworker(object):
             int(lpad_config.pop('idle_for_waiters', DEFAULT_IDLE_FOR_WAITERS)),
             self.idle_for_rockets)
 
+        self.profiling = lpad_config.pop('profiling', None) or None
+        if self.profiling not in (None,) + profiling.MODES:
+            FW_LOGGER.warning('Ignoring the unknown profiling mode %r, not one of %s',
+                              self.profiling, profiling.MODES)
+            self.profiling = None
+
+        input_cache_gb = lpad_config.pop('input_cache_gb', None)
+        if input_cache_gb:
+            from borealis import docker_task
+            from borealis.util.file_cache import FileCache
+
+            docker_task.use_input_cache(FileCache(int(float(input_cache_gb) * 2**30)))
+
+        locality_wait = lpad_config.pop('locality_wait', None)
+        self.locality_wait = None if locality_wait in (None, '') else float(locality_wait)
+
         self.launchpad = LaunchPad(**lpad_config)
         self.launchpad.m_logger.setLevel(self.strm_lvl)  # set non-stream level
 
-        # Can optionally set a specific `category` of jobs to pull, a `query`
-        # to restrict the type of Fireworks to run, and an `env` to pass
-        # worker-specific into to the Firetasks.
-        self.fireworker = FWorker(host_name)
+        # The `category` setting restricts this worker to a pool of Fireworks,
+        # and the query skips DockerTasks that need more CPUs or memory than
+        # this machine has. (FWorker could also have an `env` to pass
+        # worker-specific info to the Firetasks.)
+        from borealis import docker_task
+
+        self.category = _parse_category(lpad_config.pop('category', None))
+        cpus, memory_gb = machine_resources()
+        self.query = docker_task.resource_query(cpus, memory_gb)
+        self.fireworker = self.make_fworker()
+        FW_LOGGER.info('Fireworker category %r, %s CPUs, %.1f GiB RAM',
+                       self.category, cpus, memory_gb)
+
+        #: Set when this GCE VM is being preempted.
+        self.preempted = Event()
+
+    def watch_for_preemption(self):
+        # type: () -> None
+        """When running on a GCE VM, watch for a preemption notice and then
+        ask the running DockerTask to stop early. launch_rockets() will requeue
+        the stopped Fireworks.
+        """
+        from borealis import docker_task
+
+        def on_preempted(value):
+            if value.strip().upper() == 'TRUE' and not self.preempted.is_set():
+                FW_LOGGER.warning('Fireworker: this GCE VM is being preempted')
+                self.preempted.set()
+                docker_task.request_stop('preemption')
+
+        gcp.watch_instance_metadata('preempted', on_preempted)
+
+    def requeue_stopped_fireworks(self):
+        # type: () -> None
+        """Return this worker's Fireworks that FIZZLED because a DockerTask got
+        stopped early (DockerTaskStopped) to the READY state.
+        """
+        from borealis import docker_task
+
+        launch_ids = [launch['launch_id'] for launch in self.launchpad.launches.find(
+            {'fworker.name': self.host_name,
+             'state': 'FIZZLED',
+             'action.stored_data._exception._stacktrace': {
+                 '$regex': docker_task.DockerTaskStopped.__name__}},
+            {'launch_id': True})]
+        if not launch_ids:
+            return
+
+        fw_ids = self.launchpad.get_fw_ids(
+            {'state': 'FIZZLED', 'launches': {'$in': launch_ids}})
+        for fw_id in fw_ids:
+            self.launchpad.rerun_fw(fw_id)
+        FW_LOGGER.warning('Requeued stopped Fireworks: %s', fw_ids)
+
+    def make_fworker(self, query=None):
+        # type: (Optional[Dict[str, Any]]) -> Any  # an FWorker
+        """Make an FWorker for this worker's category and resources, further
+        restricted by the optional query.
+        """
+        from fireworks import FWorker
+
+        return FWorker(
+            self.host_name, category=self.category,
+            query={'$and': [self.query, query]} if query else self.query)
+
+    def choose_fworker(self):
+        # type: () -> Any  # an FWorker
+        """Return the FWorker to check out the next rocket with.
+
+        If the `locality_wait` setting is on, prefer READY Fireworks whose
+        DockerTask uses inputs in this worker's input cache, then ones whose
+        Docker image it already pulled, waiting up to `locality_wait` seconds
+        for one when there's other READY work. Otherwise (or after that), take
+        any READY Firework, by priority.
+        """
+        from borealis import docker_task
+
+        if self.locality_wait is None:
+            return self.fireworker
+
+        tiers = [(name, self.make_fworker(query))
+                 for name, query in docker_task.locality_queries()]
+        deadline = time.time() + self.locality_wait
+
+        while tiers:
+            for name, fworker in tiers:
+                if self.launchpad.run_exists(fworker):
+                    CHECKOUTS.labels(name).inc()
+                    return fworker
+
+            remaining = deadline - time.time()
+            if (remaining <= 0 or self.preempted.is_set()
+                    or not self.launchpad.run_exists(self.fireworker)):
+                break
+            time.sleep(min(LOCALITY_POLL_SECS, remaining))
+
+        CHECKOUTS.labels('any').inc()
+        return self.fireworker
+
+    def launch_rocket(self, fworker):
+        # type: (Any) -> bool
+        """Check out and run one READY rocket for the FWorker, if there is
+        one, in a new launcher_ directory like rapidfire() does. Return True
+        if a rocket ran.
+        """
+        from fireworks.core import rocket_launcher
+        from fireworks.utilities.fw_utilities import create_datestamp_dir, get_fw_logger
+
+        if not self.launchpad.run_exists(fworker):
+            return False
+
+        # TODO(jerry): local_redirect?
+        curdir = os.getcwd()
+        l_logger = get_fw_logger('rocket.launcher', l_dir=self.launchpad.get_logdir(),
+                                 stream_level=self.strm_lvl)
+        launcher_dir = create_datestamp_dir(curdir, l_logger, prefix='launcher_')
+        os.chdir(launcher_dir)
+        try:
+            ran = rocket_launcher.launch_rocket(
+                self.launchpad, fworker, strm_lvl=self.strm_lvl)
+        finally:
+            os.chdir(curdir)
+
+        if not ran and not os.listdir(launcher_dir):
+            os.rmdir(launcher_dir)  # remove the empty shell of a directory
+        return bool(ran)
 
     def launch_rockets(self):
         # type: () -> str
@@ -170,25 +398,37 @@ class Fireworker(object):
             (gcloud compute instances add-metadata...) to 'soon' or 'when-idle'
           * between rockets, the custom metadata attribute `quit` got set to
             'soon'
+          * this GCE VM is being preempted, after requeuing the Firework that
+            got stopped
 
         Returns the stop reason.
         """
-        # rapidfire() launches READY rockets until: `max_loops` batches of READY
-        # rockets OR `timeout` total elapsed seconds OR `nlaunches` rockets launched
-        # OR `nlaunches` == 0 ("until completion", the default) AND no rockets are
-        # even waiting.
-        #
-        # Set max_loops so it won't loop forever and we can track idle time.
-        #
-        # TODO(jerry): Set m_dir? local_redirect?
-        while True:
-            rocket_launcher.rapidfire(
-                self.launchpad, self.fireworker, strm_lvl=self.strm_lvl,
-                max_loops=1, sleep_time=self.sleep_secs)
+        # Launch one rocket at a time (like rapidfire() with nlaunches=1,
+        # max_loops=1) to check for quit requests between rockets, track idle
+        # time, and count the rockets that ran. (rapidfire() returns None.)
+        idle_since = None  # type: Optional[float]
 
-            # Idle to the max.
-            idled = self.sleep_secs  # rapidfire() just slept once
+        while True:
+            profile = profiling.RocketProfile(self.profiling, self.host_name)
+            fworker = self.choose_fworker()
+            with RAPIDFIRE_SECONDS.time(), profile:
+                ran = self.launch_rocket(fworker)
+            if ran:
+                ROCKETS.inc()
+                idle_since = None
+            profile.save()
+
+            if self.preempted.is_set():
+                self.requeue_stopped_fireworks()
+                return 'preemption'
+
+            # Idle to the max, measuring the time since the last rocket ran.
             while not self.launchpad.run_exists(self.fireworker):  # none ready to run
+                if self.preempted.is_set():
+                    return 'preemption'
+                if idle_since is None:
+                    idle_since = metrics.seconds_clock()
+                idled = metrics.seconds_clock() - idle_since
                 future_work = self.launchpad.future_run_exists(self.fireworker)  # any ready or waiting?
                 if idled >= (self.idle_for_waiters if future_work else self.idle_for_rockets):
                     return 'idle'
@@ -200,8 +440,9 @@ class Fireworker(object):
                 FW_CONSOLE_LOGGER.info(
                     'Sleeping for %s secs waiting for launchable rockets',
                     self.sleep_secs)
+                start = metrics.seconds_clock()
                 time.sleep(self.sleep_secs)
-                idled += self.sleep_secs
+                IDLE_SECONDS.inc(metrics.seconds_clock() - start)
 
             req = gcp.instance_attribute('quit')
             if req == 'soon':
@@ -230,12 +471,29 @@ def main(development=False, launchpad_filename=DEFAULT_LPAD_YAML):
         attributes/idle_for_waiters - idle this many seconds for WAITING rockets
             to become READY (for queued rockets that are waiting on other
             rockets; default 60 minutes; >= idle_for_rockets)
+        attributes/metrics_port - serve Prometheus metrics on this HTTP port
+            at /metrics (default: off)
+        attributes/images - Docker images to pre-pull in the background while
+            starting up, separated by spaces or semicolons, so the first
+            rockets don't wait for whole image downloads
+        attributes/profiling - profile each rocket, 'cprofile' or 'sample',
+            writing the profile files under its DockerTask's storage prefix
+            (default: off; see borealis.util.profiling)
+        attributes/input_cache_gb - keep up to this many GB of recently pulled
+            DockerTask inputs in a local cache (default: off)
+        attributes/locality_wait - prefer Fireworks whose DockerTask uses
+            cached inputs or an already pulled Docker image, waiting up to
+            this many seconds for one (default: off; 0 = don't wait)
+        attributes/category - the worker pool's FireWorks category (or several
+            separated by spaces) to run only Fireworks with a matching spec
+            `_category` (default: any Fireworks; see `gce --category`)
     else from the launchpad yaml file named by the `launchpad_filename` arg:
         DB host, DB port - for the MongoDB connection
         DB name
         DB username, DB password - null for no user authentication
         logdir, strm_lvl, ... - for "launchpad" & "rocket" logging
-        idle_for_waiters, idle_for_rockets
+        idle_for_waiters, idle_for_rockets, metrics_port, profiling,
+        input_cache_gb, locality_wait, category
     with fallbacks:
         name - the network hostname
         DB host, DB port - localhost:27017 (Fireworks defaults)
@@ -252,6 +510,9 @@ def main(development=False, launchpad_filename=DEFAULT_LPAD_YAML):
         gcloud compute instances add-metadata INSTANCE-NAME --metadata quit=when-idle
     or stop as soon as it finishes the current rocket:
         gcloud compute instances add-metadata INSTANCE-NAME --metadata quit=soon
+
+    When GCE preempts this VM, this stops the running DockerTask (which pushes
+    its outputs so far), requeues its Firework, and exits.
     """
     def metadata_else_config(attribute, default=None, config_key=None):
         # type: (str, Any, Optional[str]) -> Any
@@ -268,11 +529,15 @@ def main(development=False, launchpad_filename=DEFAULT_LPAD_YAML):
                  or lpad_config.get(config_key, default))
         lpad_config[config_key] = value
 
+    import ruamel.yaml as yaml
+
     exit_code = ERROR_EXIT_CODE
 
     try:
         instance_name = gcp.gce_instance_name()
         host_name = instance_name or socket.gethostname()
+        if instance_name:
+            _prepull_images(gcp.instance_attribute('images'))
         _setup_logging(instance_name, host_name)
 
         FW_CONSOLE_LOGGER.info('Reading launchpad config "{}"'.format(
@@ -285,6 +550,15 @@ def main(development=False, launchpad_filename=DEFAULT_LPAD_YAML):
         metadata_else_config('password')
         metadata_else_config('idle_for_waiters', DEFAULT_IDLE_FOR_WAITERS)
         metadata_else_config('idle_for_rockets', DEFAULT_IDLE_FOR_ROCKETS)
+        metadata_else_config('metrics_port')
+        metadata_else_config('profiling')
+        metadata_else_config('input_cache_gb')
+        metadata_else_config('locality_wait')
+        metadata_else_config('category')
+
+        metrics_port = lpad_config.pop('metrics_port', None)
+        if metrics_port:
+            metrics.start_http_server(int(metrics_port))
 
         redacted_config = dict(lpad_config, password=Redacted())
         FW_LOGGER.warning(
@@ -292,6 +566,8 @@ def main(development=False, launchpad_filename=DEFAULT_LPAD_YAML):
             host_name, redacted_config)
 
         fireworker = Fireworker(lpad_config, host_name)
+        if instance_name:
+            fireworker.watch_for_preemption()
         stop_reason = fireworker.launch_rockets()
         FW_LOGGER.warning('Fireworker -- normal exit: {}'.format(stop_reason))
         exit_code = 0
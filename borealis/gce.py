@@ -9,21 +9,36 @@ like "{prefix}-0", "{prefix}-1", "{prefix}-2", ...
 # Example: A dry run of that command to see all the options and metadata fields.
     gce grace-wcm -c3 -m db=analysis -d
 
+# Example: Also have them pre-pull Docker images while starting up.
+    gce grace-wcm -c3 -m "db=analysis,images=gcr.io/my-proj/wcm-code gcr.io/my-proj/analysis:v2"
+
+# Example: Create a pool of 4 high-memory workers that only run Fireworks with
+# the spec `_category: highmem`. (Workers without a category run any Fireworks
+# that fit their machine's CPUs and memory.)
+    gce grace-big -c4 -m db=analysis --category highmem -o machine-type=n1-highmem-8
+
 # Example: Delete those 3 worker VMs.
     gce --delete grace-wcm -c3
 
 # Example: Set their metadata field `quit` to `soon`, asking Fireworkers to shut
 # down soon (between rockets).
     gce grace-wcm -c3 --set -m quit=soon
+
+# Example: Autoscale up to 50 worker VMs to track the READY and RUNNING
+# Fireworks in the LaunchPad db, within a budget of 200 VM-hours.
+    gce grace-wcm -c50 --autoscale --budget 200
 """
 
 from __future__ import absolute_import, division, print_function
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from pprint import pprint
 import re
 import sys
+from threading import Lock
+import time
 
 if os.name == 'posix' and sys.version_info[0] < 3:
     import subprocess32 as subprocess
@@ -32,8 +47,7 @@ else:
 
 from borealis.util import data
 from borealis.util import gcp
-import ruamel.yaml as yaml
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 #: Access Scopes for the created GCE VMs.
 SCOPES = ','.join([
@@ -48,6 +62,38 @@ SCOPES = ','.join([
 
 DEFAULT_LPAD_YAML = 'my_launchpad.yaml'
 
+#: `gcloud compute instances create` options for preemptible VMs, which cost
+#: much less but GCE can stop them at any time and within 24 hours.
+#: Fireworkers on preemptible VMs requeue the Firework that got preempted.
+PREEMPTIBLE_OPTIONS = {
+    'preemptible': None,
+    'maintenance-policy': 'TERMINATE',
+    'no-restart-on-failure': None,
+}
+
+#: The default max number of `gcloud` subprocesses to run concurrently.
+DEFAULT_MAX_WORKERS = 16
+
+#: The default max number of VMs to create or delete per `gcloud` command.
+DEFAULT_CHUNK_SIZE = 25
+
+#: The default max rate of creating VMs, in VMs/second. Each VM creation is a
+#: Compute Engine API write request, which is rate limited per project.
+DEFAULT_CREATE_RATE = 10.0
+
+#: The max number of attempts to create each VM when it fails from a transient
+#: condition such as a rate limit or a zone resource stockout.
+MAX_CREATE_ATTEMPTS = 5
+
+#: `gcloud` error message patterns that indicate a Compute Engine API rate limit
+#: (worth retrying after a backoff) vs. a zone stockout (worth retrying later
+#: or in another zone). Resource quotas like "Quota 'CPUS' exceeded" won't
+#: clear up by retrying.
+RATE_LIMIT_ERRORS = re.compile(
+    r'rateLimitExceeded|Rate Limit Exceeded|per minute|RESOURCE_EXHAUSTED')
+STOCKOUT_ERRORS = re.compile(
+    r'ZONE_RESOURCE_POOL_EXHAUSTED|does not have enough resources available')
+
 
 def _clean(token):
     # type: (Any) -> str
@@ -82,20 +128,153 @@ def _parse_options(csv):
     return options
 
 
+def _chunks(items, size):
+    # type: (List[Any], int) -> List[List[Any]]
+    """Split a list into sublists of up to `size` items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _confirm(prompt):
+    # type: (str) -> bool
+    """Ask the user a yes/no question on the console. Default to no."""
+    sys.stdout.write('{} (y/N) '.format(prompt))
+    sys.stdout.flush()
+    return sys.stdin.readline().strip().lower() in ('y', 'yes')
+
+
+def _error_for(name, stderr):
+    # type: (str, str) -> str
+    """Pick the `gcloud` stderr lines that mention the named instance, else
+    return all of stderr as its error message.
+    """
+    lines = [line.strip(' -') for line in stderr.splitlines()
+             if re.search(r'\b{}\b'.format(re.escape(name)), line)]
+    return '\n'.join(lines) or stderr.strip() or 'unknown error'
+
+
+class _RateLimiter(object):
+    """A thread-safe token bucket that allows `rate` units/second on average
+    with bursts up to `burst` units.
+    """
+
+    def __init__(self, rate, burst):
+        # type: (float, int) -> None
+        assert rate > 0, 'the rate must be positive'
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._time = time.time()
+        self._lock = Lock()
+
+    def acquire(self, units=1):
+        # type: (int) -> None
+        """Wait until `units` (capped at `burst`) are available, then take them."""
+        units = min(units, self.burst)
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self._tokens >= units:
+                    self._tokens -= units
+                    return
+                wait = (units - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FleetResult(object):
+    """The per-instance outcomes of a ComputeEngine operation on a group of VMs.
+    """
+
+    def __init__(self, action):
+        # type: (str) -> None
+        self.action = action
+        self.succeeded = []  # type: List[str]
+        self.failed = {}  # type: Dict[str, str]
+        self.zones = {}  # type: Dict[str, str]
+
+    @property
+    def ok(self):
+        # type: () -> bool
+        """Return True if no instance failed."""
+        return not self.failed
+
+    def add(self, names, succeeded, stderr, zone=None):
+        # type: (List[str], Iterable[str], str, Optional[str]) -> None
+        """Record the outcome of one `gcloud` command on the named instances
+        given the names that it reported as succeeded.
+        """
+        done = set(succeeded)
+        for name in names:
+            if name in done:
+                self.succeeded.append(name)
+                if zone:
+                    self.zones[name] = zone
+            else:
+                self.failed[name] = _error_for(name, stderr)
+
+    def summary(self):
+        # type: () -> str
+        """Summarize the outcome, one line per failed instance."""
+        lines = ['{}: {} succeeded, {} failed'.format(
+            self.action, len(self.succeeded), len(self.failed))]
+        lines.extend('  {}: {}'.format(name, error.replace('\n', '; '))
+                     for name, error in sorted(self.failed.items()))
+        return '\n'.join(lines)
+
+
 class ComputeEngine(object):
     """Runs `gcloud compute` to create, delete, or change a group of GCE VM
     instances named "{prefix}-{index}".
+
+    This runs a bounded pool of concurrent `gcloud` subprocesses, each working
+    on one VM or a chunk of VMs. `gcloud` waits for the zone operations to
+    finish so each subprocess reports its VMs' outcomes, which this collects
+    into a FleetResult.
     """
 
-    MAX_VMS = 100  # don't create more than this many GCE VMs at a time
+    #: Don't create more than this many GCE VMs at a time. This guards against
+    #: typos; `create` splits large requests into rate-limited chunks.
+    MAX_VMS = 2000
 
-    def __init__(self, name_prefix, dry_run=False, verbose=False):
-        # type: (str, bool, bool) -> None
+    def __init__(self, name_prefix, dry_run=False, verbose=False,
+                 max_workers=DEFAULT_MAX_WORKERS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 create_rate=DEFAULT_CREATE_RATE, fallback_zones=()):
+        # type: (str, bool, bool, int, int, float, Iterable[str]) -> None
+        """
+        :param name_prefix: the VM instance name prefix
+        :param dry_run: print the `gcloud` commands instead of running them
+        :param verbose: print the `gcloud` commands before running them
+        :param max_workers: the max number of `gcloud` subprocesses to run at
+            a time
+        :param chunk_size: the max number of VMs to create or delete per
+            `gcloud` command
+        :param create_rate: the max average rate of creating VMs, in VMs/second
+        :param fallback_zones: zones to create VMs in when the primary zone
+            runs out of resources. When set, `delete` and `set_metadata` look
+            up each VM's zone.
+        """
         assert name_prefix, 'the name_prefix must not be empty'
+        assert max_workers > 0 and chunk_size > 0
 
         self.name_prefix = name_prefix
         self.dry_run = dry_run
         self.verbose = verbose
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.create_rate = create_rate
+        self.fallback_zones = list(fallback_zones)
+
+    def _sanitized_prefix(self):
+        # type: () -> str
+        """Sanitize the name prefix to a legal VM name string, eliding
+        "workflow" for brevity.
+        """
+        return re.sub(
+            r'[^-a-z0-9]+', '-',
+            self.name_prefix.lower().replace('workflow', ''))
 
     def make_names(self, base=0, count=1):
         # type: (int, int) -> List[str]
@@ -103,12 +282,47 @@ class ComputeEngine(object):
         range [base .. count], sanitizing the name prefix to a legal VM name
         string and eliding "workflow" for brevity.
         """
-        sanitized = re.sub(
-            r'[^-a-z0-9]+', '-',
-            self.name_prefix.lower().replace('workflow', ''))
+        sanitized = self._sanitized_prefix()
         names = ['{}-{}'.format(sanitized, i) for i in range(base, base + count)]
         return names
 
+    def list_instances(self, project=None):
+        # type: (Optional[str]) -> Dict[str, Tuple[str, str]]
+        """List the existing GCE VM instances named "{prefix}-{index}" as a
+        dict {name: (zone, status)}, where status is e.g. 'RUNNING' or
+        'STOPPING'. Raise OSError if `gcloud` fails.
+        """
+        cmd_tokens = [
+            'gcloud', 'compute', 'instances', 'list',
+            '--project={}'.format(project or gcp.project()),
+            '--filter=name ~ ^{}-[0-9]+$'.format(self._sanitized_prefix()),
+            '--format=value(name,zone.basename(),status)']
+        returncode, out, err = self._gcloud(cmd_tokens)
+        if returncode:
+            raise OSError('Failed to list GCE VMs: {}'.format(err.strip()))
+
+        instances = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) == 3:
+                instances[fields[0]] = (fields[1], fields[2])
+        return instances
+
+    def _zones_of(self, instance_names, project, default_zone):
+        # type: (List[str], str, str) -> Dict[str, List[str]]
+        """Group the named instances by zone, looking up their zones if VMs
+        might've been created in fallback zones.
+        """
+        if not self.fallback_zones or self.dry_run:
+            return {default_zone: instance_names}
+
+        instances = self.list_instances(project)
+        zones = {}  # type: Dict[str, List[str]]
+        for name in instance_names:
+            zone = instances[name][0] if name in instances else default_zone
+            zones.setdefault(zone, []).append(name)
+        return zones
+
     def _log_header(self, action, instance_names):
         # type: (str, List[str]) -> None
         dry = 'Dry run for: ' if self.dry_run else ''
@@ -118,9 +332,74 @@ class ComputeEngine(object):
                else 'VMs: {} .. {}'.format(instance_names[0], instance_names[-1]))
         print('{}{} {} Google Compute Engine {}'.format(dry, action, count, vms))
 
+    @staticmethod
+    def _gcloud(cmd_tokens):
+        # type: (List[str]) -> Tuple[int, str, str]
+        """Run a `gcloud` command without console input. Return its
+        (returncode, stdout, stderr).
+        """
+        process = subprocess.run(
+            cmd_tokens,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True)
+        return process.returncode, process.stdout, process.stderr
+
+    def _run_batch(self, action, commands, limiter=None, progress=False):
+        # type: (str, List[Tuple[List[str], List[str], Callable[[str, str], Iterable[str]]]], Optional[_RateLimiter], bool) -> FleetResult
+        """Run `gcloud` commands concurrently in a bounded pool and collect
+        their per-instance outcomes.
+
+        Each command is a tuple (instance_names, cmd_tokens, parse) where
+        parse(stdout, stderr) returns the names it reported as succeeded in
+        case the command failed partway.
+
+        If `limiter` is given, each command waits for it to allow one unit per
+        instance. If `progress`, print a line as each command finishes.
+        """
+        result = FleetResult(action)
+
+        for _, cmd_tokens, _ in commands:
+            if self.dry_run or self.verbose:
+                pprint(cmd_tokens)
+        if self.dry_run or not commands:
+            return result
+
+        def run(names, cmd_tokens):
+            if limiter:
+                limiter.acquire(len(names))
+            return self._gcloud(cmd_tokens)
+
+        total = sum(len(names) for names, _, _ in commands)
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(run, names, cmd_tokens): (names, parse, cmd_tokens)
+                       for names, cmd_tokens, parse in commands}
+
+            for future in as_completed(futures):
+                names, parse, cmd_tokens = futures[future]
+                zone = next((token.split('=', 1)[1] for token in cmd_tokens
+                             if token.startswith('--zone=')), None)
+                try:
+                    returncode, out, err = future.result()
+                    succeeded = names if returncode == 0 else parse(out, err)
+                    result.add(names, succeeded, err, zone)
+                except OSError as e:
+                    result.add(names, (), '{!r}'.format(e))
+
+                if progress:
+                    print('  {}: {}/{} done, {} failed, {:.0f}s'.format(
+                        action, len(result.succeeded) + len(result.failed),
+                        total, len(result.failed), time.time() - start))
+
+        return result
+
     def create(self, base=0, count=1, command_options=None, **metadata):
-        # type: (int, int, Optional[Dict[str, Any]], **Any) -> None
-        """In parallel, create a group of GCE VM instances.
+        # type: (int, int, Optional[Dict[str, Any]], **Any) -> FleetResult
+        """In parallel, create a group of GCE VM instances. Return a
+        FleetResult.
 
         This provides default command options to `gcloud compute instances create`.
         The caller should at least set the `image-family` option.
@@ -129,6 +408,13 @@ class ComputeEngine(object):
         ',' and '=' characters from the metadata fields, then passes tokens to
         `gcloud` without shell quoting risks.
 
+        This splits the VMs into chunks of up to `chunk_size` per `gcloud`
+        command, limits the rate of creating them to `create_rate`, and
+        prints progress as chunks finish. It retries VMs that failed from API
+        rate limits or zone resource stockouts after a jittered exponential
+        backoff, moving stocked-out VMs to the next of the `fallback_zones`.
+        Before retrying, it lists the VMs to skip those that exist.
+
         If `dry_run`, this logs the constructed `gcloud` command instead of
         running it, or if `verbose`, this logs the `gcloud` command before
         running it.
@@ -138,8 +424,9 @@ class ComputeEngine(object):
         instance_names = self.make_names(base, count)
 
         self._log_header('Creating', instance_names)
+        result = FleetResult('Create')
         if count <= 0:
-            return
+            return result
 
         project = gcp.project()
         options = {
@@ -159,32 +446,107 @@ class ComputeEngine(object):
         if metadata_string:
             options['metadata'] = metadata_string
 
-        options_list = _options_list(options)
-        cmd_tokens = ['gcloud', 'compute', 'instances', 'create'
-            ] + instance_names + options_list
-
-        if self.dry_run or self.verbose:
-            pprint(cmd_tokens)
+        options['format'] = 'value(name)'  # list the created VMs on stdout
+        options['quiet'] = None
+
+        zones = [options['zone']] + [
+            z for z in self.fallback_zones if z != options['zone']]
+        limiter = _RateLimiter(self.create_rate, self.chunk_size)
+        pending = {name: 0 for name in instance_names}  # name -> zone index
+        errors = {}  # type: Dict[str, str]
+
+        for attempt in range(MAX_CREATE_ATTEMPTS):
+            if attempt:
+                delay = data.backoff(attempt)
+                print('Retrying {} VMs in {:.0f}s'.format(len(pending), delay))
+                time.sleep(delay)
+
+            commands = []
+            for zone_index, zone in enumerate(zones):
+                names = [name for name in instance_names
+                         if pending.get(name) == zone_index]
+                options_list = _options_list(dict(options, zone=zone))
+                commands.extend(
+                    (chunk,
+                     ['gcloud', 'compute', 'instances', 'create'] + chunk + options_list,
+                     lambda out, err: out.split())
+                    for chunk in _chunks(names, self.chunk_size))
+
+            round_result = self._run_batch(
+                'Create', commands, limiter=limiter, progress=len(commands) > 1)
+            if self.dry_run:
+                return result
+
+            for name in round_result.succeeded:
+                result.succeeded.append(name)
+                result.zones[name] = round_result.zones.get(name, zones[pending[name]])
+
+            retry = {}
+            for name, error in round_result.failed.items():
+                errors[name] = error
+                if STOCKOUT_ERRORS.search(error):
+                    retry[name] = min(pending[name] + 1, len(zones) - 1)
+                elif RATE_LIMIT_ERRORS.search(error):
+                    retry[name] = pending[name]
+                else:
+                    result.failed[name] = error
+
+            if retry:
+                self._drop_existing(retry, pending, project, result)
+            pending = retry
+            if not pending:
+                break
+
+        for name in pending:
+            result.failed[name] = errors[name]
+
+        print(result.summary())
+        return result
+
+    def _drop_existing(self, retry, pending, project, result):
+        # type: (Dict[str, int], Dict[str, int], str, FleetResult) -> None
+        """Reconcile the VMs to retry against the VMs that exist, since
+        `gcloud` might not list every VM it created in a failed command. VM
+        names are unique only per zone, so retrying an existing VM in a
+        fallback zone would create a second one.
+
+        Move the existing VMs from `retry` to `result.succeeded`. If listing
+        the VMs fails, retry each VM in the zone it just tried, where a
+        duplicate fails rather than runs.
+        """
+        try:
+            instances = self.list_instances(project)
+        except OSError as e:
+            print('{}; retrying VMs in the same zones'.format(e))
+            for name in retry:
+                retry[name] = pending[name]
+            return
 
-        if not self.dry_run:
-            subprocess.call(cmd_tokens)
+        for name in sorted(retry):
+            if name in instances:
+                del retry[name]
+                result.succeeded.append(name)
+                result.zones[name] = instances[name][0]
 
     def delete(self, base=0, count=1, command_options=None):
-        # type: (int, int, Optional[Dict[str, Any]]) -> None
-        """In parallel, delete a group of GCE VM instances.
+        # type: (int, int, Optional[Dict[str, Any]]) -> FleetResult
+        """In parallel, delete a group of GCE VM instances. Return a
+        FleetResult.
 
         If `dry_run`, this logs the constructed `gcloud` command instead of
         running it, or if `verbose`, this logs the `gcloud` command before
         running it.
 
-        If command_options includes {'quiet': None}, gcloud won't ask for
-        confirmation to irreversibly auto-delete disks.
+        Unless command_options includes {'quiet': None}, this asks on the
+        console (if interactive) for confirmation to irreversibly delete the
+        VMs and their auto-delete disks.
         """
         instance_names = self.make_names(base, count)
 
         self._log_header('Deleting', instance_names)
+        result = FleetResult('Delete')
         if count <= 0:
-            return
+            return result
 
         project = gcp.project()
         options = {
@@ -192,19 +554,34 @@ class ComputeEngine(object):
             'zone': gcp.zone()}
         options.update(command_options or {})
 
-        options_list = _options_list(options)
-        cmd_tokens = ['gcloud', 'compute', 'instances', 'delete'
-            ] + instance_names + options_list
-
-        if self.dry_run or self.verbose:
-            pprint(cmd_tokens)
-
-        if not self.dry_run:
-            subprocess.call(cmd_tokens)
+        if ('quiet' not in options and not self.dry_run and sys.stdin.isatty()
+                and not _confirm('Delete these VMs and their disks?')):
+            return result
+        options['quiet'] = None
+
+        def parse(out, err):
+            # E.g. "Deleted [https://www.googleapis.com/compute/v1/projects/
+            # my-project/zones/us-west1-b/instances/grace-wcm-0]."
+            return re.findall(r'Deleted \[\S*/instances/([^/\]]+)\]', err)
+
+        commands = []
+        zones = self._zones_of(instance_names, project, options['zone'])
+        for zone, zone_names in sorted(zones.items()):
+            options_list = _options_list(dict(options, zone=zone))
+            commands.extend(
+                (names,
+                 ['gcloud', 'compute', 'instances', 'delete'] + names + options_list,
+                 parse)
+                for names in _chunks(zone_names, self.chunk_size))
+
+        result = self._run_batch('Delete', commands)
+        print(result.summary())
+        return result
 
     def set_metadata(self, base=0, count=1, command_options=None, **metadata):
-        # type: (int, int, Optional[Dict[str, Any]], **Any) -> None
-        """Set metadata fields on a group of GCE VM instances.
+        # type: (int, int, Optional[Dict[str, Any]], **Any) -> FleetResult
+        """In parallel, set metadata fields on a group of GCE VM instances.
+        Return a FleetResult.
 
         If `dry_run`, this logs the constructed `gcloud` command instead of
         running it, or if `verbose`, this logs the `gcloud` command before
@@ -217,26 +594,30 @@ class ComputeEngine(object):
 
         self._log_header('Setting metadata on', instance_names)
         if count <= 0:
-            return
+            return FleetResult('Set metadata')
 
         project = gcp.project()
         metadata_string = _join_metadata(metadata)
         options = {
             'project': project,
             'zone': gcp.zone(),
-            'metadata': metadata_string}
+            'metadata': metadata_string,
+            'quiet': None}
         options.update(command_options or {})
 
-        options_list = _options_list(options)
-        for name in instance_names:
-            cmd_tokens = ['gcloud', 'compute', 'instances', 'add-metadata', name
-                ] + options_list
+        commands = []
+        zones = self._zones_of(instance_names, project, options['zone'])
+        for zone, zone_names in sorted(zones.items()):
+            options_list = _options_list(dict(options, zone=zone))
+            commands.extend(
+                ([name],
+                 ['gcloud', 'compute', 'instances', 'add-metadata', name] + options_list,
+                 lambda out, err: ())
+                for name in zone_names)
 
-            if self.dry_run or self.verbose:
-                pprint(cmd_tokens)
-
-            if not self.dry_run:
-                subprocess.call(cmd_tokens)
+        result = self._run_batch('Set metadata', commands)
+        print(result.summary())
+        return result
 
 
 def cli():
@@ -258,6 +639,12 @@ def cli():
         const='quit-soon',
         help='Shorthand for `--set-metadata -m quit=soon`. Asks VMs to quit'
              ' soon, assuming they check this metadata field.')
+    group.add_argument('--autoscale', action='store_const', dest='action',
+        const='autoscale',
+        help='Keep creating and retiring Fireworker VMs (up to COUNT of them)'
+             ' to track the number of READY and RUNNING Fireworks in the'
+             ' LaunchPad db until the workflows are done. Retires VMs via'
+             ' `quit=when-idle` metadata.')
 
     parser.add_argument('name_prefix', metavar='NAME-PREFIX',
         help='The GCE VM name prefix for constructing a batch of VM names of the'
@@ -269,16 +656,48 @@ def cli():
              ' you create additional VMs with unique names.')
     parser.add_argument('-c', '--count', type=int, default=1,
         help='The number of VMs to create/delete/set (default=1).')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_MAX_WORKERS,
+        help='The max number of gcloud commands to run concurrently'
+             ' (default={}).'.format(DEFAULT_MAX_WORKERS))
+    parser.add_argument('--rate', type=float, default=DEFAULT_CREATE_RATE,
+        help='The max average rate of creating VMs, in VMs/second'
+             ' (default={}), to stay within the project\'s Compute Engine API'
+             ' rate limits.'.format(DEFAULT_CREATE_RATE))
+    parser.add_argument('--min', type=int, default=0, dest='min_workers',
+        help='Autoscale: the min number of VMs to keep while the workflows'
+             ' have pending work (default=0).')
+    parser.add_argument('--rockets-per-worker', type=int, default=1,
+        help='Autoscale: the number of READY + RUNNING Fireworks per VM'
+             ' (default=1).')
+    parser.add_argument('--budget', type=float, metavar='VM_HOURS',
+        help='Autoscale: after the VMs have run this many VM-hours, stop'
+             ' creating VMs and ask all of them to quit after their current'
+             ' rockets (default=no budget).')
+    parser.add_argument('--interval', type=float, default=60,
+        help='Autoscale: seconds between scaling steps (default=60).')
+    parser.add_argument('-z', '--fallback-zones', metavar='ZONE,...',
+        help='Comma-separated zones to create VMs in if the primary zone runs'
+             ' out of resources. When deleting or setting metadata, this makes'
+             ' it look up each VM\'s zone.')
     parser.add_argument('-f', '--family', default='fireworker',
         help='The GCE Disk image-family to create VMs from (default="fireworker").'
              ' (For "fireworker", be sure to also set the `db` metadata field'
              ' or read a LaunchPad file that has a `name` field.)')
+    parser.add_argument('-p', '--preemptible', action='store_true',
+        help='Create preemptible VMs, which cost much less but can get stopped'
+             ' at any time. Fireworkers will requeue the preempted Fireworks.')
     parser.add_argument('-l', dest='launchpad_filename',
         default=DEFAULT_LPAD_YAML,
         help='LaunchPad config YAML filename to read the db name, username,'
              ' and password metadata when creating VMs (default="{}"). This'
              ' will create GCE VMs which connect to that LaunchPad db.'
              ' Use `-l ""` to skip this config file.'.format(DEFAULT_LPAD_YAML))
+    parser.add_argument('--category',
+        help='The worker pool category for creating or autoscaling VMs: the'
+             ' Fireworkers will only run Fireworks with this spec `_category`,'
+             ' and autoscaling counts only those Fireworks. Use it with'
+             ' `-o machine-type=...` to size the machines for the pool. Sets'
+             ' the `category` metadata field.')
     parser.add_argument('-m', '--metadata', metavar='METADATA_KEY=VALUE,...',
         help='Comma-separated GCE metadata "KEY=VALUE" settings for creating VMs'
              ' or setting their metadata, e.g. "db=analyze" to point FireWorks'
@@ -293,20 +712,28 @@ def cli():
                  ' your current gcloud configuration.')
 
     args = parser.parse_args()
+    creating = args.action in ('create', 'autoscale')
     metadata = {}
+    lpad_config = {}  # type: Dict[str, Any]
+
+    if args.launchpad_filename and creating:
+        import ruamel.yaml as yaml
 
-    if args.launchpad_filename and args.action == 'create':
         with open(args.launchpad_filename) as f:
             lpad_config = yaml.safe_load(f)  # type: dict
             lpad_config['db'] = lpad_config.get('name')
         metadata = data.select_keys(lpad_config, ('db', 'username', 'password'))
 
+    if args.category:
+        metadata['category'] = args.category
     metadata.update(_parse_options(args.metadata))
     options = {}
-    if args.action == 'create':
+    if creating:
         if args.family:
             options['image-family'] = args.family
             options['description'] = args.family + ' worker'
+        if args.preemptible:
+            options.update(PREEMPTIBLE_OPTIONS)
         options.update(_parse_options(args.options))
 
     if args.action == 'quit-soon':
@@ -314,7 +741,7 @@ def cli():
         metadata['quit'] = 'soon'
 
     # Cross-check the args.
-    if args.action == 'create':
+    if creating:
         assert options.get('image-family'), (
             'need an image-family option to create workers')
         if args.family == 'fireworker':
@@ -323,15 +750,37 @@ def cli():
     elif args.action == 'metadata':
         assert metadata, 'need some metadata to set'
 
-    compute_engine = ComputeEngine(args.name_prefix, dry_run=args.dry_run)
+    fallback_zones = [z.strip() for z in (args.fallback_zones or '').split(',')
+                      if z.strip()]
+    compute_engine = ComputeEngine(
+        args.name_prefix, dry_run=args.dry_run, max_workers=args.jobs,
+        create_rate=args.rate, fallback_zones=fallback_zones)
+
+    if args.action == 'autoscale':
+        from fireworks import LaunchPad
+        from borealis.autoscaler import Autoscaler
+
+        lpad_config.update(data.select_keys(metadata, ('username', 'password')))
+        lpad_config['name'] = metadata.get('db')
+        launchpad = LaunchPad.from_dict(dict({'host': 'localhost'}, **lpad_config))
+        autoscaler = Autoscaler(
+            compute_engine, launchpad, min_workers=args.min_workers,
+            max_workers=args.count, rockets_per_worker=args.rockets_per_worker,
+            max_vm_hours=args.budget, interval=args.interval,
+            command_options=options, metadata=metadata)
+        autoscaler.run()
+        return
 
     if args.action == 'create':
-        compute_engine.create(args.base, args.count, command_options=options,
-                              **metadata)
+        result = compute_engine.create(
+            args.base, args.count, command_options=options, **metadata)
     elif args.action == 'delete':
-        compute_engine.delete(args.base, args.count)
-    elif args.action == 'metadata':
-        compute_engine.set_metadata(args.base, args.count, **metadata)
+        result = compute_engine.delete(args.base, args.count)
+    else:
+        result = compute_engine.set_metadata(args.base, args.count, **metadata)
+
+    if not result.ok:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
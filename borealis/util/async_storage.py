@@ -0,0 +1,687 @@
+"""An asyncio interface to Google Cloud Storage (GCS) for many concurrent
+transfers, e.g. hundreds of small objects in flight from one event loop, via
+the GCS JSON API and one shared aiohttp connection pool.
+
+This needs Python 3.5.3+ and the `aiohttp` package (`pip install
+borealis-fireworks[async]`). The blocking CloudStorage class in storage.py
+has the same operations and still runs on Python 2.7.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+from urllib.parse import quote
+import uuid
+import zlib
+
+import aiohttp
+import google.auth
+from google.auth.transport.requests import Request
+from google.api_core import exceptions as api_exceptions
+from google.cloud.exceptions import GoogleCloudError, NotFound, PreconditionFailed
+from google.cloud.storage import Blob, Bucket
+
+from borealis.util import data
+import borealis.util.filepath as fp
+import borealis.util.storage as st
+from borealis.util import transfer
+
+T = TypeVar('T')
+
+#: The GCS API endpoint, unless the STORAGE_EMULATOR_HOST environment variable
+#: names an emulator like the google-cloud-storage library supports.
+DEFAULT_ENDPOINT = 'https://storage.googleapis.com'
+
+#: The OAuth scope for reading and writing GCS objects.
+READ_WRITE_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
+
+#: The default limit on concurrent connections and transfers.
+DEFAULT_MAX_CONNECTIONS = 256
+
+#: Seconds to allow each HTTP request, not counting waiting for a connection.
+REQUEST_TIMEOUT = 300
+
+#: A download hands its file writes, gunzipping, and checksumming to a worker
+#: thread in batches of about this many bytes, keeping that work off the event
+#: loop without a thread hop per network read.
+WRITE_BATCH_SIZE = 256 * 1024
+
+#: Errors worth retrying besides the ones transfer.is_transient() accepts.
+TRANSIENT_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError)
+
+#: Errors that a transfer can end with after retrying.
+TRANSFER_ERRORS = transfer.TRANSFER_ERRORS + (aiohttp.ClientError,) + TRANSIENT_ERRORS
+
+
+def is_transient(error):
+    # type: (BaseException) -> bool
+    """Return True if the transfer error is worth retrying."""
+    return isinstance(error, TRANSIENT_ERRORS) or transfer.is_transient(error)
+
+
+async def with_retries(fn, stats, kind):
+    # type: (Callable[[], Awaitable[T]], transfer.RetryStats, str) -> T
+    """Await fn(), retrying transient errors with jittered exponential backoff
+    like transfer.with_retries() but without blocking the event loop. Count
+    the retries in stats as '{kind}_retries'.
+    """
+    attempt = 1
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt >= transfer.MAX_ATTEMPTS or not is_transient(e):
+                raise
+
+            stats.count(kind + '_retries')
+            if isinstance(e, transfer.ChecksumMismatch):
+                stats.count('checksum_mismatches')
+            delay = data.backoff(attempt, base=1.0, limit=32.0)
+            logging.warning('Retrying GCS %s in %.1f s after: %r', kind, delay, e)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _raise_for_status(response):
+    # type: (aiohttp.ClientResponse) -> None
+    """Raise the google.api_core exception for an HTTP error response, e.g.
+    NotFound for a 404, so callers handle the same errors as with
+    CloudStorage.
+    """
+    if response.status >= 400:
+        message = await response.text()
+        raise api_exceptions.from_http_status(
+            response.status, '{} {}: {}'.format(
+                response.method, response.url, message))
+
+
+def _read_file(path):
+    # type: (str) -> Tuple[bytes, Optional[str]]
+    """Return a file's contents and CRC32C checksum."""
+    with open(path, 'rb') as f:
+        payload = f.read()
+    crc = transfer.Crc32c()
+    crc.update(payload)
+    return payload, crc.b64digest()
+
+
+def _read_at(f, offset, size):
+    # type: (Any, int, int) -> bytes
+    """Read up to size bytes from the file at the given offset."""
+    f.seek(offset)
+    return f.read(size)
+
+
+def _object_metadata(full_path, content_type, content_encoding=None,
+                     custom=None):
+    # type: (str, str, Optional[str], Optional[Dict[str, str]]) -> Dict[str, Any]
+    """Return the JSON API object resource metadata for an upload."""
+    metadata = {'name': full_path, 'contentType': content_type}  # type: Dict[str, Any]
+    if content_encoding:
+        metadata['contentEncoding'] = content_encoding
+    if custom:
+        metadata['metadata'] = custom
+    return metadata
+
+
+def _multipart_body(metadata, payload, content_type):
+    # type: (Dict[str, Any], bytes, str) -> Tuple[bytes, str]
+    """Return the (body, content type) of a GCS multipart upload request."""
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        b'--', boundary.encode('ascii'), b'\r\n',
+        b'Content-Type: application/json; charset=UTF-8\r\n\r\n',
+        json.dumps(metadata).encode('utf-8'), b'\r\n',
+        b'--', boundary.encode('ascii'), b'\r\n',
+        b'Content-Type: ', content_type.encode('ascii'), b'\r\n\r\n',
+        payload, b'\r\n',
+        b'--', boundary.encode('ascii'), b'--'])
+    return body, 'multipart/related; boundary={}'.format(boundary)
+
+
+def _committed_bytes(response):
+    # type: (aiohttp.ClientResponse) -> int
+    """Return how many bytes a 308 resumable upload response says GCS has."""
+    range_header = response.headers.get('Range')  # like 'bytes=0-1234'
+    if not range_header:
+        return 0
+    return int(range_header.rsplit('-', 1)[1]) + 1
+
+
+class AsyncCloudStorage(object):
+    """An asyncio counterpart of CloudStorage, a higher level interface to a
+    GCS bucket. It uses the same storage names, directory placeholders, gzip
+    Content-Encoding, retry policy, and CRC32C checks, so either one can read
+    what the other wrote.
+
+    Use it as an async context manager, which opens the HTTP connection pool
+    and checks that the bucket exists:
+
+        async with AsyncCloudStorage('my-bucket/sim/') as gcs:
+            blobs = await gcs.list_blobs('out/')
+            await gcs.download_blobs(blobs, '/tmp/sim')
+
+    The coroutines are safe to run concurrently on one event loop. The pool
+    limits the number of open connections, and the tree operations limit the
+    number of transfers in flight, to `max_connections`.
+
+    See CloudStorage about the GCS access permissions this needs.
+    """
+
+    def __init__(self, storage_prefix, session=None, credentials=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, endpoint=None):
+        # type: (str, Optional[aiohttp.ClientSession], Any, int, Optional[str]) -> None
+        """Construct a GCS accessor with the given storage_prefix like
+        CloudStorage().
+
+        `session` is an optional aiohttp ClientSession to share. It must be
+        made with `auto_decompress=False` so gzip-encoded Blobs download
+        compressed. The default is a new session with a pool of
+        `max_connections` connections, closed by close().
+
+        `credentials` are optional google.auth credentials. The default is the
+        application default credentials, or none for an emulator.
+
+        `endpoint` is the GCS API URL, defaulting to the STORAGE_EMULATOR_HOST
+        environment variable or DEFAULT_ENDPOINT.
+        """
+        self.bucket_name, self.path_prefix = st.bucket_path(storage_prefix)
+        self.path_prefix = os.path.join(self.path_prefix, '')
+        if len(self.bucket_name) < 3:
+            raise ValueError("Invalid bucket name: '{}'".format(self.bucket_name))
+
+        emulator = os.environ.get('STORAGE_EMULATOR_HOST')
+        self.endpoint = (endpoint or emulator or DEFAULT_ENDPOINT).rstrip('/')
+        if credentials is None and not emulator:
+            credentials, _ = google.auth.default(scopes=[READ_WRITE_SCOPE])
+        self.credentials = credentials
+
+        self.max_connections = max_connections
+        self.session = session
+        self._own_session = session is None
+
+        #: A Bucket to parent the Blobs this returns. It has no Client.
+        self.bucket = Bucket(None, self.bucket_name)
+
+        #: A cache of directory placeholders already created or verified.
+        self._directory_cache = set()  # type: Set[str]
+
+        #: Counts of transfer retries, resumed uploads, and checksum
+        #: mismatches, to show how degraded storage access is.
+        self.stats = transfer.RetryStats()
+
+        self._auth_lock = None  # type: Optional[asyncio.Lock]
+        self._slots = None  # type: Optional[asyncio.Semaphore]
+
+    async def open(self):
+        # type: () -> None
+        """Open the HTTP connection pool (if not given a session) and check the
+        bucket. Raise google.api_core.exceptions.NotFound if it doesn't exist.
+        """
+        self._auth_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(self.max_connections)
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(sock_read=REQUEST_TIMEOUT),
+                auto_decompress=False)
+
+        url = '{}/storage/v1/b/{}'.format(self.endpoint, quote(self.bucket_name))
+        await with_retries(
+            lambda: self._request('GET', url, params={'fields': 'name'}),
+            self.stats, 'list')
+
+    async def close(self):
+        # type: () -> None
+        """Close the HTTP connection pool if this opened it."""
+        if self._own_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def clear_directory_cache(self):
+        # type: () -> None
+        """Clear the cache of directory placeholder names already created."""
+        self._directory_cache = set()
+
+    async def _auth_headers(self):
+        # type: () -> Dict[str, str]
+        """Return the request authorization headers, refreshing the access
+        token in a worker thread if it expired.
+        """
+        headers = {}  # type: Dict[str, str]
+        if self.credentials is None:
+            return headers
+
+        if not self.credentials.valid:
+            async with self._auth_lock:
+                if not self.credentials.valid:
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(
+                        None, self.credentials.refresh, Request())
+
+        self.credentials.apply(headers)
+        return headers
+
+    async def _request(self, method, url, params=None, headers=None, body=None):
+        # type: (str, str, Optional[Dict[str, Any]], Optional[Dict[str, str]], Any) -> Dict[str, Any]
+        """Make a JSON API request and return its JSON response, if any. Raise
+        a google.api_core exception for an HTTP error.
+        """
+        all_headers = await self._auth_headers()
+        all_headers.update(headers or {})
+
+        async with self.session.request(
+                method, url, params=params, headers=all_headers, data=body) as response:
+            await _raise_for_status(response)
+            text = await response.text()
+            return json.loads(text) if text else {}
+
+    def _object_url(self, full_path, api='storage'):
+        # type: (str, str) -> str
+        return '{}/{}/v1/b/{}/o/{}'.format(
+            self.endpoint, api, quote(self.bucket_name), quote(full_path, safe=''))
+
+    def _blob(self, resource):
+        # type: (Dict[str, Any]) -> Blob
+        """Return a Blob with the given JSON API object resource."""
+        blob = Blob(resource['name'], self.bucket)
+        blob._set_properties(resource)
+        return blob
+
+    async def list_blobs(self, prefix=''):
+        # type: (str) -> List[Blob]
+        """List Blobs with the given prefix string (which needn't be a
+        "directory" name, and it's relative to the storage_prefix), requesting a
+        subset of fields for efficiency. Return a list of Blobs.
+        """
+        url = '{}/storage/v1/b/{}/o'.format(self.endpoint, quote(self.bucket_name))
+        params = {
+            'prefix': os.path.join(self.path_prefix, prefix),
+            'fields': st.CloudStorage.FIELDS}
+        blobs = []  # type: List[Blob]
+
+        while True:
+            page = await with_retries(
+                lambda: self._request('GET', url, params=dict(params)),
+                self.stats, 'list')
+            blobs.extend(self._blob(item) for item in page.get('items', ()))
+
+            if not page.get('nextPageToken'):
+                return blobs
+            params['pageToken'] = page['nextPageToken']
+
+    async def make_dirs(self, sub_path):
+        # type: (str) -> None
+        """Make sub_path's directory placeholders if they don't exist, like
+        CloudStorage.make_dirs(), concurrently.
+        """
+        parts = os.path.join(self.path_prefix, sub_path).split(os.sep)[:-1]
+        dir_name = ''
+        new_dirs = []
+
+        for subdir in parts:
+            dir_name = os.path.join(dir_name, subdir, '')
+            if dir_name not in self._directory_cache:
+                self._directory_cache.add(dir_name)
+                new_dirs.append(dir_name)
+
+        await asyncio.gather(*[self._make_dir(name) for name in new_dirs])
+
+    async def _make_dir(self, dir_name):
+        # type: (str) -> None
+        try:
+            # ifGenerationMatch=0: upload if absent, fail if present.
+            await with_retries(
+                lambda: self._upload_bytes(
+                    dir_name, b'', st.OCTET_STREAM, if_generation_match=0),
+                self.stats, 'upload')
+        except PreconditionFailed:  # the blob is already present
+            pass
+        except TRANSFER_ERRORS:
+            # Failing to create a dir placeholder will affect gcsfuse mounts
+            # but won't break the workflow.
+            logging.exception('Failed to make GCS dir "%s"', dir_name)
+
+    async def _upload_bytes(self, full_path, payload, content_type,
+                            content_encoding=None, crc32c=None,
+                            if_generation_match=None, custom=None):
+        # type: (str, bytes, str, Optional[str], Optional[str], Optional[int], Optional[Dict[str, str]]) -> Dict[str, Any]
+        """Upload the payload as the named object in one multipart request,
+        with optional `custom` metadata. Return the object's resource dict.
+        """
+        metadata = _object_metadata(full_path, content_type, content_encoding, custom)
+        if crc32c:
+            metadata['crc32c'] = crc32c  # GCS rejects the upload if it differs
+        params = {'uploadType': 'multipart'}  # type: Dict[str, Any]
+        if if_generation_match is not None:
+            params['ifGenerationMatch'] = str(if_generation_match)
+
+        body, body_type = _multipart_body(metadata, payload, content_type)
+        url = '{}/upload/storage/v1/b/{}/o'.format(
+            self.endpoint, quote(self.bucket_name))
+        return await self._request(
+            'POST', url, params=params, headers={'Content-Type': body_type},
+            body=body)
+
+    async def upload_file(self, local_path, sub_path, compress=False):
+        # type: (str, str, bool) -> bool
+        """Upload the file named local_path as (not into) the given GCS sub_path
+        (which is relative to the storage_prefix), gzipping it on the way if
+        `compress`, like CloudStorage.upload_file().
+
+        Return True if successful. Logs exceptions.
+        """
+        return await self._upload_file(local_path, sub_path, compress) is not None
+
+    async def _upload_file(self, local_path, sub_path, compress=False):
+        # type: (str, str, bool) -> Optional[Blob]
+        """Upload a file like upload_file(). Return the uploaded Blob with its
+        metadata, or None if it failed.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        file_type = st.content_type(local_path)
+        loop = asyncio.get_event_loop()
+
+        try:
+            await self.make_dirs(sub_path)
+
+            if not compress:
+                return await self._upload_from_filename(full_path, local_path, file_type)
+
+            temp_path = await loop.run_in_executor(None, st.gzip_to_temp, local_path)
+            custom = {st.UNCOMPRESSED_SIZE: str(os.path.getsize(local_path))}
+            try:
+                return await self._upload_from_filename(
+                    full_path, temp_path, file_type, st.GZIP, custom)
+            finally:
+                os.remove(temp_path)
+        except (GoogleCloudError, OSError) + TRANSFER_ERRORS:
+            logging.exception(
+                'Failed to upload "%s" as GCS "%s"', local_path, full_path)
+            return None
+
+    async def _upload_from_filename(self, full_path, path, content_type,
+                                    content_encoding=None, custom=None):
+        # type: (str, str, str, Optional[str], Optional[Dict[str, str]]) -> Blob
+        """Upload a file with retries, in resumable chunks if it's big, then
+        verify the Blob's CRC32C. `custom` is optional custom metadata.
+        """
+        size = os.path.getsize(path)
+        loop = asyncio.get_event_loop()
+
+        if size > transfer.RESUMABLE_THRESHOLD:
+            expected = await loop.run_in_executor(None, transfer.file_crc32c, path)
+
+            async def upload():
+                resource = await self._resumable_upload(
+                    full_path, path, size, content_type, content_encoding, custom)
+                blob = self._blob(resource)
+                transfer.verify(blob, expected)
+                return blob
+        else:
+            payload, expected = await loop.run_in_executor(None, _read_file, path)
+
+            async def upload():
+                resource = await self._upload_bytes(
+                    full_path, payload, content_type, content_encoding, expected,
+                    custom=custom)
+                blob = self._blob(resource)
+                transfer.verify(blob, expected)
+                return blob
+
+        return await with_retries(upload, self.stats, 'upload')
+
+    async def _resumable_upload(self, full_path, path, size, content_type,
+                                content_encoding=None, custom=None):
+        # type: (str, str, int, str, Optional[str], Optional[Dict[str, str]]) -> Dict[str, Any]
+        """Upload the file in resumable chunks like transfer.resumable_upload(),
+        recovering from a failed chunk by asking GCS for the last committed
+        byte and continuing from there. Return the object's resource dict.
+        """
+        metadata = _object_metadata(full_path, content_type, content_encoding, custom)
+        url = '{}/upload/storage/v1/b/{}/o'.format(
+            self.endpoint, quote(self.bucket_name))
+
+        async def initiate():
+            headers = await self._auth_headers()
+            headers.update({
+                'Content-Type': 'application/json; charset=UTF-8',
+                'X-Upload-Content-Type': content_type,
+                'X-Upload-Content-Length': str(size)})
+            async with self.session.post(
+                    url, params={'uploadType': 'resumable'}, headers=headers,
+                    data=json.dumps(metadata)) as response:
+                await _raise_for_status(response)
+                return response.headers['Location']
+
+        session_url = await with_retries(initiate, self.stats, 'upload')
+
+        async def put(headers, body=b''):
+            # type: (Dict[str, str], bytes) -> Tuple[int, Optional[Dict[str, Any]]]
+            """PUT to the upload session. Return (committed byte count, resource
+            dict if the upload finished).
+            """
+            all_headers = await self._auth_headers()
+            all_headers.update(headers)
+            async with self.session.put(
+                    session_url, headers=all_headers, data=body,
+                    allow_redirects=False) as response:
+                if response.status == 308:
+                    return _committed_bytes(response), None
+                await _raise_for_status(response)
+                return size, json.loads(await response.text())
+
+        loop = asyncio.get_event_loop()
+        offset = 0
+        failures = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = await loop.run_in_executor(
+                    None, _read_at, f, offset, transfer.RESUMABLE_CHUNK_SIZE)
+                end = offset + len(chunk) - 1
+                content_range = ('bytes {}-{}/{}'.format(offset, end, size)
+                                 if chunk else 'bytes */{}'.format(size))
+
+                try:
+                    offset, resource = await put({'Content-Range': content_range}, chunk)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if failures >= transfer.MAX_ATTEMPTS or not is_transient(e):
+                        raise
+
+                    self.stats.count('upload_resumes')
+                    delay = data.backoff(failures, base=1.0, limit=32.0)
+                    logging.warning(
+                        'Resuming the GCS upload of "%s" in %.1f s after: %r',
+                        full_path, delay, e)
+                    await asyncio.sleep(delay)
+
+                    offset, resource = await with_retries(
+                        lambda: put({'Content-Range': 'bytes */{}'.format(size)}),
+                        self.stats, 'upload')
+
+                if resource is not None:
+                    return resource
+
+    async def upload_tree(self, local_path, sub_path, compress=(), uploaded=None):
+        # type: (str, str, Iterable[str], Optional[List[Blob]]) -> bool
+        """Upload a file or a directory tree as (not into) the given GCS
+        sub_path (which is relative to the storage_prefix), concurrently,
+        compressing the files whose names match any of the fnmatch-style
+        `compress` patterns, like CloudStorage.upload_tree().
+
+        If `uploaded` is a list, append the uploaded file Blobs to it.
+
+        Return True if successful. Logs exceptions.
+        """
+        if not st.names_a_directory(sub_path):
+            pairs = [(local_path, sub_path)]
+        else:
+            pairs = []
+            local_abs = os.path.abspath(local_path)
+            for dirpath, dirnames, filenames in os.walk(local_path):
+                local_rel_path = os.path.relpath(os.path.abspath(dirpath), local_abs)
+                if local_rel_path == '.':
+                    local_rel_path = ''
+                storage_subdir = os.path.join(sub_path, local_rel_path)
+                pairs.extend(
+                    (os.path.join(dirpath, filename),
+                     os.path.join(storage_subdir, filename))
+                    for filename in filenames)
+
+        async def upload(path, storage_path):
+            async with self._slots:
+                return await self._upload_file(
+                    path, storage_path, st.should_compress(path, compress))
+
+        blobs = await asyncio.gather(*[upload(*pair) for pair in pairs])
+        if uploaded is not None:
+            uploaded.extend(blob for blob in blobs if blob is not None)
+        return all(blob is not None for blob in blobs)
+
+    async def download_blob(self, blob, local_path):
+        # type: (Blob, str) -> bool
+        """Download a Blob from GCS as (not into) local_path, making directories
+        if needed, like CloudStorage.download_blob(): A gzip-encoded Blob
+        transfers compressed and decompresses as it streams to the file, and
+        the download gets verified against the Blob's CRC32C, if known.
+
+        Return True if successful. Logs exceptions.
+        """
+        if st.names_a_directory(local_path):
+            fp.makedirs(local_path)
+            return True
+
+        fp.makedirs(os.path.dirname(local_path))
+
+        try:
+            await with_retries(
+                lambda: self._download(blob, local_path), self.stats, 'download')
+        except (GoogleCloudError, zlib.error, IOError, OSError) + TRANSFER_ERRORS:
+            logging.exception(
+                'Failed to download GCS "%s" as "%s"', blob.name, local_path)
+            return False
+
+        return True
+
+    async def _download(self, blob, local_path):
+        # type: (Blob, str) -> None
+        """Download the Blob to local_path once, decompressing it if it's
+        gzip-encoded (per its metadata, like CloudStorage._download(), since
+        servers needn't send a Content-Encoding header for the stored bytes)
+        and verifying its CRC32C if known.
+
+        The file writes, gunzipping, and checksumming run in the executor in
+        batches of WRITE_BATCH_SIZE to keep them off the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        gzipped = blob.content_encoding == st.GZIP
+        params = {'alt': 'media'}
+        if blob.generation:
+            params['generation'] = str(blob.generation)
+        headers = await self._auth_headers()
+        headers['Accept-Encoding'] = st.GZIP
+
+        async with self.session.get(
+                self._object_url(blob.name, 'download/storage'), params=params,
+                headers=headers) as response:
+            await _raise_for_status(response)
+
+            f = await loop.run_in_executor(None, open, local_path, 'wb')
+            try:
+                gunzip = st._GunzipWriter(f) if gzipped else None
+                writer = transfer.ChecksumWriter(gunzip or f)
+                batch = []  # type: List[bytes]
+                batch_size = 0
+
+                async for chunk in response.content.iter_chunked(st.CHUNK_SIZE):
+                    batch.append(chunk)
+                    batch_size += len(chunk)
+                    if batch_size >= WRITE_BATCH_SIZE:
+                        await loop.run_in_executor(None, writer.write, b''.join(batch))
+                        batch, batch_size = [], 0
+                if batch:
+                    await loop.run_in_executor(None, writer.write, b''.join(batch))
+
+                # Check the stored (compressed) bytes before finishing the gunzip.
+                transfer.verify(blob, writer.crc32c.b64digest())
+                if gunzip:
+                    await loop.run_in_executor(None, gunzip.close)
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+    async def download_file(self, sub_path, local_path):
+        # type: (str, str) -> bool
+        """Download the GCS file named sub_path (relative to the storage_prefix)
+        as (not into) the local_path, making local directories if needed.
+
+        This fetches the Blob's metadata first to get its Content-Encoding and
+        CRC32C.
+
+        Return True if successful. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+
+        try:
+            resource = await with_retries(
+                lambda: self._request('GET', self._object_url(full_path)),
+                self.stats, 'download')
+        except NotFound:
+            logging.error('GCS "%s" not found', full_path)
+            return False
+        except (GoogleCloudError,) + TRANSFER_ERRORS:
+            logging.exception('Failed to get GCS "%s"', full_path)
+            return False
+
+        return await self.download_blob(self._blob(resource), local_path)
+
+    async def download_tree(self, sub_path, local_prefix):
+        # type: (str, str) -> bool
+        """Download all files and directories that begin with the sub_path
+        prefix (within the storage_prefix) to their same relative paths in
+        local_prefix, concurrently, making directories if needed.
+
+        Return True if successful. Logs exceptions.
+        """
+        if not st.names_a_directory(sub_path):
+            local_path = os.path.join(local_prefix, sub_path)
+            return await self.download_file(sub_path, local_path)
+
+        try:
+            blobs = await self.list_blobs(sub_path)
+        except (GoogleCloudError,) + TRANSFER_ERRORS:
+            logging.exception('Failed to list GCS "%s"',
+                              os.path.join(self.path_prefix, sub_path))
+            return False
+
+        return await self.download_blobs(blobs, local_prefix)
+
+    async def download_blobs(self, blobs, local_prefix):
+        # type: (Iterable[Blob], str) -> bool
+        """Download Blobs concurrently to their same relative paths (within the
+        storage_prefix) in local_prefix.
+
+        Return True if successful. Logs exceptions.
+        """
+        async def download(blob):
+            local_rel_path = st.relpath(blob.name, self.path_prefix)
+            async with self._slots:
+                return await self.download_blob(
+                    blob, os.path.join(local_prefix, local_rel_path))
+
+        results = await asyncio.gather(*[download(blob) for blob in blobs])
+        return all(results)
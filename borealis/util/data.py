@@ -3,6 +3,7 @@
 from __future__ import absolute_import, division, print_function
 
 import datetime
+import random
 from typing import Any, Dict, Iterable, Mapping, Optional
 
 
@@ -25,6 +26,16 @@ def timestamp(dt=None):
     return dt.strftime('%Y%m%d.%H%M%S')
 
 
+def backoff(attempt, base=4.0, limit=60.0):
+    # type: (int, float, float) -> float
+    """Return a jittered exponential backoff delay in seconds for the given
+    retry attempt number (1, 2, ...): `base` seconds for the first attempt,
+    doubling with each attempt up to `limit`, then scaled by a random factor
+    in [0.5, 1.0] so concurrent retriers spread out.
+    """
+    return random.uniform(0.5, 1.0) * min(limit, base * 2 ** (attempt - 1))
+
+
 def format_duration(seconds):
     # type: (float) -> str
     """Format a time duration from seconds to [days] HH:MM:SS. No microseconds."""
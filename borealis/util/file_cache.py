@@ -0,0 +1,170 @@
+"""A bounded local cache of files downloaded from or uploaded to storage, so a
+worker can give later DockerTasks the same input files, including an earlier
+task's outputs, without downloading them again.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+import logging
+import os
+import shutil
+from threading import Lock
+from typing import Any, Iterable, List, Tuple
+import uuid
+
+import borealis.util.filepath as fp
+from borealis.util.local_storage import TEMP_PREFIX, copy_file
+from borealis.util import metrics
+import borealis.util.storage as st
+
+
+#: The default cache directory. It's outside DockerTask.STAGING_DIRS, which
+#: DockerTask wipes after each task.
+DEFAULT_CACHE_DIR = os.path.join(os.sep, 'tmp', 'fireworker-cache')
+
+#: Input cache traffic, for the Fireworker's metrics endpoint.
+CACHE_FILES = metrics.counter(
+    'borealis_input_cache_files_total',
+    'Input files found in (hit) or missing from (miss) the input cache.',
+    ['result'])
+CACHE_BYTES = metrics.counter(
+    'borealis_input_cache_hit_bytes_total', 'Input bytes copied from the cache.')
+
+
+class FileCache(object):
+    """A least-recently-used cache of downloaded storage files in a local
+    directory, keyed by (bucket, blob name) and valid for one Blob generation.
+
+    The index of cached generations lives in memory, so the constructor clears
+    out any files that a previous process left in the directory. Transfers copy
+    files (via reflinks where the file system supports them) rather than
+    hard-linking them since DockerTasks can modify their input files.
+    This is thread-safe.
+    """
+
+    def __init__(self, max_bytes, cache_dir=DEFAULT_CACHE_DIR):
+        # type: (int, str) -> None
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.total_bytes = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()  # type: OrderedDict  # key -> (generation, size)
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        fp.makedirs(cache_dir)
+
+    def _path(self, bucket, name):
+        # type: (str, str) -> str
+        return os.path.join(self.cache_dir, bucket.strip(os.sep), name)
+
+    def _lookup(self, key, generation):
+        # type: (Tuple[str, str], Any) -> bool
+        """Return True if the cache has this generation, marking it as
+        recently used.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self._entries[key] = entry
+            return entry[0] == generation
+
+    def _forget(self, key):
+        # type: (Tuple[str, str]) -> None
+        """Forget a cache entry, e.g. one whose file went missing."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def fetch(self, bucket, blob, local_path):
+        # type: (str, Any, str) -> bool
+        """Copy the cached file for the Blob's generation to local_path.
+        Return True if it was in the cache.
+        """
+        key = (bucket, blob.name)
+        if not self._lookup(key, blob.generation):
+            CACHE_FILES.labels('miss').inc()
+            return False
+
+        try:
+            fp.makedirs(os.path.dirname(local_path))
+            copy_file(self._path(bucket, blob.name), local_path)
+        except (IOError, OSError) as e:  # e.g. evicted meanwhile
+            logging.debug('Input cache miss on "%s": %r', blob.name, e)
+            self._forget(key)
+            CACHE_FILES.labels('miss').inc()
+            return False
+
+        CACHE_FILES.labels('hit').inc()
+        CACHE_BYTES.inc(os.path.getsize(local_path))
+        return True
+
+    def store(self, bucket, blob, local_path):
+        # type: (str, Any, str) -> None
+        """Add a copy of the Blob's downloaded or uploaded file at local_path to
+        the cache, evicting the least recently used files to stay within
+        max_bytes. Log rather than raise errors since caching is an
+        optimization.
+        """
+        key = (bucket, blob.name)
+        path = self._path(bucket, blob.name)
+
+        try:
+            size = os.path.getsize(local_path)
+            if size > self.max_bytes:
+                return
+
+            self._forget(key)
+            fp.makedirs(os.path.dirname(path))
+            temp_path = os.path.join(
+                os.path.dirname(path), TEMP_PREFIX + uuid.uuid4().hex)
+            copy_file(local_path, temp_path)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning('Failed to cache the file "%s": %r', blob.name, e)
+            return
+
+        with self._lock:
+            self._entries[key] = (blob.generation, size)
+            self.total_bytes += size
+            evicted = []  # type: List[Tuple[str, str]]
+            while self.total_bytes > self.max_bytes:
+                old_key, (_, old_size) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(self._path(*old_key))
+            except OSError:
+                pass
+
+    def fetch_tree(self, storage, blobs, local_prefix):
+        # type: (st.StorageBackend, Iterable[Any], str) -> List[Any]
+        """Copy the cached files of the `blobs` listed in the storage backend
+        to their same relative paths (within the storage_prefix) in
+        local_prefix, like storage.download_blobs(). Return the Blobs that
+        weren't in the cache, including any directory placeholders.
+        """
+        return [blob for blob in blobs
+                if st.names_a_directory(blob.name)
+                or not self.fetch(storage.bucket_name, blob,
+                                  self.local_path(storage, blob, local_prefix))]
+
+    def store_tree(self, storage, blobs, local_prefix):
+        # type: (st.StorageBackend, Iterable[Any], str) -> None
+        """Cache the downloaded or uploaded files of the `blobs` in
+        local_prefix.
+        """
+        for blob in blobs:
+            if not st.names_a_directory(blob.name):
+                self.store(storage.bucket_name, blob,
+                           self.local_path(storage, blob, local_prefix))
+
+    @staticmethod
+    def local_path(storage, blob, local_prefix):
+        # type: (st.StorageBackend, Any, str) -> str
+        """Return the local path in local_prefix to download the Blob to."""
+        return os.path.join(local_prefix, st.relpath(blob.name, storage.path_prefix))
@@ -0,0 +1,533 @@
+"""A storage backend on a local or shared (e.g. NFS) file system, for workers
+that don't need an object store, and for running and benchmarking DockerTasks
+without GCS.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import namedtuple
+import errno
+import logging
+import os
+import shutil
+import tarfile
+from typing import Any, Iterable, Iterator, List, Optional
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+import borealis.util.filepath as fp
+import borealis.util.storage as st
+from borealis.util import transfer
+
+
+#: The Linux ioctl request to clone a file's data copy-on-write (a "reflink"),
+#: supported by btrfs, XFS, and some NFS servers.
+FICLONE = 0x40049409
+
+#: Bytes per os.copy_file_range() call.
+COPY_RANGE_SIZE = 64 * 1024 * 1024
+
+#: The filename prefix of files being written, to rename into place when done.
+TEMP_PREFIX = '.borealis-tmp-'
+
+#: copy_file_range() errors that mean "copy it another way".
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+#: A stored file or directory, like a GCS Blob from a listing. `name` is its
+#: path relative to the storage root, ending with '/' for a directory.
+#: `generation` is its modification time in nanoseconds.
+LocalBlob = namedtuple('LocalBlob', 'name size generation crc32c content_encoding')
+
+
+def _generation(stat):
+    # type: (os.stat_result) -> int
+    """Return a file's "generation": its modification time in nanoseconds."""
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)  # not in Python 2
+    return mtime_ns if mtime_ns is not None else int(stat.st_mtime * 1e9)
+
+
+def _copy_range(src_fd, dst_fd, size):
+    # type: (int, int, int) -> None
+    """Copy size bytes with os.copy_file_range(), which copies within the
+    kernel or even within an NFS 4.2 server. Raise OSError if unsupported.
+    """
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(
+            src_fd, dst_fd, min(COPY_RANGE_SIZE, size - offset), offset, offset)
+        if not copied:
+            break
+        offset += copied
+
+
+def copy_file(src, dst):
+    # type: (str, str) -> None
+    """Copy the file src to dst with the cheapest method the file systems
+    support: a copy-on-write reflink clone, else os.copy_file_range(), else
+    shutil.copyfile().
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except (IOError, OSError):
+                pass
+
+        if hasattr(os, 'copy_file_range'):  # Python 3.8+ on Linux
+            try:
+                _copy_range(fsrc.fileno(), fdst.fileno(),
+                            os.fstat(fsrc.fileno()).st_size)
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                fdst.truncate(0)
+
+    shutil.copyfile(src, dst)
+
+
+class LocalStorage(st.StorageBackend):
+    """A storage backend in a directory on a local or shared file system, e.g.
+    for off-GCE workers that share an NFS volume. Select it in DockerTask with
+    a 'file://' storage_prefix such as 'file:///mnt/nfs/sim/'.
+
+    Transfers copy files with reflinks or copy_file_range() where the file
+    systems support them, so they needn't pass the data through this process.
+    Writes go to temp files that get renamed into place, so readers never see
+    partial files.
+
+    This stores files as-is: It ignores the `compress` option since gzipping
+    would cost more than it saves on a file system, and it doesn't compute
+    CRC32C checksums. A Blob's "generation" is its file's modification time.
+    """
+
+    def __init__(self, root_prefix, hard_links=False):
+        # type: (str, bool) -> None
+        """Construct a storage accessor for the root_prefix directory, an
+        absolute path (without the 'file://' scheme), e.g. '/mnt/nfs/sim/'.
+        All operations are relative to this prefix.
+
+        If `hard_links`, transfer files by hard-linking them when they're on
+        the same file system. That's the cheapest but the local and stored
+        files then share their data, so only use it if no one will modify
+        files in place, e.g. a task rewriting its inputs or checkpointed
+        outputs.
+
+        Raise ValueError if the path isn't absolute or isn't a directory.
+        """
+        if not os.path.isabs(root_prefix):
+            raise ValueError("Storage path isn't absolute: '{}'".format(root_prefix))
+        if not os.path.isdir(root_prefix):
+            raise ValueError("Storage directory doesn't exist: '{}'".format(root_prefix))
+
+        # Like CloudStorage, the "bucket" is the file system root and blob
+        # names are paths within it.
+        self.root = os.sep
+        self.bucket_name = self.root
+        rel_path = os.path.relpath(root_prefix, self.root)
+        self.path_prefix = '' if rel_path == os.curdir else os.path.join(rel_path, '')
+        self.hard_links = hard_links
+
+        #: Counts of transfer events, for the StorageBackend interface. Local
+        #: transfers don't retry.
+        self.stats = transfer.RetryStats()
+
+    def _full_path(self, name):
+        # type: (str) -> str
+        """Return the file system path of a blob name."""
+        return os.path.join(self.root, name)
+
+    def _blob(self, name):
+        # type: (str) -> LocalBlob
+        """Return a LocalBlob with the named file's current metadata."""
+        stat = os.stat(self._full_path(name))
+        size = 0 if st.names_a_directory(name) else stat.st_size
+        return LocalBlob(name, size, _generation(stat), None, None)
+
+    def list_blobs(self, prefix=''):
+        # type: (str) -> Iterator[LocalBlob]
+        """List the files and directories whose paths start with the given
+        prefix string (which needn't be a "directory" name, and it's relative
+        to the storage_prefix), in name order. Directory Blob names end with
+        '/'.
+        """
+        name_prefix = os.path.join(self.path_prefix, prefix)
+        top = os.path.dirname(name_prefix)
+        full_top = self._full_path(top)
+
+        for dirpath, dirnames, filenames in os.walk(full_top):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, self.root)
+            names = sorted(
+                [os.path.join(rel_dir, d, '') for d in dirnames]
+                + [os.path.join(rel_dir, f) for f in filenames
+                   if not f.startswith(TEMP_PREFIX)])
+
+            for name in names:
+                if name.startswith(name_prefix):
+                    try:
+                        yield self._blob(name)
+                    except OSError:  # it was just deleted
+                        pass
+
+            # Skip sub-directories that can't contain matches.
+            dirnames[:] = [
+                d for d in dirnames
+                if os.path.join(rel_dir, d, '').startswith(name_prefix)
+                or name_prefix.startswith(os.path.join(rel_dir, d, ''))]
+
+    def list_files(self, sub_path, use_manifest=False):
+        # type: (str, bool) -> List[LocalBlob]
+        """List the Blobs that download_tree(sub_path, ...) would download, like
+        CloudStorage.list_files().
+        """
+        if not st.names_a_directory(sub_path):
+            full_path = os.path.join(self.path_prefix, sub_path)
+            return [blob for blob in self.list_blobs(sub_path)
+                    if blob.name == full_path]
+
+        blobs = self.read_manifest(sub_path) if use_manifest else None
+        if blobs is None:
+            blobs = list(self.list_blobs(sub_path))
+        return blobs
+
+    def write_manifest(self, sub_path, blobs):
+        # type: (str, Iterable[LocalBlob]) -> bool
+        """Write a manifest file for the sub_path directory tree like
+        CloudStorage.write_manifest().
+
+        Return True if successful. Logs exceptions.
+        """
+        tree_path = os.path.join(self.path_prefix, sub_path)
+        name = os.path.join(self.path_prefix, st.manifest_name(sub_path))
+
+        try:
+            self._write(name, lambda f: f.write(
+                st.manifest_json(tree_path, blobs).encode('utf-8')))
+        except (IOError, OSError):
+            logging.exception('Failed to write the manifest "%s"', name)
+            return False
+        return True
+
+    def read_manifest(self, sub_path):
+        # type: (str) -> Optional[List[LocalBlob]]
+        """Read the manifest file for the sub_path directory tree, returning its
+        list of Blobs, or None if there's no usable manifest.
+        """
+        tree_path = os.path.join(self.path_prefix, sub_path)
+        full_path = self._full_path(
+            os.path.join(self.path_prefix, st.manifest_name(sub_path)))
+
+        if not os.path.exists(full_path):
+            return None
+        try:
+            with open(full_path, 'rb') as f:
+                files = st.parse_manifest(f.read())
+        except (IOError, OSError, ValueError, KeyError):
+            logging.exception('Failed to read the manifest "%s"', full_path)
+            return None
+
+        return [self.pinned_blob(
+                    os.path.join(tree_path, entry['name']), entry['size'],
+                    entry['generation'], entry.get('crc32c'), entry.get('encoding'))
+                for entry in files]
+
+    def pinned_blob(self, name, size, generation, crc32c=None, encoding=None):
+        # type: (str, int, int, Optional[str], Optional[str]) -> LocalBlob
+        """Return a Blob for the full blob name with the given metadata.
+        Downloading it fails if the file's generation changed.
+        """
+        return LocalBlob(name, size, generation, crc32c, encoding)
+
+    def make_dirs(self, sub_path):
+        # type: (str) -> None
+        """Make sub_path's parent directories if they don't exist."""
+        fp.makedirs(os.path.dirname(
+            self._full_path(os.path.join(self.path_prefix, sub_path))))
+
+    def _transfer(self, src, dst):
+        # type: (str, str) -> None
+        """Copy or hard-link the file src to a new file dst."""
+        if self.hard_links:
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        copy_file(src, dst)
+
+    def _write(self, name, writer):
+        # type: (str, Any) -> None
+        """Call writer(file) to write the named stored file."""
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                writer(f)
+
+        self._replace(name, write)
+
+    def _store(self, local_path, name):
+        # type: (str, str) -> None
+        """Copy or hard-link the local file to the named stored file."""
+        self._replace(name, lambda temp_path: self._transfer(local_path, temp_path))
+
+    def _replace(self, name, make):
+        # type: (str, Any) -> None
+        """Call make(temp_path) to make a temp file in the named stored file's
+        directory, then rename it into place.
+        """
+        full_path = self._full_path(name)
+        fp.makedirs(os.path.dirname(full_path))
+        temp_path = os.path.join(
+            os.path.dirname(full_path), TEMP_PREFIX + uuid.uuid4().hex)
+
+        try:
+            make(temp_path)
+            os.rename(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def upload_file(self, local_path, sub_path, compress=False):
+        # type: (str, str, bool) -> bool
+        """Store the file named local_path as (not into) sub_path. This ignores
+        `compress`.
+
+        Return True if successful. Logs exceptions.
+        """
+        return self._upload_file(local_path, sub_path) is not None
+
+    def _upload_file(self, local_path, sub_path):
+        # type: (str, str) -> Optional[LocalBlob]
+        """Store a file like upload_file(). Return the stored Blob, or None if
+        it failed.
+        """
+        name = os.path.join(self.path_prefix, sub_path)
+        try:
+            self._store(local_path, name)
+            return self._blob(name)
+        except (IOError, OSError):
+            logging.exception('Failed to store "%s" as "%s"', local_path, name)
+            return None
+
+    def upload_tree(self, local_path, sub_path, compress=(), manifest=False,
+                    uploaded=None):
+        # type: (str, str, Iterable[str], bool, Optional[List[LocalBlob]]) -> bool
+        """Store a file or a directory tree as (not into) sub_path, like
+        CloudStorage.upload_tree() but ignoring `compress`.
+
+        Return True if successful. Logs exceptions.
+        """
+        if uploaded is None:
+            uploaded = []
+
+        if not st.names_a_directory(sub_path):
+            blob = self._upload_file(local_path, sub_path)
+            if blob is not None:
+                uploaded.append(blob)
+            return blob is not None
+
+        ok = True
+        tree_start = len(uploaded)
+        local_abs = os.path.abspath(local_path)
+
+        for dirpath, dirnames, filenames in os.walk(local_path):
+            local_rel_path = os.path.relpath(os.path.abspath(dirpath), local_abs)
+            if local_rel_path == '.':
+                local_rel_path = ''
+            storage_subdir = os.path.join(sub_path, local_rel_path)
+            self.make_dirs(os.path.join(storage_subdir, ''))
+
+            for filename in filenames:
+                blob = self._upload_file(
+                    os.path.join(dirpath, filename),
+                    os.path.join(storage_subdir, filename))
+                if blob is None:
+                    ok = False
+                else:
+                    uploaded.append(blob)
+
+        if manifest and ok:
+            ok = self.write_manifest(sub_path, uploaded[tree_start:])
+
+        return ok
+
+    def upload_archive(self, local_dir, sub_path, uploaded=None):
+        # type: (str, str, Optional[List[LocalBlob]]) -> bool
+        """Store the local_dir tree as one tar archive file named sub_path, like
+        CloudStorage.upload_archive().
+
+        Return True if successful. Logs exceptions.
+        """
+        name = os.path.join(self.path_prefix, sub_path)
+
+        def pack(writer):
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for entry in sorted(os.listdir(local_dir)):
+                    tar.add(os.path.join(local_dir, entry), arcname=entry)
+
+        try:
+            self._write(name, pack)
+            blob = self._blob(name)
+        except (tarfile.TarError, IOError, OSError):
+            logging.exception(
+                'Failed to store "%s" as archive "%s"', local_dir, name)
+            return False
+
+        if uploaded is not None:
+            uploaded.append(blob)
+        return True
+
+    def download_archive(self, sub_path, local_dir):
+        # type: (str, str) -> bool
+        """Extract the tar archive file named sub_path into local_dir, like
+        CloudStorage.download_archive().
+
+        Return True if successful. Logs exceptions.
+        """
+        full_path = self._full_path(os.path.join(self.path_prefix, sub_path))
+        fp.makedirs(local_dir)
+
+        try:
+            with open(full_path, 'rb') as f:
+                st._extract_archive(f, local_dir)
+        except (tarfile.TarError, IOError, OSError):
+            logging.exception(
+                'Failed to extract archive "%s" into "%s"', full_path, local_dir)
+            return False
+        return True
+
+    def download_blob(self, blob, local_path):
+        # type: (LocalBlob, str) -> bool
+        """Copy a stored file as (not into) local_path, making directories if
+        needed. Fail if the Blob has a generation and the file's differs.
+
+        Return True if successful. Logs exceptions.
+        """
+        if st.names_a_directory(local_path):
+            fp.makedirs(local_path)
+            return True
+
+        fp.makedirs(os.path.dirname(local_path))
+        full_path = self._full_path(blob.name)
+
+        try:
+            if blob.generation is not None:
+                generation = _generation(os.stat(full_path))
+                if generation != int(blob.generation):
+                    logging.error('"%s" generation %s != expected generation %s',
+                                  full_path, generation, blob.generation)
+                    return False
+
+            if os.path.lexists(local_path):
+                os.remove(local_path)  # don't write through an old hard link
+            self._transfer(full_path, local_path)
+        except (IOError, OSError):
+            logging.exception('Failed to copy "%s" as "%s"', full_path, local_path)
+            return False
+
+        return True
+
+    def copy_blob(self, blob, sub_path):
+        # type: (LocalBlob, str) -> Optional[LocalBlob]
+        """Copy the stored file for the Blob as sub_path. Fail if the Blob has
+        a generation and the file's differs. If sub_path names the Blob's own
+        file, skip the copy so it keeps its generation.
+
+        Return the new (or same) Blob, or None if it failed. Logs exceptions.
+        """
+        full_path = self._full_path(blob.name)
+        name = os.path.join(self.path_prefix, sub_path)
+
+        try:
+            if blob.generation is not None:
+                generation = _generation(os.stat(full_path))
+                if generation != int(blob.generation):
+                    logging.error('"%s" generation %s != expected generation %s',
+                                  full_path, generation, blob.generation)
+                    return None
+
+            if name != blob.name:
+                self._store(full_path, name)
+            return self._blob(name)
+        except (IOError, OSError):
+            logging.exception('Failed to copy "%s" as "%s"', full_path, name)
+            return None
+
+    def read_text(self, sub_path):
+        # type: (str) -> Optional[str]
+        """Return the text of the file named sub_path, or None if it doesn't
+        exist or it failed. Logs exceptions.
+        """
+        full_path = self._full_path(os.path.join(self.path_prefix, sub_path))
+
+        if not os.path.exists(full_path):
+            return None
+        try:
+            with open(full_path, 'rb') as f:
+                return f.read().decode('utf-8')
+        except (IOError, OSError):
+            logging.exception('Failed to read "%s"', full_path)
+            return None
+
+    def write_text(self, sub_path, text, content_type='text/plain'):
+        # type: (str, str, str) -> bool
+        """Write the text as the file named sub_path. Return True if
+        successful. Logs exceptions.
+        """
+        name = os.path.join(self.path_prefix, sub_path)
+
+        try:
+            self._write(name, lambda f: f.write(text.encode('utf-8')))
+        except (IOError, OSError):
+            logging.exception('Failed to write "%s"', name)
+            return False
+        return True
+
+    def download_file(self, sub_path, local_path):
+        # type: (str, str) -> bool
+        """Copy the stored file named sub_path as (not into) local_path, making
+        local directories if needed.
+
+        Return True if successful. Logs exceptions.
+        """
+        name = os.path.join(self.path_prefix, sub_path)
+        if not os.path.isfile(self._full_path(name)):
+            logging.error('"%s" not found', self._full_path(name))
+            return False
+        return self.download_blob(self.pinned_blob(name, 0, None), local_path)
+
+    def download_tree(self, sub_path, local_prefix, blobs=None, use_manifest=False):
+        # type: (str, str, Optional[Iterable[LocalBlob]], bool) -> bool
+        """Copy all files and directories that begin with the sub_path prefix
+        (within the storage_prefix) to their same relative paths in
+        local_prefix, like CloudStorage.download_tree().
+
+        Return True if successful. Logs exceptions.
+        """
+        if blobs is None:
+            if not st.names_a_directory(sub_path):
+                local_path = os.path.join(local_prefix, sub_path)
+                return self.download_file(sub_path, local_path)
+            if use_manifest:
+                blobs = self.read_manifest(sub_path)
+            if blobs is None:
+                blobs = self.list_blobs(sub_path)
+        elif not blobs and not st.names_a_directory(sub_path):
+            logging.error('"%s" not found', self._full_path(
+                os.path.join(self.path_prefix, sub_path)))
+            return False
+
+        ok = True
+        for blob in blobs:
+            local_rel_path = st.relpath(blob.name, self.path_prefix)
+            path = os.path.join(local_prefix, local_rel_path)
+            ok = self.download_blob(blob, path) and ok
+        return ok
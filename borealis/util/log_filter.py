@@ -9,6 +9,9 @@ from typing import Dict
 class LogPrefixFilter(logging.Filter):
     """Filter log records by a specific log level for each name prefix. (The
     prefix is the first component of the dotted log name.)
+
+    This caches the level for each log name it sees. Assigning `levels` or
+    `else_level`, or calling set_level(), clears the cache.
     """
     # Subclass logging.Filter just to satisfy addFilter()'s zealous type decl.
 
@@ -19,14 +22,71 @@ class LogPrefixFilter(logging.Filter):
         else_level: the default log level to use.
         """
         super(LogPrefixFilter, self).__init__()
-        self.levels = levels
-        self.else_level = else_level
+        self._levels = dict(levels)
+        self._else_level = else_level
+        self._cache = {}  # type: Dict[str, int]
+
+    @property
+    def levels(self):
+        # type: () -> Dict[str, int]
+        """A copy of the dictionary of log name prefix -> log level."""
+        return dict(self._levels)
+
+    @levels.setter
+    def levels(self, levels):
+        # type: (Dict[str, int]) -> None
+        self._levels = dict(levels)
+        self._cache = {}
+
+    @property
+    def else_level(self):
+        # type: () -> int
+        """The default log level to use."""
+        return self._else_level
+
+    @else_level.setter
+    def else_level(self, level):
+        # type: (int) -> None
+        self._else_level = level
+        self._cache = {}
+
+    def set_level(self, prefix, level):
+        # type: (str, int) -> None
+        """Set the log level for a log name prefix."""
+        self._levels[prefix] = level
+        self._cache = {}
+
+    def level_for(self, name):
+        # type: (str) -> int
+        """Return the filter level for the log name."""
+        try:
+            return self._cache[name]
+        except KeyError:
+            prefix = name.split('.', 1)[0]
+            level = self._cache[name] = self._levels.get(prefix, self._else_level)
+            return level
 
     def filter(self, record):
         # type: (logging.LogRecord) -> bool
         """Return False to reject this log record; True to pass it to other
         filters.
         """
-        prefix = record.name.split('.', 1)[0]
-        filter_level = self.levels.get(prefix, self.else_level)
-        return record.levelno >= filter_level
\ No newline at end of file
+        return record.levelno >= self.level_for(record.name)
+
+
+def apply_logger_levels(*filters):
+    # type: (*LogPrefixFilter) -> None
+    """Set the level of each Logger named by a prefix in these filters' levels
+    to the lowest level that any of the filters will pass, so those loggers
+    don't even create the log records that all the filters would reject.
+
+    Only call this with the filters on all the handlers that get records from
+    those loggers, and call it again after changing the filters' levels.
+    """
+    prefixes = set()
+    for f in filters:
+        prefixes.update(f.levels)
+
+    for prefix in prefixes:
+        level = min(f.level_for(prefix) for f in filters)
+        logging.getLogger(prefix).setLevel(level)
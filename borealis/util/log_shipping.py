@@ -0,0 +1,253 @@
+"""Ship Python log records to StackDriver cloud logging in batches."""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import deque
+import datetime
+import logging
+import sys
+from threading import Condition, Lock, Thread, current_thread
+import time
+from typing import Any, List, Optional, Tuple
+
+from borealis.util import metrics
+
+
+DROPPED_RECORDS = metrics.counter(
+    'borealis_log_records_dropped_total',
+    'Log records that cloud logging dropped or sampled out under load.')
+FAILED_ENTRIES = metrics.counter(
+    'borealis_log_entries_failed_total',
+    'Cloud log entries that failed to ship.')
+
+
+try:
+    UTC = datetime.timezone.utc
+except AttributeError:  # Python 2
+    class _UTC(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+    UTC = _UTC()
+
+
+class BatchingCloudHandler(logging.Handler):
+    """A logging Handler that ships records to StackDriver cloud logging from a
+    background thread via a bounded in-memory queue, so emit() never waits on
+    the network.
+
+    The background thread sends a batch when it has `max_batch_entries` records
+    or when the oldest queued record is `max_latency` seconds old, splitting
+    batches at `max_batch_bytes`. It coalesces consecutive records from the
+    same logger at the same level (e.g. lines of container output) into one
+    log entry of up to `coalesce_bytes`, which cuts the per-entry overhead.
+
+    Under pressure, when the queue is over `pressure` full, it keeps only
+    1 of every `sample_every` low-priority (below WARNING) records. When the
+    queue is full, it drops low-priority records, or for a higher priority
+    record, the oldest queued record. It counts all the dropped records and
+    reports them in the log.
+    """
+
+    def __init__(self, client, name, resource=None, labels=None,
+                 max_queue=20000, max_batch_entries=500,
+                 max_batch_bytes=1024 * 1024, max_latency=2.0,
+                 coalesce_bytes=16 * 1024, pressure=0.75, sample_every=10):
+        # type: (Any, str, Any, Optional[dict], int, int, int, float, int, float, int) -> None
+        """
+        client: a google.cloud.logging Client.
+        name: the cloud log name.
+        resource: the cloud logging monitored Resource for the entries.
+        labels: optional labels for all the entries.
+        """
+        super(BatchingCloudHandler, self).__init__()
+        self.logger = client.logger(name)
+        self.resource = resource
+        self.labels = labels
+        self.max_queue = max_queue
+        self.max_batch_entries = max_batch_entries
+        self.max_batch_bytes = max_batch_bytes
+        self.max_latency = max_latency
+        self.coalesce_bytes = coalesce_bytes
+        self.pressure_size = int(max_queue * pressure)
+        self.sample_every = max(sample_every, 1)
+
+        #: The number of records dropped or sampled out, in total.
+        self.dropped = 0
+        #: The number of log entries that failed to ship, in total.
+        self.failed = 0
+        self._dropped_unreported = 0
+        self._sampled = 0
+
+        self._queue = deque()  # type: deque
+        self._lock = Lock()
+        self._ready = Condition(self._lock)
+        self._closing = False
+        self._flushing = False
+
+        self._thread = Thread(target=self._run, name='log-shipping')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        # type: (logging.LogRecord) -> None
+        """Enqueue the record without blocking on I/O."""
+        if self._closing or current_thread() is self._thread:
+            return  # avoid recursion from the shipping thread's own logging
+
+        low_priority = record.levelno < logging.WARNING
+
+        with self._lock:
+            size = len(self._queue)
+
+            if size >= self.max_queue:
+                self._count_dropped()
+                if low_priority:
+                    return
+                self._queue.popleft()
+            elif size >= self.pressure_size and low_priority:
+                self._sampled += 1
+                if self._sampled % self.sample_every:
+                    self._count_dropped()
+                    return
+
+            self._queue.append(record)
+            if size == 0 or size + 1 >= self.max_batch_entries:
+                self._ready.notify()  # start the latency clock or a full batch
+
+    def _count_dropped(self):
+        # type: () -> None
+        self.dropped += 1
+        self._dropped_unreported += 1
+        DROPPED_RECORDS.inc()
+
+    def _take_batch(self):
+        # type: () -> Tuple[List[logging.LogRecord], int]
+        """Wait for a batch of records to ship. Return the records and the
+        number of records dropped since the last batch.
+        """
+        with self._lock:
+            while not self._closing and not self._flushing:
+                if not self._queue:
+                    self._ready.wait()
+                    continue
+                if len(self._queue) >= self.max_batch_entries:
+                    break
+
+                # Time the deadline from the oldest queued record.
+                remaining = (self._queue[0].created + self.max_latency
+                             - time.time())
+                if remaining <= 0:
+                    break
+                self._ready.wait(remaining)
+            self._flushing = False
+
+            count = min(len(self._queue), self.max_batch_entries)
+            records = [self._queue.popleft() for _ in range(count)]
+            dropped, self._dropped_unreported = self._dropped_unreported, 0
+            return records, dropped
+
+    def _entries(self, records, dropped):
+        # type: (List[logging.LogRecord], int) -> List[Tuple[str, str, str, float]]
+        """Format and coalesce records into (logger name, severity, message,
+        created time) entries.
+        """
+        entries = []  # type: List[Tuple[str, str, str, float]]
+
+        if dropped:
+            entries.append((
+                __name__, 'WARNING',
+                'Dropped {} log records under load'.format(dropped), time.time()))
+
+        for record in records:
+            try:
+                message = self.format(record)
+            except Exception:
+                self.handleError(record)
+                continue
+
+            if entries:
+                name, severity, text, created = entries[-1]
+                if (name == record.name and severity == record.levelname
+                        and record.levelno < logging.WARNING
+                        and len(text) + len(message) < self.coalesce_bytes):
+                    entries[-1] = (name, severity, text + '\n' + message, created)
+                    continue
+
+            entries.append((record.name, record.levelname, message, record.created))
+
+        return entries
+
+    def _ship(self, entries):
+        # type: (List[Tuple[str, str, str, float]]) -> None
+        """Send the entries in API calls of up to max_batch_bytes."""
+        batch = self.logger.batch()
+        batch_bytes = 0
+
+        for name, severity, message, created in entries:
+            if batch.entries and batch_bytes + len(message) > self.max_batch_bytes:
+                self._commit(batch)
+                batch_bytes = 0
+
+            batch.log_struct(
+                {'message': message, 'python_logger': name},
+                severity=severity,
+                resource=self.resource,
+                labels=self.labels,
+                timestamp=datetime.datetime.fromtimestamp(created, tz=UTC))
+            batch_bytes += len(message)
+
+        if batch.entries:
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # type: (Any) -> None
+        count = len(batch.entries)
+        try:
+            batch.commit()
+        except Exception as e:
+            del batch.entries[:]
+            self.failed += count
+            FAILED_ENTRIES.inc(count)
+            print('Failed to ship {} log entries: {!r}'.format(count, e),
+                  file=sys.stderr)
+
+    def _run(self):
+        # type: () -> None
+        """The background thread's loop."""
+        while True:
+            records, dropped = self._take_batch()
+            if records or dropped:
+                self._ship(self._entries(records, dropped))
+            elif self._closing:
+                return
+
+    def flush(self):
+        # type: () -> None
+        """Ask the background thread to send what's queued now."""
+        with self._lock:
+            self._flushing = True
+            self._ready.notify()
+
+    def close(self, timeout=5.0):
+        # type: (float) -> None
+        """Ship the queued records, waiting up to `timeout` seconds, then stop
+        accepting records. Records that didn't make it count as dropped.
+        """
+        with self._lock:
+            self._closing = True
+            self._ready.notify()
+        self._thread.join(timeout)
+
+        with self._lock:
+            self.dropped += len(self._queue)
+            DROPPED_RECORDS.inc(len(self._queue))
+            self._queue.clear()
+
+        super(BatchingCloudHandler, self).close()
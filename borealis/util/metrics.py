@@ -0,0 +1,294 @@
+"""Lightweight in-process metrics (counters and histograms) with an optional
+HTTP endpoint that serves them in the Prometheus text format, which
+OpenMetrics scrapers also read.
+
+Instrumenting code costs a lock and an addition per event, so it's cheap
+enough for hot paths, and it does nothing else until something scrapes the
+endpoint. Modules define their metrics at import time, e.g.
+
+    ROCKETS = metrics.counter('fireworker_rockets_total', 'Rockets launched.')
+    ROCKETS.inc()
+
+    PHASES = metrics.histogram(
+        'dockertask_phase_seconds', 'DockerTask phase durations.', ['phase'])
+    with PHASES.labels('run').time():
+        ...
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+from contextlib import contextmanager
+import logging
+import math
+from threading import Lock, Thread
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    seconds_clock = time.monotonic
+except AttributeError:
+    seconds_clock = time.time
+
+#: The default histogram bucket upper bounds, in seconds, spanning quick
+#: requests to long tasks.
+DEFAULT_BUCKETS = (
+    0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+#: The HTTP response content type of the metrics text.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    # type: (float) -> str
+    if value == math.floor(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=()):
+    # type: (Sequence[str], Sequence[str], Sequence[Tuple[str, str]]) -> str
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + '}'
+
+
+class _CounterValue(object):
+    """One labeled counter value."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        """Add a non-negative amount."""
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        # type: () -> List[Tuple[str, List[Tuple[str, str]], float]]
+        return [('', [], self.value)]
+
+
+class _HistogramValue(object):
+    """One labeled histogram: counts of observations in cumulative buckets,
+    plus their count and sum.
+    """
+
+    def __init__(self, buckets):
+        # type: (Sequence[float]) -> None
+        self._lock = Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        # type: (float) -> None
+        """Record an observation, e.g. a duration in seconds."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        # type: () -> Iterator[None]
+        """A context manager that observes its duration in seconds."""
+        start = seconds_clock()
+        try:
+            yield
+        finally:
+            self.observe(seconds_clock() - start)
+
+    def samples(self):
+        # type: () -> List[Tuple[str, List[Tuple[str, str]], float]]
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+
+        result = []
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + [float('inf')], counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else _format_value(bound)
+            result.append(('_bucket', [('le', le)], cumulative))
+        result.append(('_count', [], cumulative))
+        result.append(('_sum', [], total))
+        return result
+
+
+class Metric(object):
+    """A named metric with zero or more label names. Call labels() to get the
+    value for particular label values, or for a metric without labels, use
+    its value methods (like inc() or observe()) directly.
+    """
+
+    TYPE = ''
+
+    def __init__(self, name, documentation, labelnames=(), **kwargs):
+        # type: (str, str, Sequence[str], **Any) -> None
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._lock = Lock()
+        self._values = {}  # type: Dict[Tuple[str, ...], Any]
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        # type: (*Any) -> Any
+        """Return the metric value for these label values, in labelnames
+        order. Callers on hot paths can keep the result to skip the lookup.
+        """
+        key = tuple(str(value) for value in values)
+        value = self._values.get(key)
+        if value is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError('Metric {} needs labels {}'.format(
+                    self.name, self.labelnames))
+            with self._lock:
+                value = self._values.setdefault(key, self._new_value())
+        return value
+
+    def render(self):
+        # type: () -> List[str]
+        """Return the metric's exposition text lines."""
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+
+        for key, value in sorted(self._values.items()):
+            for suffix, extra, sample in value.samples():
+                lines.append('{}{}{} {}'.format(
+                    self.name, suffix, _format_labels(self.labelnames, key, extra),
+                    _format_value(sample)))
+        return lines
+
+
+class Counter(Metric):
+    """A metric that counts up, e.g. requests or bytes."""
+
+    TYPE = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        # type: (float) -> None
+        self._default.inc(amount)
+
+
+class Histogram(Metric):
+    """A metric that counts observations like durations in buckets."""
+
+    TYPE = 'histogram'
+
+    def _new_value(self):
+        return _HistogramValue(tuple(self._kwargs.get('buckets', DEFAULT_BUCKETS)))
+
+    def observe(self, value):
+        # type: (float) -> None
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class Registry(object):
+    """A collection of metrics to render together."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric):
+        # type: (Metric) -> Metric
+        """Add the metric unless there's already one by that name. Return the
+        registered one.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError('Metric {} is already a {}'.format(
+                        metric.name, existing.TYPE))
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        # type: () -> str
+        """Return all the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []  # type: List[str]
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+#: The process's metrics.
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    # type: (str, str, Sequence[str]) -> Counter
+    """Define (or return the already defined) Counter in REGISTRY. Its name
+    should end with '_total'.
+    """
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    # type: (str, str, Sequence[str], Sequence[float]) -> Histogram
+    """Define (or return the already defined) Histogram in REGISTRY."""
+    return REGISTRY.register(
+        Histogram(name, documentation, labelnames, buckets=buckets))
+
+
+def start_http_server(port, address='', registry=REGISTRY):
+    # type: (int, str, Registry) -> Any
+    """Serve the registry's metrics at http://address:port/metrics from a
+    daemon thread. Return the HTTP server (call shutdown() to stop it).
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # don't log every scrape
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server((address, port), Handler)
+    thread = Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logging.getLogger('fireworker').info(
+        'Serving metrics at http://%s:%s/metrics', address or '0.0.0.0', port)
+    return server
@@ -0,0 +1,253 @@
+"""Opt-in profiling of the Fireworker's rockets to find where the worker's own
+Python time goes: FireWorks checkout, storage transfers, log handling, ...
+
+The Fireworker wraps each launch_rocket() call in a RocketProfile, and
+DockerTask wraps each of its phases ('pull', 'download', 'run', 'upload') in
+phase(). There are two modes:
+
+  'cprofile' -- deterministic profiling (cProfile) of the thread that runs the
+    rocket. Writes `<phase>.pstats` for each DockerTask phase and
+    `rocket.pstats` for the rest of the rocket, i.e. the FireWorks overhead.
+    Read them with `python -m pstats` or a viewer like snakeviz.
+
+  'sample' -- a sampling profiler that snapshots every thread's stack each
+    SAMPLE_INTERVAL seconds, so it also sees the storage transfer and log
+    shipping threads. Writes `rocket.collapsed` in the collapsed-stack format
+    that flamegraph.pl and speedscope read, with the phase and thread names as
+    the root frames.
+
+A DockerTask calls set_destination() so its rocket's profile files go under its
+storage prefix, in `profiles/<task name>/<host name>.<timestamp>/`.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from borealis.util import data
+
+#: The profiling modes. See the module docstring.
+MODES = ('cprofile', 'sample')
+
+#: Seconds between stack samples in the 'sample' mode.
+SAMPLE_INTERVAL = 0.01
+
+#: The storage sub-directory for profile files.
+PROFILES_DIR = 'profiles'
+
+#: The label of the time outside any phase.
+ROCKET = 'rocket'
+
+_active = None  # type: Optional[RocketProfile]
+
+
+class _Sampler(object):
+    """A daemon thread that counts the collapsed stacks of all the other
+    threads, each prefixed by the current `label`.
+    """
+
+    def __init__(self, interval):
+        # type: (float) -> None
+        self.interval = interval
+        self.label = ROCKET
+        self.stacks = Counter()  # type: Counter
+        self._frame_names = {}  # type: Dict[Any, str]
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join()
+
+    def _frame_name(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            name = '{} ({}:{})'.format(
+                code.co_name, code.co_filename, code.co_firstlineno
+            ).replace(';', ':')
+            self._frame_names[code] = name
+        return name
+
+    def _run(self):
+        own_id = threading.current_thread().ident
+
+        while not self._done.wait(self.interval):
+            label = self.label
+            thread_names = {thread.ident: thread.name
+                            for thread in threading.enumerate()}
+
+            # noinspection PyProtectedMember
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                names = []
+                while frame is not None:
+                    names.append(self._frame_name(frame.f_code))
+                    frame = frame.f_back
+                names.append(thread_names.get(thread_id, str(thread_id)))
+                names.append(label)
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def write(self, path):
+        # type: (str) -> None
+        """Write the stack counts to a collapsed-stack file."""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+class RocketProfile(object):
+    """A context manager that profiles one rocket in the given mode and makes
+    itself the active profile for phase() and set_destination(). A mode of
+    None or '' profiles nothing.
+    """
+
+    def __init__(self, mode, host_name, interval=SAMPLE_INTERVAL):
+        # type: (Optional[str], str, float) -> None
+        if mode and mode not in MODES:
+            raise ValueError('Unknown profiling mode {!r}, not one of {}'.format(
+                mode, MODES))
+
+        self.mode = mode
+        self.host_name = host_name
+        self.interval = interval
+        self.timestamp = ''
+        self.label = ROCKET
+
+        #: (storage_prefix, task name) to upload the profile files to.
+        self.destination = None  # type: Optional[Tuple[str, str]]
+
+        self._profiles = {}  # type: Dict[str, Any]  # label -> cProfile.Profile
+        self._profiler = None  # type: Any  # the enabled cProfile.Profile
+        self._sampler = None  # type: Optional[_Sampler]
+
+    def __enter__(self):
+        global _active
+
+        self.timestamp = data.timestamp()
+        if self.mode == 'cprofile':
+            self._switch(ROCKET)
+        elif self.mode == 'sample':
+            self._sampler = _Sampler(self.interval)
+            self._sampler.start()
+
+        if self.mode:
+            _active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active
+
+        if _active is self:
+            _active = None
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler = None
+        if self._sampler:
+            self._sampler.stop()
+        return False
+
+    def _switch(self, label):
+        # type: (str) -> None
+        """Attribute the profiling from now on to `label`. (cProfile can only
+        run one Profile at a time per thread.)
+        """
+        self.label = label
+        if self._sampler:
+            self._sampler.label = label
+            return
+
+        import cProfile
+
+        if self._profiler:
+            self._profiler.disable()
+        self._profiler = self._profiles.get(label)
+        if self._profiler is None:
+            self._profiler = self._profiles[label] = cProfile.Profile()
+        self._profiler.enable()
+
+    @contextmanager
+    def phase(self, name):
+        # type: (str) -> Iterator[None]
+        """A context manager that attributes its profiling to phase `name`."""
+        previous = self.label
+        self._switch(name)
+        try:
+            yield
+        finally:
+            self._switch(previous)
+
+    def write(self, directory):
+        # type: (str) -> None
+        """Write the profile files into the local directory."""
+        for label, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(directory, label + '.pstats'))
+        if self._sampler:
+            self._sampler.write(os.path.join(directory, ROCKET + '.collapsed'))
+
+    def save(self):
+        # type: () -> bool
+        """Upload the profile files to the destination that a DockerTask set,
+        if any. Return True if it uploaded them. Logs exceptions.
+        """
+        if not self.mode or not self.destination:
+            return False
+
+        import borealis.util.storage as st
+
+        storage_prefix, task_name = self.destination
+        sub_path = os.path.join(
+            PROFILES_DIR, task_name,
+            '{}.{}'.format(self.host_name, self.timestamp), '')
+        local_dir = tempfile.mkdtemp(prefix='profile-')
+
+        try:
+            self.write(local_dir)
+            ok = st.open_storage(storage_prefix).upload_tree(local_dir, sub_path)
+            if ok:
+                logging.getLogger('fireworker').info(
+                    'Wrote the rocket profile to %s%s', storage_prefix, sub_path)
+            return ok
+        except Exception as e:
+            logging.getLogger('fireworker').exception(
+                'Failed to write the rocket profile: %r', e)
+            return False
+        finally:
+            shutil.rmtree(local_dir, ignore_errors=True)
+
+
+@contextmanager
+def _unprofiled():
+    yield
+
+
+def phase(name):
+    # type: (str) -> Any
+    """Return a context manager that profiles a DockerTask phase on its own if
+    a RocketProfile is active, else does nothing.
+    """
+    profile = _active
+    return profile.phase(name) if profile else _unprofiled()
+
+
+def set_destination(storage_prefix, task_name):
+    # type: (str, str) -> None
+    """Direct the active RocketProfile, if any, to save its files under
+    storage_prefix, in a sub-directory for task_name.
+    """
+    profile = _active
+    if profile:
+        profile.destination = (storage_prefix, task_name)
@@ -2,17 +2,75 @@
 
 from __future__ import absolute_import, division, print_function
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import fnmatch
+import gzip
+import json
 import logging
+import mimetypes
 import os
-from typing import Iterator, List, Optional, Set
+import shutil
+import tarfile
+import tempfile
+from threading import Lock, Thread
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set
+import zlib
 
 from google.cloud.storage import Blob, Client
-from google.cloud.exceptions import GoogleCloudError, PreconditionFailed
+from google.cloud.exceptions import GoogleCloudError, NotFound, PreconditionFailed
+from requests.adapters import HTTPAdapter
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 import borealis.util.filepath as fp
+from borealis.util import metrics
+from borealis.util import transfer
 
 
 OCTET_STREAM = 'application/octet-stream'
+GZIP = 'gzip'
+
+#: Bytes per chunk when streaming a file through gzip.
+CHUNK_SIZE = 1024 * 1024
+
+#: The custom metadata key that records a gzip-encoded object's uncompressed
+#: size, which is what it takes on disk when downloaded.
+UNCOMPRESSED_SIZE = 'borealis-uncompressed-size'
+
+#: How much to assume that a gzip-encoded object without UNCOMPRESSED_SIZE
+#: metadata (e.g. pinned from a manifest) expands when downloaded. Text files
+#: like logs and tables typically compress 5-10x.
+GZIP_EXPANSION = 10
+
+#: The storage name suffix and content type of a directory archive object.
+ARCHIVE_SUFFIX = '.tar'
+ARCHIVE_CONTENT_TYPE = 'application/x-tar'
+
+#: The storage name suffix of a directory tree's manifest object.
+MANIFEST_SUFFIX = '.manifest.json'
+
+#: The default number of concurrent listing and download requests.
+DEFAULT_MAX_WORKERS = 16
+
+#: GCS traffic, for the Fireworker's metrics endpoint. The request counts are
+#: approximate: a listing counts its pages, and a resumable upload counts as
+#: one request.
+GCS_BYTES = metrics.counter(
+    'borealis_gcs_bytes_total', 'Bytes transferred to or from GCS.', ['direction'])
+GCS_REQUESTS = metrics.counter(
+    'borealis_gcs_requests_total', 'GCS requests.', ['operation'])
+
+#: storage_prefix schemes that open_storage() understands. A prefix without a
+#: scheme names GCS.
+GCS_SCHEME = 'gs://'
+FILE_SCHEME = 'file://'
+
+#: How many directory levels deep walk_blobs() splits a tree into concurrent
+#: listings. Deeper splits cost a request per small directory.
+LIST_SPLIT_DEPTH = 2
 
 
 def bucket_path(pathname):
@@ -48,7 +106,417 @@ def relpath(path, start=None):
     return result
 
 
-class CloudStorage(object):
+def should_compress(local_path, patterns):
+    # type: (str, Iterable[str]) -> bool
+    """Return True if local_path's filename matches any of the fnmatch-style
+    `patterns`, e.g. ['*.csv', '*.tsv', '*.log', '*.json'].
+    """
+    filename = os.path.basename(local_path)
+    return any(fnmatch(filename, pattern) for pattern in patterns)
+
+
+def content_type(path):
+    # type: (str) -> str
+    """Guess a file's content type from its pathname."""
+    return mimetypes.guess_type(path)[0] or OCTET_STREAM
+
+
+class _GunzipWriter(object):
+    """A write-only file-like object that decompresses gzip data as it's
+    written, writing the result to another file, so a download can decompress
+    in the same stream as it transfers.
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        # type: (bytes) -> None
+        self.file_obj.write(self._decompressor.decompress(data))
+
+    def close(self):
+        # type: () -> None
+        """Finish decompressing. Raise zlib.error if the data was truncated."""
+        self.file_obj.write(self._decompressor.flush())
+        if not getattr(self._decompressor, 'eof', True):  # no eof in Python 2
+            raise zlib.error('Truncated gzip data')
+
+
+def local_size(blob):
+    # type: (Any) -> int
+    """Return how many bytes the Blob takes on disk when downloaded: its size,
+    or if it's gzip-encoded, its UNCOMPRESSED_SIZE metadata if known, else its
+    size times GZIP_EXPANSION.
+    """
+    size = blob.size or 0
+    if blob.content_encoding != GZIP:
+        return size
+
+    metadata = getattr(blob, 'metadata', None) or {}
+    try:
+        return int(metadata[UNCOMPRESSED_SIZE])
+    except (KeyError, ValueError):
+        return size * GZIP_EXPANSION
+
+
+def gzip_to_temp(local_path):
+    # type: (str) -> str
+    """Gzip a file to a new temp file and return its path. The caller must
+    remove it.
+    """
+    fd, temp_path = tempfile.mkstemp(suffix='.gz')
+    try:
+        with os.fdopen(fd, 'wb') as raw, open(local_path, 'rb') as src:
+            with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as gz:
+                shutil.copyfileobj(src, gz, CHUNK_SIZE)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def archive_name(sub_path):
+    # type: (str) -> str
+    """Return the storage name of the archive object for a directory path."""
+    return sub_path.rstrip(os.sep) + ARCHIVE_SUFFIX
+
+
+def manifest_name(sub_path):
+    # type: (str) -> str
+    """Return the storage name of the manifest object for a directory path."""
+    return sub_path.rstrip(os.sep) + MANIFEST_SUFFIX
+
+
+def manifest_json(tree_path, blobs):
+    # type: (str, Iterable[Any]) -> str
+    """Return the manifest JSON text for the Blobs in the tree_path directory
+    tree: their names (relative to tree_path), sizes, generations, CRC32C
+    checksums, and content encodings.
+    """
+    files = []
+
+    for blob in blobs:
+        entry = {
+            'name': os.path.relpath(blob.name, tree_path),
+            'size': blob.size,
+            'generation': blob.generation,
+            'crc32c': blob.crc32c}
+        if blob.content_encoding:
+            entry['encoding'] = blob.content_encoding
+        files.append(entry)
+
+    return json.dumps({'files': files}, sort_keys=True)
+
+
+def parse_manifest(text):
+    # type: (bytes) -> List[Dict[str, Any]]
+    """Return the file entries of manifest_json() text. Raise ValueError or
+    KeyError if it's malformed.
+    """
+    return json.loads(text.decode('utf-8'))['files']
+
+
+class _PipeReader(object):
+    """A file-like reader of the read end of a pipe that tracks its position
+    for tell(), as resumable uploads need, and raises IOError at the end of
+    the data if the writer failed, so a partial stream can't pass as a
+    complete one.
+
+    It keeps the data from the latest read() so a resumable upload can seek()
+    back within it to recover from a failed chunk, and it computes the
+    stream's CRC32C.
+    """
+
+    def __init__(self, file_obj, errors):
+        # type: (BinaryIO, List[BaseException]) -> None
+        self.file_obj = file_obj
+        self.errors = errors
+        self.position = 0
+        self.crc32c = transfer.Crc32c()
+        self._window = b''  # the latest read() result...
+        self._window_start = 0  # ...and its stream position
+        self._replay = b''  # data to read again after seeking back
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        result = b''
+        if self._replay:
+            count = len(self._replay) if size < 0 else size
+            result, self._replay = self._replay[:count], self._replay[count:]
+
+        if size < 0 or len(result) < size:
+            data = self.file_obj.read(size - len(result) if size >= 0 else -1)
+            if not data and self.errors:
+                raise IOError('The stream writer failed: {!r}'.format(self.errors[0]))
+            self.crc32c.update(data)
+            result += data
+
+        self._window, self._window_start = result, self.position
+        self.position += len(result)
+        return result
+
+    def tell(self):
+        # type: () -> int
+        return self.position
+
+    def seek(self, position):
+        # type: (int) -> None
+        """Seek back within the latest read()."""
+        if position == self.position:
+            return
+        if not self._window_start <= position < self.position:
+            raise IOError("Can't seek a pipe stream to {} outside [{}, {}]".format(
+                position, self._window_start, self.position))
+
+        offset = position - self._window_start
+        self._replay = self._window[offset:] + self._replay
+        self._window = self._window[:offset]
+        self.position = position
+
+
+def _stream(producer, consumer):
+    # type: (Callable[[BinaryIO], Any], Callable[[_PipeReader], Any]) -> None
+    """Run producer(writer) in a thread, streaming its output through a pipe to
+    consumer(reader) in this thread, so neither has to hold all the data on
+    disk or in memory. Raise the producer's exception if it failed
+    first, else the consumer's.
+    """
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    writer = os.fdopen(write_fd, 'wb')
+    errors = []  # type: List[BaseException]
+
+    def produce():
+        try:
+            producer(writer)
+        except BaseException as e:  # incl. a broken pipe if the consumer quit
+            errors.append(e)
+        finally:
+            try:
+                writer.close()
+            except (IOError, OSError):
+                pass
+
+    thread = Thread(target=produce, name='stream-producer')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        pipe_reader = _PipeReader(reader, errors)
+        consumer(pipe_reader)
+        while pipe_reader.read(CHUNK_SIZE):  # drain any trailing padding
+            pass
+    except Exception:
+        if errors:  # the producer failed first, e.g. from a transient 503
+            raise errors[0]
+        raise
+    finally:
+        reader.close()  # unblock the producer if the consumer failed
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def _check_member(member, local_dir):
+    # type: (tarfile.TarInfo, str) -> None
+    """Raise tarfile.ExtractError unless the archive member is a file,
+    directory, or link that stays within local_dir.
+    """
+    root = os.path.realpath(local_dir)
+
+    def inside(path):
+        path = os.path.realpath(path)
+        return path == root or path.startswith(os.path.join(root, ''))
+
+    path = os.path.join(root, member.name)
+    if os.path.isabs(member.name) or not inside(path):
+        raise tarfile.ExtractError(
+            'Archive member "{}" is outside the directory'.format(member.name))
+
+    if member.issym():
+        target = os.path.join(os.path.dirname(path), member.linkname)
+    elif member.islnk():
+        target = os.path.join(root, member.linkname)
+    elif member.isfile() or member.isdir():
+        return
+    else:
+        raise tarfile.ExtractError(
+            'Archive member "{}" is a special file'.format(member.name))
+
+    if os.path.isabs(member.linkname) or not inside(target):
+        raise tarfile.ExtractError(
+            'Archive link "{}" points outside the directory'.format(member.name))
+
+
+def _extract_archive(reader, local_dir):
+    # type: (Any, str) -> None
+    """Extract a tar stream into local_dir, member by member as it arrives."""
+    # Newer Pythons can also sanitize the members' permissions.
+    options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+    with tarfile.open(fileobj=reader, mode='r|') as tar:
+        for member in tar:
+            _check_member(member, local_dir)
+            tar.extract(member, local_dir, **options)
+
+
+class StorageBackend(object):
+    """The interface of a storage backend for DockerTask inputs and outputs.
+    See open_storage().
+
+    A backend stores files as "Blobs" named by paths relative to its bucket,
+    with `name`, `size`, `generation`, `crc32c`, and `content_encoding`
+    attributes (the latter two can be None). `sub_path` arguments are
+    relative to the storage_prefix, and a path names a directory iff it ends
+    with '/'. The transfer methods return True if successful and log
+    exceptions.
+
+    A backend has the attributes `bucket_name`, `path_prefix` (the
+    storage_prefix's path within the bucket, ending with '/'), and `stats`
+    (a transfer.RetryStats).
+    """
+
+    def clear_directory_cache(self):
+        # type: () -> None
+        """Clear any cache of directories already created."""
+        pass
+
+    def list_blobs(self, prefix=''):
+        # type: (str) -> Iterable[Any]
+        """List the Blobs whose names start with the prefix string."""
+        raise NotImplementedError
+
+    def list_files(self, sub_path, use_manifest=False):
+        # type: (str, bool) -> List[Any]
+        """List the Blobs that download_tree(sub_path, ...) would download."""
+        raise NotImplementedError
+
+    def pinned_blob(self, name, size, generation, crc32c=None, encoding=None):
+        # type: (str, int, int, Optional[str], Optional[str]) -> Any
+        """Return a Blob for the full blob name with the given metadata, pinned
+        to the given generation.
+        """
+        raise NotImplementedError
+
+    def make_dirs(self, sub_path):
+        # type: (str) -> None
+        """Make sub_path's parent directories if they don't exist."""
+        raise NotImplementedError
+
+    def upload_tree(self, local_path, sub_path, compress=(), manifest=False,
+                    uploaded=None):
+        # type: (str, str, Iterable[str], bool, Optional[List[Any]]) -> bool
+        """Upload a file or a directory tree as (not into) sub_path."""
+        raise NotImplementedError
+
+    def upload_archive(self, local_dir, sub_path, uploaded=None):
+        # type: (str, str, Optional[List[Any]]) -> bool
+        """Upload the local_dir tree as one tar archive named sub_path."""
+        raise NotImplementedError
+
+    def download_blob(self, blob, local_path):
+        # type: (Any, str) -> bool
+        """Download a Blob as (not into) local_path."""
+        raise NotImplementedError
+
+    def download_tree(self, sub_path, local_prefix, blobs=None, use_manifest=False):
+        # type: (str, str, Optional[Iterable[Any]], bool) -> bool
+        """Download the files and directories that begin with the sub_path
+        prefix to their same relative paths in local_prefix.
+        """
+        raise NotImplementedError
+
+    def download_archive(self, sub_path, local_dir):
+        # type: (str, str) -> bool
+        """Download the tar archive named sub_path, extracting it into
+        local_dir.
+        """
+        raise NotImplementedError
+
+    def copy_blob(self, blob, sub_path):
+        # type: (Any, str) -> Optional[Any]
+        """Copy the Blob (in this storage's bucket, pinned to its generation)
+        as sub_path without downloading it. If sub_path names the Blob itself
+        and that generation is still the current one, skip the copy so the
+        Blob keeps its generation. Return the new (or same) Blob, or None if
+        it failed.
+        """
+        raise NotImplementedError
+
+    def read_text(self, sub_path):
+        # type: (str) -> Optional[str]
+        """Return the text of the small file named sub_path, or None if it
+        doesn't exist or it failed.
+        """
+        raise NotImplementedError
+
+    def write_text(self, sub_path, text, content_type='text/plain'):
+        # type: (str, str, str) -> bool
+        """Write the text as the file named sub_path. Return True if
+        successful.
+        """
+        raise NotImplementedError
+
+
+def pooled_client(pool_size):
+    # type: (int) -> Client
+    """Return a new storage Client whose HTTP session has a connection pool
+    of pool_size, enough for that many concurrent requests. This builds the
+    authorized session rather than reconfiguring the Client's private one.
+
+    For a GCS emulator (STORAGE_EMULATOR_HOST) or without Application Default
+    Credentials, return a default Client.
+    """
+    import google.auth
+    from google.auth.exceptions import DefaultCredentialsError
+    from google.auth.transport.requests import AuthorizedSession
+
+    if os.environ.get('STORAGE_EMULATOR_HOST'):
+        return Client()
+    try:
+        credentials, project = google.auth.default(scopes=Client.SCOPE)
+    except DefaultCredentialsError:
+        return Client()
+
+    session = AuthorizedSession(credentials)
+    session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+    kwargs = {'project': project} if project else {}
+    return Client(credentials=credentials, _http=session, **kwargs)
+
+
+def open_storage(storage_prefix):
+    # type: (str) -> StorageBackend
+    """Return the storage backend for the storage_prefix's scheme:
+    'gs://bucket/path/' or plain 'bucket/path/' for a GCS CloudStorage, or
+    'file:///shared/path/' for a LocalStorage directory on a local or shared
+    (e.g. NFS) file system.
+
+    A 'file://' prefix can end with the query '?hard_links=1' to make the
+    LocalStorage transfer files by hard-linking them where it can. See
+    LocalStorage() about when that's safe.
+    """
+    if storage_prefix.startswith(FILE_SCHEME):
+        from borealis.util.local_storage import LocalStorage
+        path, _, query = storage_prefix[len(FILE_SCHEME):].partition('?')
+        options = dict(option.partition('=')[::2]
+                       for option in query.split('&') if option)
+        hard_links = options.pop('hard_links', '0')
+        if options or hard_links not in ('0', '1'):
+            raise ValueError('Unknown storage options in "{}"; expected'
+                             ' hard_links=0 or 1'.format(storage_prefix))
+        return LocalStorage(path, hard_links=hard_links == '1')
+
+    if storage_prefix.startswith(GCS_SCHEME):
+        storage_prefix = storage_prefix[len(GCS_SCHEME):]
+    elif '://' in storage_prefix:
+        raise ValueError('Unknown storage scheme in "{}"; expected {} or {}'.format(
+            storage_prefix, GCS_SCHEME, FILE_SCHEME))
+    return CloudStorage(storage_prefix)
+
+
+class CloudStorage(StorageBackend):
     """A higher level interface to a GCS bucket.
 
     See https://cloud.google.com/storage/docs/naming about legal bucket and
@@ -73,15 +541,28 @@ class CloudStorage(object):
 
     #: For efficiency, retrieve just these Blob metadata fields.
     #: https://cloud.google.com/storage/docs/json_api/v1/how-tos/performance
-    FIELDS = 'items(bucket,name,id,generation,size),nextPageToken'
+    FIELDS = ('items(bucket,name,id,generation,size,contentEncoding,crc32c,'
+              'metadata),nextPageToken')
 
-    def __init__(self, storage_prefix):
-        # type: (str) -> None
+    #: The Blob metadata fields to retrieve in a delimited listing.
+    DELIMITED_FIELDS = (
+        'items(bucket,name,id,generation,size,contentEncoding,crc32c,'
+        'metadata),prefixes,nextPageToken')
+
+    def __init__(self, storage_prefix, client=None, max_workers=DEFAULT_MAX_WORKERS):
+        # type: (str, Optional[Client], int) -> None
         """Construct a GCS accessor with the given storage_prefix, which must
         name a GCS bucket and optionally a base path, e.g.
         'curie-workflows/sim/2020-02-02/'. (It should end with a '/' but will
         work if it doesn't.) All operations are relative to this prefix.
 
+        `client` is an optional storage Client to use, e.g. one configured to
+        talk to a local GCS emulator. The default is a new Client() with an
+        HTTP connection pool big enough for `max_workers`.
+
+        `max_workers` is the number of concurrent listing and download requests
+        in download_tree().
+
         Raise google.api_core.exceptions.NotFound if the bucket doesn't exist.
 
         File uploads to GCS will automatically create directory placeholder
@@ -96,12 +577,19 @@ class CloudStorage(object):
             # exists, but it trips over an empty name.
             raise ValueError("Invalid bucket name: '{}'".format(self.bucket_name))
 
-        self.client = Client()
+        self.max_workers = max_workers
+        if client is None:
+            client = pooled_client(max_workers)
+        self.client = client
         self.bucket = self.client.get_bucket(self.bucket_name)
 
         #: A cache of directory placeholders already created or verified.
         self._directory_cache = set()  # type: Set[str]
 
+        #: Counts of transfer retries, resumed uploads, and checksum
+        #: mismatches, to show how degraded storage access is.
+        self.stats = transfer.RetryStats()
+
     def clear_directory_cache(self):
         # type: () -> None
         """Clear the cache of directory placeholder names already created."""
@@ -115,8 +603,146 @@ class CloudStorage(object):
         """
         prefix = os.path.join(self.path_prefix, prefix)
         iterator = self.bucket.list_blobs(prefix=prefix, fields=self.FIELDS)
+        GCS_REQUESTS.labels('list').inc()
         return iterator
 
+    def walk_blobs(self, prefix='', split_depth=LIST_SPLIT_DEPTH):
+        # type: (str, int) -> Iterator[Blob]
+        """Like list_blobs() but faster for big trees: Split the prefix (which
+        is relative to the storage_prefix) into "sub-directory" prefixes down
+        to `split_depth` levels, list them concurrently, and yield the Blobs as
+        each page arrives, in no particular order.
+        """
+        results = Queue()  # type: Queue
+        lock = Lock()
+        pending = [0]
+        stopping = []  # type: List[bool]
+
+        def list_prefix(prefix, depth):
+            try:
+                delimiter = os.sep if depth < split_depth else None
+                fields = self.DELIMITED_FIELDS if delimiter else self.FIELDS
+                iterator = self.bucket.list_blobs(
+                    prefix=prefix, delimiter=delimiter, fields=fields)
+
+                for page in iterator.pages:
+                    GCS_REQUESTS.labels('list').inc()
+                    if stopping:
+                        break
+                    for sub_prefix in getattr(page, 'prefixes', ()):
+                        submit(sub_prefix, depth + 1)
+                    results.put((list(page), None))
+            except Exception as e:
+                results.put(([], e))
+            finally:
+                results.put(None)
+
+        def submit(prefix, depth):
+            with lock:
+                pending[0] += 1
+            executor.submit(list_prefix, prefix, depth)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            submit(os.path.join(self.path_prefix, prefix), 0)
+
+            while True:
+                item = results.get()
+                if item is None:
+                    with lock:
+                        pending[0] -= 1
+                        if not pending[0]:
+                            break
+                    continue
+
+                blobs, error = item
+                if error:
+                    raise error
+                for blob in blobs:
+                    yield blob
+        finally:
+            stopping.append(True)
+            executor.shutdown(wait=False)
+
+    def list_files(self, sub_path, use_manifest=False):
+        # type: (str, bool) -> List[Blob]
+        """List the Blobs that download_tree(sub_path, ...) would download: all
+        Blobs in the tree if sub_path names a directory (via its manifest if
+        `use_manifest` and it has one), otherwise the one named sub_path (if
+        it exists).
+        """
+        if not names_a_directory(sub_path):
+            full_path = os.path.join(self.path_prefix, sub_path)
+            return [blob for blob in self.list_blobs(sub_path)
+                    if blob.name == full_path]
+
+        blobs = self.read_manifest(sub_path) if use_manifest else None
+        if blobs is None:
+            blobs = list(self.walk_blobs(sub_path))
+        return blobs
+
+    def write_manifest(self, sub_path, blobs):
+        # type: (str, Iterable[Blob]) -> bool
+        """Write a manifest object for the sub_path directory tree listing the
+        given Blobs' names (relative to sub_path), sizes, generations, CRC32C
+        checksums, and content encodings, so downloads can skip listing the
+        tree. See manifest_name().
+
+        Return True if successful. Logs exceptions.
+        """
+        tree_path = os.path.join(self.path_prefix, sub_path)
+        full_path = os.path.join(self.path_prefix, manifest_name(sub_path))
+
+        try:
+            blob = self.bucket.blob(full_path)
+            GCS_REQUESTS.labels('upload').inc()
+            blob.upload_from_string(
+                manifest_json(tree_path, blobs), content_type='application/json')
+        except GoogleCloudError as e:
+            logging.exception('Failed to write the GCS manifest "%s"', full_path)
+            return False
+        return True
+
+    def read_manifest(self, sub_path):
+        # type: (str) -> Optional[List[Blob]]
+        """Read the manifest object for the sub_path directory tree, returning
+        its list of Blobs pinned to the recorded generations, or None if there's
+        no usable manifest.
+        """
+        tree_path = os.path.join(self.path_prefix, sub_path)
+        full_path = os.path.join(self.path_prefix, manifest_name(sub_path))
+
+        try:
+            GCS_REQUESTS.labels('download').inc()
+            text = self.bucket.blob(full_path).download_as_string()
+            files = parse_manifest(text)
+        except NotFound:
+            return None
+        except (GoogleCloudError, ValueError, KeyError) as e:
+            logging.exception('Failed to read the GCS manifest "%s"', full_path)
+            return None
+
+        return [self.pinned_blob(
+                    os.path.join(tree_path, entry['name']), entry['size'],
+                    entry['generation'], entry.get('crc32c'), entry.get('encoding'))
+                for entry in files]
+
+    def pinned_blob(self, name, size, generation, crc32c=None, encoding=None):
+        # type: (str, int, int, Optional[str], Optional[str]) -> Blob
+        """Return a Blob for the full blob name (within the bucket, not relative
+        to the storage_prefix) with the given metadata, as if from a listing,
+        pinned to the given generation.
+        """
+        blob = Blob(name, self.bucket)
+        blob._set_properties({  # like a listing does
+            'name': name,
+            'bucket': self.bucket_name,
+            'size': str(size),
+            'generation': str(generation),
+            'crc32c': crc32c,
+            'contentEncoding': encoding})
+        return blob
+
     def make_dirs(self, sub_path):
         # type: (str) -> None
         """Make sub_path's directory placeholders if they don't exist. E.g. for
@@ -133,6 +759,7 @@ class CloudStorage(object):
                 self._directory_cache.add(dir_name)
 
                 blob = self.bucket.blob(dir_name)
+                GCS_REQUESTS.labels('make_dir').inc()
                 try:
                     # if_generation_match=0: upload if absent, fail if present.
                     blob.upload_from_string(
@@ -144,37 +771,108 @@ class CloudStorage(object):
                     # mounts but won't break the workflow.
                     logging.exception('Failed to make GCS dir "%s"', dir_name)
 
-    def upload_file(self, local_path, sub_path):
-        # type: (str, str) -> bool
+    def upload_file(self, local_path, sub_path, compress=False):
+        # type: (str, str, bool) -> bool
         """Upload the file named local_path as (not into) the given GCS sub_path
         (which is relative to the storage_prefix).
 
+        If `compress`, gzip the file on the way and set the Blob's
+        Content-Encoding to 'gzip', keeping the file's own content type. GCS
+        will then serve it decompressed ("decompressive transcoding") to clients
+        that don't accept gzip, while download_blob() transfers it compressed.
+
+        This retries transient failures with jittered exponential backoff,
+        uploads big files in resumable chunks that recover from failures,
+        and verifies the upload's CRC32C checksum if there's a CRC32C library.
+
         Return True if successful. Logs exceptions.
         """
+        return self._upload_file(local_path, sub_path, compress) is not None
+
+    def _upload_file(self, local_path, sub_path, compress=False):
+        # type: (str, str, bool) -> Optional[Blob]
+        """Upload a file like upload_file(). Return the uploaded Blob with its
+        metadata, or None if it failed.
+        """
         full_path = os.path.join(self.path_prefix, sub_path)
 
         try:
             self.make_dirs(sub_path)
 
             blob = self.bucket.blob(full_path)
-            blob.upload_from_filename(local_path)  # guesses content_type from the path
-        except (GoogleCloudError, OSError) as e:
+            if compress:
+                self._upload_compressed(blob, local_path)
+            else:
+                self._upload_from_filename(blob, local_path, content_type(local_path))
+        except (GoogleCloudError, OSError) + transfer.TRANSFER_ERRORS as e:
             logging.exception(
                 'Failed to upload "%s" as GCS "%s"', local_path, full_path)
-            return False
-        return True
+            return None
+        return blob
 
-    def upload_tree(self, local_path, sub_path):
-        # type: (str, str) -> bool
+    def _upload_compressed(self, blob, local_path):
+        # type: (Blob, str) -> None
+        """Gzip the file to a temp file, then upload it to the Blob, recording
+        its uncompressed size in the Blob's metadata.
+        """
+        temp_path = gzip_to_temp(local_path)
+        try:
+            blob.content_encoding = GZIP
+            blob.metadata = {UNCOMPRESSED_SIZE: str(os.path.getsize(local_path))}
+            self._upload_from_filename(blob, temp_path, content_type(local_path))
+        finally:
+            os.remove(temp_path)
+
+    def _upload_from_filename(self, blob, path, content_type):
+        # type: (Blob, str, str) -> None
+        """Upload a file to the Blob with retries, in resumable chunks if it's
+        big, then verify the Blob's CRC32C.
+        """
+        expected = transfer.file_crc32c(path)
+        size = os.path.getsize(path)
+
+        def upload():
+            GCS_REQUESTS.labels('upload').inc()
+            if size > transfer.RESUMABLE_THRESHOLD:
+                with open(path, 'rb') as f:
+                    resource = transfer.resumable_upload(
+                        blob, self.client, f, content_type, size, self.stats)
+                if resource:
+                    blob._set_properties(resource)
+            else:
+                blob.upload_from_filename(path, content_type=content_type)
+            transfer.verify(blob, expected)
+
+        transfer.with_retries(upload, self.stats, 'upload')
+        GCS_BYTES.labels('upload').inc(size)
+
+    def upload_tree(self, local_path, sub_path, compress=(), manifest=False,
+                    uploaded=None):
+        # type: (str, str, Iterable[str], bool, Optional[List[Blob]]) -> bool
         """Upload a file or a directory tree as (not into) the given GCS
-        sub_path (which is relative to the storage_prefix).
+        sub_path (which is relative to the storage_prefix), compressing the
+        files whose names match any of the fnmatch-style `compress` patterns.
+        See upload_file().
+
+        If `manifest` and sub_path names a directory, also write the tree's
+        manifest object after uploading all its files. See write_manifest().
+
+        If `uploaded` is a list, append the uploaded file Blobs to it.
 
         Return True if successful. Logs exceptions.
         """
+        if uploaded is None:
+            uploaded = []
+
         if not names_a_directory(sub_path):
-            return self.upload_file(local_path, sub_path)
+            blob = self._upload_file(
+                local_path, sub_path, should_compress(local_path, compress))
+            if blob is not None:
+                uploaded.append(blob)
+            return blob is not None
 
         ok = True
+        tree_start = len(uploaded)
         local_abs = os.path.abspath(local_path)
 
         for dirpath, dirnames, filenames in os.walk(local_path):
@@ -184,18 +882,209 @@ class CloudStorage(object):
             storage_subdir = os.path.join(sub_path, local_rel_path)
 
             for filename in filenames:
-                ok = self.upload_file(
+                blob = self._upload_file(
                     os.path.join(dirpath, filename),
-                    os.path.join(storage_subdir, filename)) and ok
+                    os.path.join(storage_subdir, filename),
+                    should_compress(filename, compress))
+                if blob is None:
+                    ok = False
+                else:
+                    uploaded.append(blob)
+
+        if manifest and ok:
+            ok = self.write_manifest(sub_path, uploaded[tree_start:])
 
         return ok
 
-    @classmethod
-    def download_blob(cls, blob, local_path):
+    def upload_archive(self, local_dir, sub_path, uploaded=None):
+        # type: (str, str, Optional[List[Blob]]) -> bool
+        """Upload the local_dir tree as one tar archive object named sub_path
+        (which is relative to the storage_prefix; see archive_name()), packing
+        and uploading it as a stream. This pays the per-object overhead once
+        rather than once per file.
+
+        If `uploaded` is a list, append the uploaded archive Blob to it.
+
+        This uploads in resumable chunks that recover from transient failures,
+        and verifies the archive's CRC32C if there's a CRC32C library.
+
+        Return True if successful. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        blob = self.bucket.blob(full_path)
+
+        def pack(writer):
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for name in sorted(os.listdir(local_dir)):
+                    tar.add(os.path.join(local_dir, name), arcname=name)
+
+        def upload(reader):
+            GCS_REQUESTS.labels('upload').inc()
+            resource = transfer.resumable_upload(
+                blob, self.client, reader, ARCHIVE_CONTENT_TYPE, None, self.stats)
+            if resource:
+                blob._set_properties(resource)
+            transfer.verify(blob, reader.crc32c.b64digest())
+            GCS_BYTES.labels('upload').inc(reader.position)
+
+        try:
+            self.make_dirs(sub_path)
+            _stream(pack, upload)
+        except ((GoogleCloudError, tarfile.TarError, IOError, OSError)
+                + transfer.TRANSFER_ERRORS) as e:
+            logging.exception(
+                'Failed to upload "%s" as GCS archive "%s"', local_dir, full_path)
+            return False
+
+        if uploaded is not None:
+            uploaded.append(blob)
+        return True
+
+    def download_archive(self, sub_path, local_dir):
+        # type: (str, str) -> bool
+        """Download the tar archive object named sub_path (which is relative to
+        the storage_prefix), extracting it into local_dir while it downloads.
+        This refuses archive members that would land outside local_dir.
+
+        This retries transient failures with jittered exponential backoff,
+        clearing local_dir and extracting the archive again, and verifies the
+        downloaded stream against the archive's CRC32C if there's a CRC32C
+        library.
+
+        Return True if successful. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+        attempts = []  # type: List[int]
+
+        def get_blob():
+            GCS_REQUESTS.labels('metadata').inc()
+            return self.bucket.get_blob(full_path)
+
+        def download(blob):
+            if attempts:  # clear out a partial extraction
+                shutil.rmtree(local_dir, ignore_errors=True)
+            attempts.append(1)
+            fp.makedirs(local_dir)
+            readers = []  # type: List[_PipeReader]
+
+            def extract(reader):
+                readers.append(reader)
+                _extract_archive(reader, local_dir)
+
+            GCS_REQUESTS.labels('download').inc()
+            _stream(blob.download_to_file, extract)
+
+            # The HTTP layer decompresses a gzip-encoded Blob, which changes
+            # the checksum.
+            if not blob.content_encoding:
+                transfer.verify(blob, readers[0].crc32c.b64digest())
+            GCS_BYTES.labels('download').inc(readers[0].position)
+
+        try:
+            blob = transfer.with_retries(get_blob, self.stats, 'download')
+            if blob is None:
+                logging.error('GCS archive "%s" not found', full_path)
+                return False
+
+            # The Blob has its generation, so retries get the same archive.
+            transfer.with_retries(lambda: download(blob), self.stats, 'download')
+        except ((GoogleCloudError, tarfile.TarError, IOError, OSError)
+                + transfer.TRANSFER_ERRORS) as e:
+            logging.exception(
+                'Failed to download GCS archive "%s" into "%s"', full_path,
+                local_dir)
+            return False
+        return True
+
+    def copy_blob(self, blob, sub_path):
+        # type: (Blob, str) -> Optional[Blob]
+        """Copy the Blob, pinned to its generation, as the GCS sub_path (which
+        is relative to the storage_prefix) via server-side rewrite requests,
+        which don't pass the data through this process.
+
+        If sub_path names the Blob itself and its generation is still the
+        current one, this returns the current Blob without copying since a
+        rewrite would make a new generation.
+
+        This retries transient failures with jittered exponential backoff.
+
+        Return the new (or same) Blob, or None if it failed. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+
+        def get_current():
+            GCS_REQUESTS.labels('metadata').inc()
+            return self.bucket.get_blob(full_path)
+
+        def rewrite():
+            dest = self.bucket.blob(full_path)
+            token = None
+            while True:
+                GCS_REQUESTS.labels('copy').inc()
+                token, _, _ = dest.rewrite(blob, token=token)
+                if not token:
+                    return dest
+
+        try:
+            if full_path == blob.name:
+                current = transfer.with_retries(get_current, self.stats, 'copy')
+                if current is not None and current.generation == blob.generation:
+                    return current
+
+            self.make_dirs(sub_path)
+            return transfer.with_retries(rewrite, self.stats, 'copy')
+        except (GoogleCloudError,) + transfer.TRANSFER_ERRORS as e:
+            logging.exception('Failed to copy GCS "%s" generation %s as "%s"',
+                              blob.name, blob.generation, full_path)
+            return None
+
+    def read_text(self, sub_path):
+        # type: (str) -> Optional[str]
+        """Return the text of the small GCS object named sub_path, or None if
+        it doesn't exist or it failed. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+
+        try:
+            GCS_REQUESTS.labels('download').inc()
+            return self.bucket.blob(full_path).download_as_string().decode('utf-8')
+        except NotFound:
+            return None
+        except GoogleCloudError as e:
+            logging.exception('Failed to read GCS "%s"', full_path)
+            return None
+
+    def write_text(self, sub_path, text, content_type='text/plain'):
+        # type: (str, str, str) -> bool
+        """Write the text as the GCS object named sub_path. Return True if
+        successful. Logs exceptions.
+        """
+        full_path = os.path.join(self.path_prefix, sub_path)
+
+        try:
+            self.make_dirs(sub_path)
+            GCS_REQUESTS.labels('upload').inc()
+            self.bucket.blob(full_path).upload_from_string(
+                text, content_type=content_type)
+        except GoogleCloudError as e:
+            logging.exception('Failed to write GCS "%s"', full_path)
+            return False
+        return True
+
+    def download_blob(self, blob, local_path):
         # type: (Blob, str) -> bool
         """Download a Blob from GCS as (not into) local_path, making directories
         if needed. `blob` must have its `name` and `bucket` fields set.
 
+        If the Blob's Content-Encoding is 'gzip' (e.g. it came from
+        list_blobs()), transfer it compressed and decompress it while streaming
+        it to the file. (Otherwise the HTTP layer will decompress a gzip-encoded
+        Blob on the fly.)
+
+        This retries transient failures with jittered exponential backoff and
+        verifies the download against the Blob's CRC32C, if known (e.g. from
+        list_blobs()) and there's a CRC32C library.
+
         Return True if successful. Logs exceptions.
         """
         if names_a_directory(local_path):
@@ -205,42 +1094,121 @@ class CloudStorage(object):
         fp.makedirs(os.path.dirname(local_path))
 
         try:
-            blob.download_to_filename(local_path)
-        except GoogleCloudError as e:
+            transfer.with_retries(
+                lambda: self._download(blob, local_path), self.stats, 'download')
+        except (GoogleCloudError, zlib.error, IOError, OSError) + transfer.TRANSFER_ERRORS as e:
             logging.exception(
                 'Failed to download GCS "%s" as "%s"', blob.name, local_path)
             return False
 
         return True
 
+    @staticmethod
+    def _download(blob, local_path):
+        # type: (Blob, str) -> None
+        """Download the Blob to local_path once, decompressing it if it's
+        gzip-encoded and verifying its CRC32C if known.
+        """
+        gzipped = blob.content_encoding == GZIP
+        GCS_REQUESTS.labels('download').inc()
+
+        with open(local_path, 'wb') as f:
+            if gzipped or blob.crc32c:
+                gunzip = _GunzipWriter(f) if gzipped else None
+                writer = transfer.ChecksumWriter(gunzip or f)
+                blob.download_to_file(writer, raw_download=True)
+                if gunzip:
+                    gunzip.close()
+                transfer.verify(blob, writer.crc32c.b64digest())
+            else:
+                blob.download_to_file(f)
+        GCS_BYTES.labels('download').inc(blob.size or 0)
+
     def download_file(self, sub_path, local_path):
         # type: (str, str) -> bool
         """Download the GCS file named sub_path (relative to the storage_prefix)
         as (not into) the local_path, making local directories if needed.
 
+        This fetches the Blob's metadata first to get its Content-Encoding.
+
         Return True if successful. Logs exceptions.
         """
         full_path = os.path.join(self.path_prefix, sub_path)
-        blob = self.bucket.blob(full_path)
+
+        def get_blob():
+            GCS_REQUESTS.labels('metadata').inc()
+            return self.bucket.get_blob(full_path)
+
+        try:
+            blob = transfer.with_retries(get_blob, self.stats, 'download')
+        except (GoogleCloudError,) + transfer.TRANSFER_ERRORS as e:
+            logging.exception('Failed to get GCS "%s"', full_path)
+            return False
+
+        if blob is None:
+            logging.error('GCS "%s" not found', full_path)
+            return False
+
         return self.download_blob(blob, local_path)
 
-    def download_tree(self, sub_path, local_prefix):
-        # type: (str, str) -> bool
+    def download_tree(self, sub_path, local_prefix, blobs=None, use_manifest=False):
+        # type: (str, str, Optional[Iterable[Blob]], bool) -> bool
         """Download all files and directories that begin with the sub_path
         prefix (within the storage_prefix) to their same relative paths in
         local_prefix, making directories if needed.
 
+        `blobs` is an optional list_files(sub_path) result to download rather
+        than listing them again. Otherwise, if `use_manifest` and the tree has
+        a manifest, download the Blob generations it lists. Otherwise list the
+        tree via walk_blobs(), downloading Blobs as their listing pages arrive.
+
         Return True if successful. Logs exceptions.
         """
-        if not names_a_directory(sub_path):
-            local_path = os.path.join(local_prefix, sub_path)
-            return self.download_file(sub_path, local_path)
+        if blobs is None:
+            if not names_a_directory(sub_path):
+                local_path = os.path.join(local_prefix, sub_path)
+                return self.download_file(sub_path, local_path)
+            if use_manifest:
+                blobs = self.read_manifest(sub_path)
+            if blobs is None:
+                blobs = self.walk_blobs(sub_path)
+        elif not blobs and not names_a_directory(sub_path):
+            logging.error('GCS "%s" not found',
+                          os.path.join(self.path_prefix, sub_path))
+            return False
+
+        try:
+            return self.download_blobs(blobs, local_prefix)
+        except GoogleCloudError as e:
+            logging.exception('Failed to list GCS "%s"',
+                              os.path.join(self.path_prefix, sub_path))
+            return False
 
+    def download_blobs(self, blobs, local_prefix):
+        # type: (Iterable[Blob], str) -> bool
+        """Download Blobs concurrently to their same relative paths (within the
+        storage_prefix) in local_prefix, starting on each one as `blobs`
+        yields it.
+
+        Return True if successful. Logs exceptions.
+        """
         ok = True
+        max_in_flight = 4 * self.max_workers
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+
+            for blob in blobs:
+                local_rel_path = relpath(blob.name, self.path_prefix)
+                path = os.path.join(local_prefix, local_rel_path)
+                in_flight.add(executor.submit(self.download_blob, blob, path))
+
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        ok = future.result() and ok
 
-        for blob in self.list_blobs(sub_path):
-            local_rel_path = relpath(blob.name, self.path_prefix)
-            path = os.path.join(local_prefix, local_rel_path)
-            ok = self.download_blob(blob, path) and ok
+            for future in in_flight:
+                ok = future.result() and ok
 
         return ok
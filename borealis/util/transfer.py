@@ -0,0 +1,276 @@
+"""A retrying, checksum-verifying transfer layer for Google Cloud Storage (GCS)
+Blob uploads and downloads.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import base64
+import inspect
+import logging
+import struct
+from threading import Lock
+import time
+from typing import Any, BinaryIO, Callable, Dict, Optional, TypeVar
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud.storage import Blob, Client
+from google.resumable_media import common as media_common
+import requests
+
+from borealis.util import data
+from borealis.util import metrics
+
+try:
+    import google_crc32c
+
+    def _crc32c_extend(crc, chunk):
+        # type: (int, bytes) -> int
+        return google_crc32c.extend(crc, chunk)
+except ImportError:
+    try:
+        import crcmod.predefined
+        _crcmod_fn = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
+
+        def _crc32c_extend(crc, chunk):
+            # type: (int, bytes) -> int
+            return _crcmod_fn(chunk, crc)
+    except ImportError:
+        _crc32c_extend = None
+
+T = TypeVar('T')
+
+#: True if a CRC32C library is installed to verify transfers end-to-end.
+CHECKSUMS = _crc32c_extend is not None
+
+#: Tries per transfer (or per resumable upload chunk) before giving up.
+MAX_ATTEMPTS = 5
+
+#: Upload files bigger than this in resumable chunks that can recover from
+#: failures rather than restarting.
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+
+#: Bytes per resumable upload request. GCS requires a multiple of 256 KB. Each
+#: upload buffers one chunk in memory.
+RESUMABLE_CHUNK_SIZE = 32 * 256 * 1024
+
+#: HTTP status codes worth retrying.
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+#: Errors worth retrying besides those with TRANSIENT_STATUS_CODES.
+TRANSIENT_ERRORS = (
+    media_common.DataCorruption,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError)
+
+
+class ChecksumMismatch(Exception):
+    """A transferred Blob's CRC32C checksum didn't match the local data's."""
+    pass
+
+
+#: Errors that a transfer can end with after retrying.
+TRANSFER_ERRORS = (
+    api_exceptions.GoogleAPICallError,
+    media_common.InvalidResponse,
+    ChecksumMismatch) + TRANSIENT_ERRORS
+
+
+def is_transient(error):
+    # type: (BaseException) -> bool
+    """Return True if the transfer error is worth retrying."""
+    if isinstance(error, (ChecksumMismatch,) + TRANSIENT_ERRORS):
+        return True
+    if isinstance(error, api_exceptions.GoogleAPICallError):
+        return error.code in TRANSIENT_STATUS_CODES
+    if isinstance(error, media_common.InvalidResponse):
+        return getattr(error.response, 'status_code', None) in TRANSIENT_STATUS_CODES
+    return False
+
+
+class Crc32c(object):
+    """An incremental CRC32C checksum in the GCS format, or a no-op if there's
+    no CRC32C library (see CHECKSUMS).
+    """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, chunk):
+        # type: (bytes) -> None
+        if CHECKSUMS:
+            self.value = _crc32c_extend(self.value, chunk)
+
+    def b64digest(self):
+        # type: () -> Optional[str]
+        """Return the base64-encoded big-endian checksum like GCS's Blob.crc32c,
+        or None if there's no CRC32C library.
+        """
+        if not CHECKSUMS:
+            return None
+        return base64.b64encode(struct.pack('>I', self.value)).decode('ascii')
+
+
+def file_crc32c(path, chunk_size=1024 * 1024):
+    # type: (str, int) -> Optional[str]
+    """Return the GCS-format CRC32C checksum of a local file, or None if there's
+    no CRC32C library.
+    """
+    if not CHECKSUMS:
+        return None
+
+    crc = Crc32c()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc.update(chunk)
+    return crc.b64digest()
+
+
+def verify(blob, expected):
+    # type: (Blob, Optional[str]) -> None
+    """Raise ChecksumMismatch if the Blob's CRC32C isn't the expected value.
+    Skip it if either one is unknown.
+    """
+    if expected and blob.crc32c and blob.crc32c != expected:
+        raise ChecksumMismatch('GCS "{}" CRC32C {} != local data CRC32C {}'.format(
+            blob.name, blob.crc32c, expected))
+
+
+class ChecksumWriter(object):
+    """A write-only file-like object that computes the CRC32C of the data as
+    it passes it to another file-like object.
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.crc32c = Crc32c()
+
+    def write(self, chunk):
+        # type: (bytes) -> None
+        self.crc32c.update(chunk)
+        self.file_obj.write(chunk)
+
+
+#: Process-wide counts of RetryStats events.
+RETRY_EVENTS = metrics.counter(
+    'borealis_gcs_retry_events_total',
+    'GCS transfer retries, resumed uploads, and checksum mismatches.',
+    ['event'])
+
+
+class RetryStats(object):
+    """Thread-safe counts of transfer retries and related events, to show how
+    degraded storage access is.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counts = {}  # type: Dict[str, int]
+
+    def count(self, event):
+        # type: (str) -> None
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+        RETRY_EVENTS.labels(event).inc()
+
+    def __bool__(self):
+        return bool(self.counts)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'RetryStats({!r})'.format(self.counts)
+
+
+def with_retries(fn, stats, kind):
+    # type: (Callable[[], T], RetryStats, str) -> T
+    """Call fn(), retrying transient errors with jittered exponential backoff.
+    Count the retries in stats as '{kind}_retries'.
+    """
+    attempt = 1
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= MAX_ATTEMPTS or not is_transient(e):
+                raise
+
+            stats.count(kind + '_retries')
+            if isinstance(e, (ChecksumMismatch, media_common.DataCorruption)):
+                stats.count('checksum_mismatches')
+            delay = data.backoff(attempt, base=1.0, limit=32.0)
+            logging.warning('Retrying GCS %s in %.1f s after: %r', kind, delay, e)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _takes_argument(fn, name):
+    # type: (Callable, str) -> bool
+    """Return True if the function has a parameter with the given name."""
+    try:
+        return name in inspect.signature(fn).parameters
+    except AttributeError:  # Python 2
+        return name in inspect.getargspec(fn).args
+
+
+#: True if Blob._initiate_resumable_upload() takes the `num_retries`
+#: parameter, which google-cloud-storage 3.0 removed. It's not public API so
+#: pass its arguments by keyword.
+_INITIATE_NUM_RETRIES = _takes_argument(
+    Blob._initiate_resumable_upload, 'num_retries')
+
+
+def _invalidate(upload):
+    # type: (Any) -> bool
+    """Mark the ResumableUpload invalid so recover() will query the server for
+    the last committed byte, if this google-resumable-media version has a way
+    to. Return True if the upload is now invalid.
+    """
+    if not upload.invalid:
+        make_invalid = getattr(upload, '_make_invalid', None)
+        if make_invalid is not None:
+            make_invalid()
+    return upload.invalid
+
+
+def resumable_upload(blob, client, stream, content_type, size, stats):
+    # type: (Blob, Client, BinaryIO, str, Optional[int], RetryStats) -> Dict[str, Any]
+    """Upload the stream to the Blob in resumable chunks, recovering from a
+    failed chunk by asking GCS for the last committed byte, seeking the stream
+    back to it, and continuing from there. `size` is the stream's length or
+    None if unknown. Return the created Blob's resource dict.
+
+    The stream must support read(), tell(), and seek() back to the last
+    chunk's start.
+    """
+    start = stream.tell()
+
+    def initiate():
+        stream.seek(start)
+        options = {'chunk_size': RESUMABLE_CHUNK_SIZE}
+        if _INITIATE_NUM_RETRIES:
+            options['num_retries'] = None
+        return blob._initiate_resumable_upload(
+            client, stream, content_type, size, **options)
+
+    upload, transport = with_retries(initiate, stats, 'upload')
+    response = None
+    failures = 0
+
+    while not upload.finished:
+        try:
+            response = upload.transmit_next_chunk(transport)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            if (failures >= MAX_ATTEMPTS or not is_transient(e)
+                    or not _invalidate(upload)):
+                raise
+
+            stats.count('upload_resumes')
+            delay = data.backoff(failures, base=1.0, limit=32.0)
+            logging.warning('Resuming the GCS upload of "%s" in %.1f s after: %r',
+                            blob.name, delay, e)
+            time.sleep(delay)
+            with_retries(lambda: upload.recover(transport), stats, 'upload')
+
+    return response.json() if response is not None else {}
@@ -22,13 +22,19 @@ setup(
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*, <4',
     install_requires=[
         'google-cloud-logging>=1.14.0',
-        'google-cloud-storage>=1.28.0',
+        'google-cloud-storage>=1.28.0,<4',
         'docker>=4.1.0',
         'FireWorks>=1.9.5',
         'requests>=2.22.0',
         'ruamel.yaml>=0.16.9',
         'subprocess32>=3.5.4',
+        'futures>=3.3.0; python_version < "3"',
+        'google-crc32c>=1.0.0; python_version >= "3.5"',
+        'crcmod>=1.7; python_version < "3"',
     ],
+    extras_require={
+        'async': ['aiohttp>=3.6.2; python_version >= "3.5.3"'],
+    },
     package_data={
         'borealis': ['setup/*'],
     },